@@ -0,0 +1,123 @@
+import os
+import hashlib
+import numpy as np
+
+# origin of a bbox, kept in the sources column
+bbox_sources = {'detector': 0, 'motion': 1, 'patch': 2}
+
+bbox_columns = ['boxes', 'offsets', 'scores', 'sources']
+
+def bbox_store_path(prefix, column):
+    return '{}_{}.npy'.format(prefix, column)
+
+class bbox_store:
+    '''
+    Ragged per-frame bboxes in CSR layout: the (M, 4) float32 boxes of all frames in frame order and the int64 offsets
+    of the frames, the boxes of frame i are boxes[offsets[i]:offsets[i + 1]]. Optional score and source columns hold
+    one value per box. Saved stores are memory-mapped, so worker processes share the boxes instead of copying them.
+    '''
+    def __init__(self, boxes, offsets, scores=None, sources=None, prefix=None):
+        '''
+        :param prefix: path prefix of the saved columns, the columns are reopened from it in worker processes
+        '''
+        self.boxes = boxes
+        self.offsets = offsets
+        self.scores = scores
+        self.sources = sources
+        self.prefix = prefix
+
+    @classmethod
+    def from_list(cls, all_bboxes, all_scores=None, all_sources=None):
+        '''
+        :param all_bboxes: list of (n_i, 4) bbox arrays of the frames
+        :param all_scores: optional list of (n_i,) scores
+        :param all_sources: optional list of (n_i,) sources, see bbox_sources
+        '''
+        counts = np.array([len(x) for x in all_bboxes], dtype=np.int64)
+        offsets = np.zeros(len(all_bboxes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        def flat(arrays, shape, dtype):
+            arrays = [np.asarray(x, dtype=dtype).reshape(shape) for x in arrays if len(x) > 0]
+            return np.concatenate(arrays) if len(arrays) > 0 else np.zeros((0,) + shape[1:], dtype=dtype)
+
+        boxes = flat(all_bboxes, (-1, 4), np.float32)
+        scores = None if all_scores is None else flat(all_scores, (-1,), np.float32)
+        sources = None if all_sources is None else flat(all_sources, (-1,), np.uint8)
+        return cls(boxes, offsets, scores, sources)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        columns = dict()
+        for column in bbox_columns:
+            if os.path.exists(bbox_store_path(prefix, column)):
+                columns[column] = np.load(bbox_store_path(prefix, column), mmap_mode=mmap_mode)
+        return cls(prefix=prefix, **columns)
+
+    @staticmethod
+    def exists(prefix):
+        return os.path.exists(bbox_store_path(prefix, 'offsets'))
+
+    def save(self, prefix):
+        # the offsets are written last, an interrupted save is not mistaken for a complete store
+        for column in ['boxes', 'scores', 'sources', 'offsets']:
+            value = getattr(self, column)
+            if value is None:
+                if os.path.exists(bbox_store_path(prefix, column)):
+                    os.remove(bbox_store_path(prefix, column))
+            else:
+                np.save(bbox_store_path(prefix, column), value)
+        self.prefix = prefix
+
+    def digest(self):
+        # sha1 of the boxes and offsets, identifies the bboxes the foreground of a run was extracted from
+        sha = hashlib.sha1()
+        for column in ['offsets', 'boxes']:
+            value = np.ascontiguousarray(getattr(self, column))
+            sha.update(str(value.dtype).encode())
+            sha.update(value.reshape(-1).view(np.uint8))
+        return sha.hexdigest()
+
+    def __getstate__(self):
+        # memory-mapped columns are reopened in worker processes instead of being pickled with their content
+        state = self.__dict__.copy()
+        if self.prefix is not None:
+            for column in bbox_columns:
+                state[column] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.prefix is not None:
+            self.__dict__.update(bbox_store.load(self.prefix).__dict__)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, indice):
+        return self.boxes[self.offsets[indice]:self.offsets[indice + 1]]
+
+    def get_scores(self, indice):
+        return None if self.scores is None else self.scores[self.offsets[indice]:self.offsets[indice + 1]]
+
+    def get_sources(self, indice):
+        return None if self.sources is None else self.sources[self.offsets[indice]:self.offsets[indice + 1]]
+
+def save_bboxes(prefix, all_bboxes):
+    '''
+    :param all_bboxes: bbox_store or list of per-frame bbox arrays
+    :return: the saved store
+    '''
+    if not isinstance(all_bboxes, bbox_store):
+        all_bboxes = bbox_store.from_list(all_bboxes)
+    all_bboxes.save(prefix)
+    return all_bboxes
+
+def load_bboxes(prefix, legacy_path=None):
+    '''
+    Memory-mapped bboxes saved by save_bboxes, a pickled object array of per-frame bboxes at legacy_path is converted
+    on first use
+    '''
+    if not bbox_store.exists(prefix) and legacy_path is not None and os.path.exists(legacy_path):
+        save_bboxes(prefix, list(np.load(legacy_path, allow_pickle=True)))
+    return bbox_store.load(prefix)
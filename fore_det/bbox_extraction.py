@@ -0,0 +1,223 @@
+import numpy as np
+from vad_datasets import img_tensor2numpy, img_batch_tensor2numpy, frame_size, prefetch_loader
+from bbox_store import bbox_store, bbox_sources
+from fore_det.inference import DetectorSession
+from fore_det.obj_det_with_motion import getObBboxesBatch, filterObBboxes, getFgBboxes, delCoverBboxes, MotionDiffCache
+from fore_det.simple_patch import get_patch_loc
+from fore_det.motion_bg import extractBgBboxes
+from fore_det.roi import frameScene, translateBboxes
+
+
+def getFrameBboxes(cur_img, batch, ob_bboxes, dataset_name, foreground_extraction_mode, frame_range=None, motion_cache=None, roi=None):
+    '''
+    Foreground bboxes of one frame
+    :param cur_img: the frame, (h, w, c)
+    :param batch: context window of the frame as returned by the dataset
+    :param ob_bboxes: bboxes of the detector for the frame, None if the mode does not use the detector
+    :param frame_range: frame indices of the window, to share blurred frames with the neighbouring windows through motion_cache
+    :param roi: SceneROI of the frame, motion outside it is ignored
+    :return: bboxes and their sources, see bbox_sources
+    '''
+    if foreground_extraction_mode == 'obj_det_with_motion':
+        # A coarse detection of bboxes by pretrained object detector
+        ob_bboxes = delCoverBboxes(ob_bboxes, dataset_name)
+
+        # further foreground detection by motion
+        fg_bboxes = getFgBboxes(cur_img, img_batch_tensor2numpy(batch), ob_bboxes, dataset_name, verbose=False,
+                                frame_range=frame_range, motion_cache=motion_cache, roi=roi)
+        if fg_bboxes.shape[0] > 0:
+            cur_bboxes = np.concatenate((ob_bboxes, fg_bboxes), axis=0)
+        else:
+            cur_bboxes = ob_bboxes
+        cur_sources = np.repeat([bbox_sources['detector'], bbox_sources['motion']], [ob_bboxes.shape[0], fg_bboxes.shape[0]])
+    elif foreground_extraction_mode == 'obj_det':
+        # A coarse detection of bboxes by pretrained object detector
+        cur_bboxes = delCoverBboxes(ob_bboxes, dataset_name)
+        cur_sources = np.full(cur_bboxes.shape[0], bbox_sources['detector'])
+    elif foreground_extraction_mode == 'simple_patch':
+        patch_num_list = [(3, 4), (6, 8)]
+        cur_bboxes = list()
+        for h_num, w_num in patch_num_list:
+            cur_bboxes.append(get_patch_loc(frame_size[dataset_name][0], frame_size[dataset_name][1], h_num, w_num))
+        cur_bboxes = np.concatenate(cur_bboxes, axis=0)
+        cur_sources = np.full(cur_bboxes.shape[0], bbox_sources['patch'])
+    else:
+        raise NotImplementedError
+    return cur_bboxes, cur_sources
+
+
+def detectorAddr(dataset, idx, roi):
+    # address of the detector input of a frame, the crop of the ROI is part of it
+    addr = dataset.all_frame_addr[dataset.context_range(idx)[1]]
+    if roi is None or roi.rect is None:
+        return addr
+    return '{}@{},{},{},{}'.format(addr, *roi.rect)
+
+
+def frameRoi(dataset, idx, rois):
+    return rois.get(frameScene(dataset, idx)) if rois else None
+
+
+def objDetStore(all_ob_bboxes, dataset_name):
+    # obj_det bboxes from the detector bboxes of each frame, static frames (None) reuse the bboxes of the previous frame
+    all_bboxes = list()
+    for ob_bboxes in all_ob_bboxes:
+        all_bboxes.append(all_bboxes[-1] if ob_bboxes is None else delCoverBboxes(ob_bboxes, dataset_name))
+    return bbox_store.from_list(all_bboxes, all_sources=[np.full(len(x), bbox_sources['detector']) for x in all_bboxes])
+
+
+def getCachedObjBboxes(dataset, dataset_name, det_cache, rois=None, indices=None):
+    # obj_det bboxes from the cached detections of unchanged frame files, None if a frame is missing from the cache
+    all_bboxes = list()
+    for idx in (range(len(dataset)) if indices is None else indices):
+        roi = frameRoi(dataset, idx, rois)
+        if roi is not None and roi.rect is None:
+            # the frame shape is only known once a frame is read
+            return None
+        dets = det_cache.getByAddr(detectorAddr(dataset, idx, roi))
+        if dets is None:
+            return None
+        ob_bboxes = filterObBboxes(dets, dataset_name)
+        if roi is not None:
+            ob_bboxes = translateBboxes(ob_bboxes, roi.rect[:2])
+        all_bboxes.append(delCoverBboxes(ob_bboxes, dataset_name))
+    return bbox_store.from_list(all_bboxes, all_sources=[np.full(len(x), bbox_sources['detector']) for x in all_bboxes])
+
+
+def extractBboxes(dataset, model, dataset_name, foreground_extraction_mode, det_batch_size=8, num_workers=0, prefetch_depth=None,
+                  det_cache=None, scheduler=None, static_gate=None, rois=None, indices=None, ob_bboxes=None, detect_only=False):
+    '''
+    Extract the foreground bboxes of all frames of a dataset, frames are detected in batches of det_batch_size
+    :param dataset: dataset with context_frame_num=1, the middle frame of each window is the detected frame
+    :param model: detector built by init_detector, None for simple_patch and motion_bg
+    :param det_cache: DetectionCache of raw detections, only frames missing from it are forwarded by the detector
+    :param scheduler: KeyframeScheduler, the detector only runs on keyframes and the bboxes of the others are propagated
+    :param static_gate: StaticFrameGate, static frames reuse the bboxes of the previous frame
+    :param rois: per-scene SceneROI as returned by loadRoi, the detector only sees the bounding rectangle of the ROI
+        and motion outside the ROI is ignored
+    :param indices: frames to extract in increasing order, all frames if None
+    :param ob_bboxes: detector bboxes of the frames as returned with detect_only, the detector is not used
+    :param detect_only: return the detector bboxes of each frame, None for static frames, instead of the bbox_store
+    :return: bbox_store of the bboxes in frame order
+    '''
+    if foreground_extraction_mode == 'motion_bg':
+        # no detector, whole videos are processed in parallel on the cpu
+        all_bboxes = extractBgBboxes(dataset, dataset_name, num_workers=num_workers, rois=rois)
+        return bbox_store.from_list(all_bboxes, all_sources=[np.full(len(x), bbox_sources['motion']) for x in all_bboxes])
+    if det_cache is not None and foreground_extraction_mode == 'obj_det' and not detect_only:
+        # the bboxes only depend on the detections, the frames are not read at all if every frame is cached
+        all_bboxes = getCachedObjBboxes(dataset, dataset_name, det_cache, rois=rois, indices=indices)
+        if all_bboxes is not None:
+            print('bboxes derived from the cached detections')
+            return all_bboxes
+    if ob_bboxes is not None and foreground_extraction_mode == 'obj_det':
+        # the bboxes only depend on the given detections, the frames are not read
+        return objDetStore(ob_bboxes, dataset_name)
+    items = [x for _, x in iterBboxes(dataset, model, dataset_name, foreground_extraction_mode, det_batch_size=det_batch_size,
+                                      num_workers=num_workers, prefetch_depth=prefetch_depth, det_cache=det_cache,
+                                      scheduler=scheduler, static_gate=static_gate, rois=rois, indices=indices,
+                                      ob_bboxes=ob_bboxes, detect_only=detect_only)]
+    if detect_only:
+        return items
+    return bbox_store.from_list([x[0] for x in items], all_sources=[x[1] for x in items])
+
+
+def iterBboxes(dataset, model, dataset_name, foreground_extraction_mode, det_batch_size=8, num_workers=0, prefetch_depth=None,
+               det_cache=None, scheduler=None, static_gate=None, rois=None, indices=None, ob_bboxes=None, detect_only=False):
+    '''
+    The bboxes of extractBboxes frame by frame as they are extracted, (idx, (bboxes, sources)) for every frame in order,
+    or (idx, detector bboxes) with detect_only, None for static frames. motion_bg is not supported.
+    '''
+    use_detector = foreground_extraction_mode in ['obj_det_with_motion', 'obj_det'] and ob_bboxes is None
+    if use_detector:
+        session = DetectorSession(model, batch_size=det_batch_size)
+    if ob_bboxes is not None:
+        # static frames were found with the detector bboxes
+        ob_bboxes = iter(ob_bboxes)
+        static_gate = None
+    # frames are visited in order, so each frame is blurred once for the motion bboxes
+    motion_cache = MotionDiffCache()
+    # bboxes and sources of the last processed frame, reused by static frames
+    last = None
+    pending = list()
+
+    def detect(positions, cur_imgs, cur_rois):
+        # detector bboxes of some of the pending frames, in full-frame coordinates
+        det_imgs, offsets, addrs = list(), list(), list()
+        for i in positions:
+            idx = pending[i][0]
+            if cur_rois[i] is None:
+                det_img, offset = cur_imgs[i], (0, 0)
+            else:
+                det_img, offset = cur_rois[i].cropFrame(cur_imgs[i])
+            det_imgs.append(det_img)
+            offsets.append(offset)
+            addrs.append(detectorAddr(dataset, idx, cur_rois[i]))
+        all_ob_bboxes = getObBboxesBatch(det_imgs, session, dataset_name, det_cache=det_cache, addrs=addrs)
+        return [translateBboxes(x, offset) for x, offset in zip(all_ob_bboxes, offsets)]
+
+    def flush():
+        # items of the pending frames, see iterBboxes
+        nonlocal last
+        frame_indices = [idx for idx, _ in pending]
+        cur_imgs = [img_tensor2numpy(batch[1]) for _, batch in pending]
+        if ob_bboxes is not None:
+            given = [next(ob_bboxes) for _ in pending]
+            is_static = [x is None for x in given]
+        elif static_gate is not None:
+            is_static = [static_gate.isStatic(cur_img, dataset.frame_video_idx[idx]) for cur_img, (idx, _) in zip(cur_imgs, pending)]
+        else:
+            is_static = [False] * len(pending)
+        for i in range(len(pending) - 1, -1, -1):
+            if is_static[i]:
+                del pending[i]
+                del cur_imgs[i]
+        cur_rois = [frameRoi(dataset, idx, rois) for idx, _ in pending]
+        if ob_bboxes is not None:
+            all_ob_bboxes = [x for x in given if x is not None]
+        elif use_detector:
+            if scheduler is None:
+                is_key = [True] * len(pending)
+            else:
+                is_key = scheduler.scheduleKeyframes([idx for idx, _ in pending], [dataset.frame_video_idx[idx] for idx, _ in pending])
+            key_pos = [i for i, x in enumerate(is_key) if x]
+            key_bboxes = detect(key_pos, cur_imgs, cur_rois)
+            all_ob_bboxes = [None] * len(pending)
+            for i, cur_ob_bboxes in zip(key_pos, key_bboxes):
+                all_ob_bboxes[i] = cur_ob_bboxes
+            if scheduler is not None:
+                for i, (idx, _) in enumerate(pending):
+                    if not is_key[i]:
+                        all_ob_bboxes[i] = scheduler.propagate(idx)
+                        if all_ob_bboxes[i] is not None:
+                            continue
+                        # the propagated bboxes drifted, the frame is detected after all
+                        all_ob_bboxes[i] = detect([i], cur_imgs, cur_rois)[0]
+                    scheduler.setKeyframe(all_ob_bboxes[i], idx)
+        else:
+            all_ob_bboxes = [None] * len(pending)
+        processed = iter(zip(cur_imgs, pending, all_ob_bboxes, cur_rois))
+        items = list()
+        for frame_idx, static in zip(frame_indices, is_static):
+            if detect_only:
+                items.append((frame_idx, None if static else next(processed)[2]))
+                continue
+            if not static:
+                # the first frame of a video is never static
+                cur_img, (idx, batch), cur_ob_bboxes, roi = next(processed)
+                last = getFrameBboxes(cur_img, batch, cur_ob_bboxes, dataset_name, foreground_extraction_mode,
+                                      frame_range=dataset.context_range(idx), motion_cache=motion_cache, roi=roi)
+            items.append((frame_idx, last))
+        del pending[:]
+        return items
+
+    for idx, items in prefetch_loader([dataset], indices=indices, num_workers=num_workers, prefetch_depth=prefetch_depth):
+        batch, _ = items[0]
+        print('Extracting bboxes of {}-th frame'.format(idx + 1))
+        pending.append((idx, batch))
+        if len(pending) == det_batch_size:
+            for item in flush():
+                yield item
+    if len(pending) > 0:
+        for item in flush():
+            yield item
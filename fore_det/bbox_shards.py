@@ -0,0 +1,159 @@
+import os
+import json
+import shutil
+import multiprocessing
+import numpy as np
+import cv2
+from bbox_store import bbox_store, bbox_sources, save_bboxes
+from fore_det.bbox_extraction import extractBboxes, iterBboxes, frameRoi
+from fore_det.motion_bg import getVideoBgBboxes
+from fore_det.roi import roiPath
+
+# dataset and settings of the worker processes of extractBboxesSharded
+shard_worker_args = None
+
+
+def videoRanges(dataset):
+    # (start, length) of each video in frame order
+    ranges = list()
+    start = 0
+    for cont in dataset.videos.values():
+        ranges.append((start, cont['length']))
+        start += cont['length']
+    return ranges
+
+
+def shardPrefix(shard_dir, video_idx):
+    return os.path.join(shard_dir, 'video_{:05d}'.format(video_idx))
+
+
+def initShardWorker(dataset, dataset_name, foreground_extraction_mode, rois):
+    global shard_worker_args
+    # frames of a shard are read once, a frame cache would only hold frames that are never read again
+    dataset.cache = None
+    shard_worker_args = (dataset, dataset_name, foreground_extraction_mode, rois)
+    cv2.setNumThreads(1)
+
+
+def extractShard(dataset, dataset_name, foreground_extraction_mode, rois, start, length, ob_bboxes, prefix):
+    '''
+    Extract the bboxes of one video and save them as a bbox_store at prefix
+    :param ob_bboxes: detector bboxes of the frames found by the main process, None for the modes without detector
+    '''
+    if foreground_extraction_mode == 'motion_bg':
+        all_bboxes = getVideoBgBboxes(dataset, start, length, dataset_name, roi=frameRoi(dataset, start, rois) if length > 0 else None)
+        store = bbox_store.from_list(all_bboxes, all_sources=[np.full(len(x), bbox_sources['motion']) for x in all_bboxes])
+    else:
+        store = extractBboxes(dataset, None, dataset_name, foreground_extraction_mode, rois=rois,
+                              indices=list(range(start, start + length)), ob_bboxes=ob_bboxes)
+    # the offsets are saved last, a shard interrupted while saving is extracted again
+    store.save(prefix)
+    return prefix
+
+
+def extractShardWorker(args):
+    return extractShard(*(shard_worker_args + args))
+
+
+def shardMeta(dataset, foreground_extraction_mode, ranges, detector_key=None, scheduler=None, static_gate=None):
+    # the frames and settings the bboxes of the shards depend on
+    roi = None
+    if os.path.exists(roiPath(dataset.dir)):
+        with open(roiPath(dataset.dir)) as f:
+            roi = json.load(f)
+    return {'dir': dataset.dir, 'mode': dataset.mode, 'foreground_extraction_mode': foreground_extraction_mode,
+            'lengths': [length for _, length in ranges], 'detector_key': detector_key, 'roi': roi,
+            'static_thr': static_gate.thr if static_gate is not None else 0,
+            'det_interval': scheduler.interval if scheduler is not None else 1,
+            'det_motion_change_thr': scheduler.motion_change_thr if scheduler is not None else None,
+            'det_drift_thr': scheduler.drift_thr if scheduler is not None else None,
+            'det_spread_thr': scheduler.spread_thr if scheduler is not None else None}
+
+
+def checkShards(shard_dir, meta):
+    # shards of a previous run are only resumed if they were extracted from the same frames with the same settings
+    meta_path = os.path.join(shard_dir, 'shards.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == meta:
+                return
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+
+
+def mergeShards(prefixes):
+    # shards in video order concatenated into the bbox_store of all frames
+    shards = [bbox_store.load(x) for x in prefixes]
+    offsets = [np.zeros(1, dtype=np.int64)]
+    total = 0
+    for shard in shards:
+        offsets.append(shard.offsets[1:] + total)
+        total += shard.offsets[-1]
+    boxes = np.concatenate([x.boxes for x in shards]) if len(shards) > 0 else np.zeros((0, 4), dtype=np.float32)
+    sources = None
+    if len(shards) > 0 and all(x.sources is not None for x in shards):
+        sources = np.concatenate([x.sources for x in shards])
+    return bbox_store(boxes, np.concatenate(offsets), sources=sources)
+
+
+def extractBboxesSharded(dataset, model, dataset_name, foreground_extraction_mode, prefix, num_workers, det_batch_size=8,
+                         prefetch_depth=None, det_cache=None, scheduler=None, static_gate=None, rois=None, detector_key=None):
+    '''
+    Extract the bboxes of a dataset video by video in a process pool and merge them into the bbox_store at prefix
+    Each video is saved as a shard in <prefix>_shards as soon as it is done, after a crash the videos with a
+    complete shard are not extracted again. The detector runs in the main process on the frames of all remaining
+    videos, read by one prefetch_loader, and hands each video to the shard workers once it is detected. The motion
+    bboxes, simple_patch and motion_bg run in the shard workers, obj_det bboxes only need the detections and are
+    derived without reading the frames again.
+    :param prefix: path prefix of the merged bbox_store, see save_bboxes
+    :param num_workers: number of worker processes, shared by the frame readers of the detector and the shard workers
+    :param detector_key: detectorKey of the detector, shards extracted by another detector are discarded
+    :return: the merged bbox_store
+    '''
+    shard_dir = prefix + '_shards'
+    ranges = videoRanges(dataset)
+    checkShards(shard_dir, shardMeta(dataset, foreground_extraction_mode, ranges, detector_key=detector_key,
+                                     scheduler=scheduler, static_gate=static_gate))
+    prefixes = [shardPrefix(shard_dir, video_idx) for video_idx in range(len(ranges))]
+    todo = [video_idx for video_idx in range(len(ranges)) if not bbox_store.exists(prefixes[video_idx])]
+    print('{} of {} videos already extracted'.format(len(ranges) - len(todo), len(ranges)))
+    use_detector = foreground_extraction_mode in ['obj_det_with_motion', 'obj_det']
+    reader_num = 0
+    if use_detector:
+        # obj_det shards do not read frames, obj_det_with_motion shards read every frame again for the motion bboxes
+        reader_num = num_workers - 1 if foreground_extraction_mode == 'obj_det' else num_workers // 2
+    shard_num = max(num_workers - reader_num, 1)
+
+    detections = None
+    if use_detector:
+        todo_indices = [idx for video_idx in todo for idx in range(ranges[video_idx][0], sum(ranges[video_idx]))]
+        detections = iterBboxes(dataset, model, dataset_name, foreground_extraction_mode, det_batch_size=det_batch_size,
+                                num_workers=reader_num, prefetch_depth=prefetch_depth, det_cache=det_cache,
+                                scheduler=scheduler, static_gate=static_gate, rois=rois, indices=todo_indices, detect_only=True)
+    pool = multiprocessing.Pool(shard_num, initializer=initShardWorker, initargs=(dataset, dataset_name, foreground_extraction_mode, rois))
+    try:
+        in_flight = list()
+        for video_idx in todo:
+            print('Extracting bboxes of {}-th video, {} in total'.format(video_idx + 1, len(ranges)))
+            start, length = ranges[video_idx]
+            ob_bboxes = None
+            if use_detector:
+                ob_bboxes = [next(detections)[1] for _ in range(length)]
+            in_flight.append(pool.apply_async(extractShardWorker, ((start, length, ob_bboxes, prefixes[video_idx]),)))
+            # the detections of at most 2 * shard_num videos wait for the workers
+            while len(in_flight) >= 2 * shard_num:
+                in_flight.pop(0).get()
+        for result in in_flight:
+            result.get()
+    finally:
+        if detections is not None:
+            detections.close()
+        pool.terminate()
+        pool.join()
+
+    save_bboxes(prefix, mergeShards(prefixes))
+    shutil.rmtree(shard_dir)
+    return bbox_store.load(prefix)
@@ -0,0 +1,129 @@
+import os
+import hashlib
+import sqlite3
+import numpy as np
+
+
+def frameHash(img):
+    # content address of a frame, identical frames share their detections across datasets and runs
+    sha = hashlib.sha1()
+    sha.update(str((img.shape, img.dtype.str)).encode())
+    sha.update(np.ascontiguousarray(img).tobytes())
+    return sha.hexdigest()
+
+
+def detectorKey(config_file, checkpoint_file):
+    # the detections depend on the detector config and its weights
+    sha = hashlib.sha1()
+    with open(config_file, 'rb') as f:
+        sha.update(f.read())
+    with open(checkpoint_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def toDetections(result):
+    '''
+    Raw detections of all classes as one (M, 6) float32 array of [x1, y1, x2, y2, score, class],
+    rows are in the order of np.vstack(result)
+    '''
+    if isinstance(result, tuple):
+        result = result[0]
+    dets = [np.hstack((np.asarray(x, dtype=np.float32).reshape(-1, 5), np.full((len(x), 1), i, dtype=np.float32)))
+            for i, x in enumerate(result)]
+    if len(dets) == 0:
+        return np.zeros((0, 6), dtype=np.float32)
+    return np.vstack(dets)
+
+
+def addrStat(addr):
+    # frames of video files are addressed as <video file>#<frame number>, crops of a frame as <frame>@<x1>,<y1>,<x2>,<y2>
+    path = addr.split('@')[0].split('#')[0]
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class DetectionCache(object):
+    """Raw detector outputs of frames, keyed by frame content hash and detector.
+
+    Detections are stored before any score or area threshold, so the bboxes
+    of getObBboxes and delCoverBboxes can be derived again with other
+    thresholds without the detector. A second table maps frame files to their
+    content hash, so frames that did not change need not be decoded again.
+
+    Args:
+        path (str): The sqlite database file.
+        detector_key (str): See detectorKey.
+    """
+
+    def __init__(self, path, detector_key):
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.detector_key = detector_key
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS detections (frame_hash TEXT, detector TEXT, dets BLOB, PRIMARY KEY (frame_hash, detector))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS frames (addr TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, frame_hash TEXT)')
+        self.db.commit()
+
+    def __getstate__(self):
+        raise TypeError('DetectionCache is only used in the main process')
+
+    def get(self, frame_hash):
+        row = self.db.execute('SELECT dets FROM detections WHERE frame_hash = ? AND detector = ?',
+                              (frame_hash, self.detector_key)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).reshape(-1, 6)
+
+    def put(self, frame_hashes, all_dets):
+        self.db.executemany('INSERT OR REPLACE INTO detections VALUES (?, ?, ?)',
+                            [(x, self.detector_key, np.ascontiguousarray(y, dtype=np.float32).tobytes())
+                             for x, y in zip(frame_hashes, all_dets)])
+        self.db.commit()
+
+    def getHashByAddr(self, addr):
+        stat = addrStat(addr)
+        if stat is None:
+            return None
+        row = self.db.execute('SELECT size, mtime, frame_hash FROM frames WHERE addr = ?', (addr,)).fetchone()
+        if row is None or tuple(row[:2]) != stat:
+            return None
+        return row[2]
+
+    def putAddrs(self, addrs, frame_hashes):
+        rows = list()
+        for addr, frame_hash in zip(addrs, frame_hashes):
+            stat = addrStat(addr)
+            if stat is not None:
+                rows.append((addr, stat[0], stat[1], frame_hash))
+        self.db.executemany('INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?)', rows)
+        self.db.commit()
+
+    def getByAddr(self, addr):
+        frame_hash = self.getHashByAddr(addr)
+        return None if frame_hash is None else self.get(frame_hash)
+
+
+def detectFrames(imgs, session, det_cache=None, addrs=None):
+    '''
+    Raw (M, 6) detections of a list of frames, only frames missing from det_cache are forwarded by the detector
+    :param session: DetectorSession
+    :param addrs: frame addresses, recorded in det_cache to find the detections of unchanged files without decoding them
+    '''
+    if det_cache is None:
+        return [toDetections(x) for x in session(imgs)]
+    frame_hashes = [frameHash(x) for x in imgs]
+    all_dets = [det_cache.get(x) for x in frame_hashes]
+    missing = [i for i, x in enumerate(all_dets) if x is None]
+    if len(missing) > 0:
+        new_dets = [toDetections(x) for x in session([imgs[i] for i in missing])]
+        det_cache.put([frame_hashes[i] for i in missing], new_dets)
+        for i, dets in zip(missing, new_dets):
+            all_dets[i] = dets
+    if addrs is not None:
+        det_cache.putAddrs(addrs, frame_hashes)
+    return all_dets
@@ -0,0 +1,175 @@
+import numpy as np
+import cv2
+from collections import OrderedDict
+
+
+class KeyframeScheduler(object):
+    """Runs the object detector on keyframes only and propagates the bboxes in between by optical flow.
+
+    Keyframes are the first frame of each video, every interval-th frame of a
+    video and the frames whose mean flow magnitude changes by more than
+    motion_change_thr pixels from the previous frame. The bboxes of the other
+    frames are those of the last keyframe or propagated frame, shifted frame by
+    frame by the median flow inside each bbox. Frames may be left out, e.g. the
+    static frames of StaticFrameGate: their flow is still applied, and a left
+    out interval-th frame moves the keyframe to the next frame. A propagated frame is detected after all if one of its bboxes
+    drifts: it moved by more than drift_thr of its size since the keyframe,
+    the flow inside it spreads by more than spread_thr pixels (median absolute
+    deviation) or it left half of its area outside the frame.
+
+    Args:
+        flow_dataset: dataset of the optical flow of the frames, the flow of
+            frame t is the motion from frame t to frame t + 1.
+        interval (int): Frames between two scheduled keyframes.
+    """
+
+    def __init__(self, flow_dataset, interval=5, motion_change_thr=1.0, drift_thr=0.5, spread_thr=2.0, flow_cache_size=32):
+        self.flow_dataset = flow_dataset
+        self.interval = interval
+        self.motion_change_thr = motion_change_thr
+        self.drift_thr = drift_thr
+        self.spread_thr = spread_thr
+        self.video_idx = None
+        self.video_start = 0
+        self.last_scheduled = None
+        self.motion = list()
+        # flows are read when the keyframes of a batch are scheduled and again when its bboxes are propagated
+        self.flows = OrderedDict()
+        self.flow_cache_size = flow_cache_size
+        # bboxes of frame last_idx and their shift since the keyframe
+        self.bboxes = None
+        self.shift = None
+        self.last_idx = None
+        self.detected = 0
+        self.propagated = 0
+
+    def __repr__(self):
+        return 'KeyframeScheduler(interval={}, detected {} frames, propagated {} frames)'.format(self.interval, self.detected, self.propagated)
+
+    def getFlow(self, idx):
+        if idx not in self.flows:
+            self.flows[idx] = np.asarray(self.flow_dataset.get_frame(idx), dtype=np.float32)
+            if len(self.flows) > self.flow_cache_size:
+                self.flows.popitem(last=False)
+        return self.flows[idx]
+
+    def motionEnergy(self, idx):
+        return float(np.mean(np.linalg.norm(self.getFlow(idx), axis=2)))
+
+    def scheduleKeyframes(self, indices, video_indices):
+        '''
+        Whether each frame of a run of consecutive frames is a scheduled keyframe, decided before any detection
+        :param indices: frame indices in increasing order, frames may be left out
+        :param video_indices: video index of each frame
+        '''
+        is_key = list()
+        for idx, video_idx in zip(indices, video_indices):
+            if video_idx != self.video_idx:
+                self.video_idx = video_idx
+                self.video_start = idx
+                self.last_scheduled = None
+                self.motion = list()
+            # the motion from frame idx - 1 to idx
+            if idx > self.video_start:
+                self.motion.append(self.motionEnergy(idx - 1))
+            motion_change = len(self.motion) >= 2 and abs(self.motion[-1] - self.motion[-2]) > self.motion_change_thr
+            if len(self.motion) > 2:
+                self.motion = self.motion[-2:]
+            # an interval-th frame was reached since the last scheduled frame, it is idx unless frames were left out
+            interval_reached = self.last_scheduled is not None and \
+                (idx - self.video_start) // self.interval > (self.last_scheduled - self.video_start) // self.interval
+            is_key.append(idx == self.video_start or interval_reached or motion_change)
+            self.last_scheduled = idx
+        return is_key
+
+    def setKeyframe(self, bboxes, idx):
+        self.bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+        self.shift = np.zeros((len(self.bboxes), 2), dtype=np.float32)
+        self.last_idx = idx
+        self.detected += 1
+
+    def propagate(self, idx):
+        '''
+        Bboxes of frame idx from those of frame last_idx, moved by the flow of every frame in between, None if they
+        drift and the frame has to be detected
+        '''
+        for t in range(self.last_idx, idx):
+            if not self.step(t):
+                return None
+        self.propagated += 1
+        return self.bboxes
+
+    def step(self, t):
+        # moves the bboxes of frame t to frame t + 1, False if they drift
+        flow = self.getFlow(t)
+        h, w = flow.shape[:2]
+        new_bboxes = self.bboxes.copy()
+        for i, (x1, y1, x2, y2) in enumerate(self.bboxes):
+            l, top = max(int(x1), 0), max(int(y1), 0)
+            r, b = min(int(x2) + 1, w), min(int(y2) + 1, h)
+            if r <= l or b <= top:
+                return False
+            box_flow = flow[top:b, l:r].reshape(-1, 2)
+            median = np.median(box_flow, axis=0)
+            if np.median(np.abs(box_flow - median)) > self.spread_thr:
+                return False
+            self.shift[i] += median
+            size = max(x2 - x1, y2 - y1, 1)
+            if np.linalg.norm(self.shift[i]) > self.drift_thr * size:
+                return False
+            new_bboxes[i, [0, 2]] += median[0]
+            new_bboxes[i, [1, 3]] += median[1]
+        clipped = new_bboxes.copy()
+        clipped[:, [0, 2]] = np.clip(clipped[:, [0, 2]], 0, w - 1)
+        clipped[:, [1, 3]] = np.clip(clipped[:, [1, 3]], 0, h - 1)
+        area = (new_bboxes[:, 2] - new_bboxes[:, 0]) * (new_bboxes[:, 3] - new_bboxes[:, 1])
+        clipped_area = (clipped[:, 2] - clipped[:, 0]) * (clipped[:, 3] - clipped[:, 1])
+        if np.any(clipped_area < 0.5 * area):
+            return False
+        self.bboxes = clipped
+        self.last_idx = t + 1
+        return True
+
+
+class StaticFrameGate(object):
+    """Skips the frames of a fixed camera that barely change.
+
+    A frame is static if the mean absolute difference of its grayscale,
+    downsampled by scale, to the last processed frame of the same video is
+    below thr. Static frames reuse the bboxes of the previous frame.
+
+    Args:
+        thr (float): Mean absolute difference (0-255) below which a frame is
+            static.
+        scale (int): Downsampling factor of the compared frames.
+    """
+
+    def __init__(self, thr=1.0, scale=4):
+        self.thr = thr
+        self.scale = scale
+        self.video_idx = None
+        self.last_frame = None
+        self.skipped = 0
+        self.total = 0
+
+    def __repr__(self):
+        return 'StaticFrameGate(thr={}, skipped {} of {} frames, skip ratio {:.2%})'.format(
+            self.thr, self.skipped, self.total, self.skipped / max(self.total, 1))
+
+    def downsample(self, img):
+        if img.ndim == 3 and img.shape[2] == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        elif img.ndim == 3:
+            img = img[:, :, 0]
+        h, w = img.shape
+        return cv2.resize(img, (max(w // self.scale, 1), max(h // self.scale, 1)), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def isStatic(self, img, video_idx):
+        self.total += 1
+        small = self.downsample(img)
+        if video_idx == self.video_idx and float(np.mean(np.abs(small - self.last_frame))) < self.thr:
+            self.skipped += 1
+            return True
+        self.video_idx = video_idx
+        self.last_frame = small
+        return False
@@ -4,6 +4,7 @@ import mmcv
 import numpy as np
 import pycocotools.mask as maskUtils
 import torch
+import mmdet
 from mmcv.parallel import collate, scatter
 from mmcv.runner import load_checkpoint
 from mmdet.core import get_classes
@@ -122,6 +123,92 @@ def inference_detector(model, img):
     return result
 
 
+class SharedFeatDetector(object):
+    """A detector whose extract_feat returns precomputed features.
+
+    simple_test of mmdet 1.x detectors starts with self.extract_feat(img), it
+    is called with this object as self to run the heads of one image on its
+    features. Every other attribute is the detector's, the detector itself is
+    not modified.
+
+    Args:
+        model (nn.Module): The loaded detector.
+        feats (tuple[Tensor]): Features of the image.
+    """
+
+    def __init__(self, model, feats):
+        self.model = model
+        self.feats = feats
+
+    def extract_feat(self, img):
+        return self.feats
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+class DetectorSession(object):
+    """Inference of frame batches with a detector.
+
+    The test pipeline is built once and the frames of a batch are collated
+    together. mmdet 2.x forwards the whole batch at once. mmdet 1.x
+    BaseDetector.forward_test only tests one image per gpu, there the
+    backbone and neck run once on the whole batch and the heads image by
+    image on the features of the batch.
+
+    Args:
+        model (nn.Module): The loaded detector.
+        batch_size (int): Max number of frames forwarded together.
+    """
+
+    def __init__(self, model, batch_size=8):
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.test_pipeline = Compose([LoadImage()] + model.cfg.data.test.pipeline[1:])
+        self.batch_size = batch_size
+        self.multi_image = int(mmdet.__version__.split('.')[0]) >= 2
+
+    def forward(self, datas):
+        data = scatter(collate(datas, samples_per_gpu=len(datas)), [self.device])[0]
+        with torch.no_grad():
+            result = self.model(return_loss=False, rescale=True, **data)
+        # mmdet 2.x returns the results of all images, mmdet 1.x the result of a single image
+        return result if self.multi_image else [result]
+
+    def forward_shared_feat(self, datas):
+        # mmdet 1.x: simple_test of each image on its slice of the features of the whole batch
+        data = scatter(collate(datas, samples_per_gpu=len(datas)), [self.device])[0]
+        img, img_meta = data['img'][0], data['img_meta'][0]
+        results = []
+        with torch.no_grad():
+            feats = self.model.extract_feat(img)
+            for i in range(len(datas)):
+                model = SharedFeatDetector(self.model, tuple(x[i:i + 1] for x in feats))
+                results.append(type(self.model).simple_test(model, img[i:i + 1], [img_meta[i]], rescale=True))
+        return results
+
+    def forward_batch(self, datas):
+        if len(datas) == 1 or self.multi_image:
+            return self.forward(datas)
+        return self.forward_shared_feat(datas)
+
+    def __call__(self, imgs):
+        """Inference a list of images.
+
+        Args:
+            imgs (list[str/ndarray]): Image files or loaded images.
+
+        Returns:
+            list: The detection result of each image, as returned by
+                inference_detector.
+        """
+        results = []
+        for i in range(0, len(imgs), self.batch_size):
+            datas = [self.test_pipeline(dict(img=img)) for img in imgs[i:i + self.batch_size]]
+            results += self.forward_batch(datas)
+        return results
+
+
 # TODO: merge this method with the one in BaseDetector
 def show_result(img,
                 result,
@@ -0,0 +1,104 @@
+import numpy as np
+import cv2
+import multiprocessing
+from fore_det.obj_det_with_motion import getFgParams, getMaskBboxes
+from fore_det.roi import frameScene
+
+bg_alpha = 0.05  # update rate of the running background
+bg_init_frames = 25  # the background of a video starts as the median of its first frames
+
+# dataset read by the worker processes of extractBgBboxes
+bg_dataset = None
+
+
+class BackgroundModel(object):
+    """Running background of a video in the blurred domain of getFgBboxes.
+
+    The background starts as the median of the first frames of the video and
+    is then updated by an exponential moving average.
+    """
+
+    def __init__(self, blurred_frames, alpha=bg_alpha):
+        self.alpha = alpha
+        self.background = np.median(np.array(blurred_frames), axis=0).astype(np.float32)
+
+    def update(self, blurred):
+        cv2.accumulateWeighted(blurred, self.background, self.alpha)
+
+
+def getBgBboxes(blurred, bg_model, dataset_name, roi=None):
+    # bboxes of the regions differing from the background, with the binary, area and extend thresholds of getFgBboxes
+    area_thr, binary_thr, extend, _ = getFgParams(dataset_name)
+    grad = cv2.absdiff(blurred, cv2.convertScaleAbs(bg_model.background))
+    grad = cv2.threshold(grad, binary_thr, 255, cv2.THRESH_BINARY)[1]
+    if roi is not None:
+        grad = roi.maskGrad(grad)
+    return getMaskBboxes(grad, None, area_thr, extend).reshape(-1, 4).astype(np.float32)
+
+
+def getVideoBgBboxes(dataset, start, length, dataset_name, roi=None):
+    '''
+    Background bboxes of the frames start, ..., start + length - 1 of a dataset, which form one video
+    :param roi: SceneROI of the video, None for the whole frame
+    '''
+    gauss_mask_size = getFgParams(dataset_name)[3]
+
+    def blur(idx):
+        return cv2.GaussianBlur(dataset.get_frame(idx), (gauss_mask_size, gauss_mask_size), 0)
+
+    if length == 0:
+        return list()
+    init_frames = [blur(start + i) for i in range(min(bg_init_frames, length))]
+    bg_model = BackgroundModel(init_frames)
+    all_bboxes = list()
+    for i in range(length):
+        blurred = init_frames[i] if i < len(init_frames) else blur(start + i)
+        all_bboxes.append(getBgBboxes(blurred, bg_model, dataset_name, roi=roi))
+        bg_model.update(blurred)
+    return all_bboxes
+
+
+def initBgWorker(dataset):
+    global bg_dataset
+    bg_dataset = dataset
+    # frames are read once, a frame cache would only hold frames that are never read again
+    bg_dataset.cache = None
+    cv2.setNumThreads(1)
+
+
+def getVideoBgBboxesWorker(args):
+    start, length, dataset_name, roi = args
+    return getVideoBgBboxes(bg_dataset, start, length, dataset_name, roi=roi)
+
+
+def extractBgBboxes(dataset, dataset_name, num_workers=0, rois=None):
+    '''
+    Foreground bboxes of all frames of a dataset by per-video background models, without the object detector
+    :param dataset: dataset of raw frames
+    :param num_workers: number of processes, each processing whole videos, 0 to run in the main process
+    :param rois: per-scene SceneROI as returned by loadRoi
+    :return: list of bbox arrays in frame order
+    '''
+    tasks = list()
+    start = 0
+    for video_name, cont in dataset.videos.items():
+        roi = rois.get(frameScene(dataset, start)) if rois and cont['length'] > 0 else None
+        tasks.append((start, cont['length'], dataset_name, roi))
+        start += cont['length']
+
+    all_bboxes = list()
+    if num_workers <= 0:
+        for video_idx, task in enumerate(tasks):
+            print('Extracting background bboxes of {}-th video, {} in total'.format(video_idx + 1, len(tasks)))
+            all_bboxes += getVideoBgBboxes(dataset, *task)
+        return all_bboxes
+    pool = multiprocessing.Pool(num_workers, initializer=initBgWorker, initargs=(dataset,))
+    try:
+        # results are returned in video order
+        for video_idx, video_bboxes in enumerate(pool.imap(getVideoBgBboxesWorker, tasks)):
+            print('Extracting background bboxes of {}-th video, {} in total'.format(video_idx + 1, len(tasks)))
+            all_bboxes += video_bboxes
+    finally:
+        pool.terminate()
+        pool.join()
+    return all_bboxes
@@ -2,6 +2,7 @@ import mmcv
 from mmcv.image import imread, imwrite
 import cv2
 from fore_det.inference import inference_detector, init_detector, show_result
+from fore_det.det_cache import detectFrames
 import numpy as np
 from sklearn import preprocessing
 import os
@@ -9,11 +10,20 @@ from torch.utils.data import Dataset, DataLoader
 from vad_datasets import ped_dataset, avenue_dataset, shanghaiTech_dataset
 from configparser import ConfigParser
 import time
+from collections import OrderedDict
 
 cp = ConfigParser()
 cp.read("config.cfg")
 
 def getObBboxes(img, model, dataset_name):
+    result = inference_detector(model, img)
+    return filterObBboxes(result, dataset_name)
+
+def getObBboxesBatch(imgs, session, dataset_name, det_cache=None, addrs=None):
+    # detection of a list of frames with a DetectorSession, frames found in det_cache are not forwarded
+    return [filterObBboxes(dets, dataset_name) for dets in detectFrames(imgs, session, det_cache=det_cache, addrs=addrs)]
+
+def filterObBboxes(result, dataset_name):
     if dataset_name == 'UCSDped2':
         score_thr = 0.5
         min_area_thr = 10 * 10
@@ -26,11 +36,10 @@ def getObBboxes(img, model, dataset_name):
     else:
         raise NotImplementedError
     
-    result = inference_detector(model, img)
-    
     #bboxes = show_result(img, result, model.CLASSES, score_thr)
     bbox_result = result
-    bboxes = np.vstack(bbox_result)
+    # per-class results of the detector or (M, 6) detections of DetectionCache, whose class column is dropped
+    bboxes = np.vstack(bbox_result)[:, :5]
     
     scores = bboxes[:, -1]
     inds = scores > score_thr
@@ -44,7 +53,7 @@ def getObBboxes(img, model, dataset_name):
     
     return bboxes[bbox_areas >= min_area_thr, :4]
 
-def delCoverBboxes(bboxes, dataset_name):
+def delCoverBboxes(bboxes, dataset_name, tile_size=64):
     if dataset_name == 'UCSDped2':
         cover_thr = 0.6
     elif dataset_name == 'avenue':
@@ -64,25 +73,31 @@ def delCoverBboxes(bboxes, dataset_name):
     bbox_areas = (y2-y1+1) * (x2-x1+1)
 
     sort_idx = bbox_areas.argsort()#Index of bboxes sorted in ascending order by area size
-    
-    keep_idx = []
-    for i in range(sort_idx.size):
+    x1, y1, x2, y2, bbox_areas = x1[sort_idx], y1[sort_idx], x2[sort_idx], y2[sort_idx], bbox_areas[sort_idx]
+
+    # a bbox is deleted if it is covered by any larger bbox (later in the sorted order),
+    # the pairwise ratios are computed for tile_size bboxes at a time to bound the memory of crowded frames
+    keep = np.ones(sort_idx.size, dtype=bool)
+    for start in range(0, sort_idx.size, tile_size):
+        rows = slice(start, start + tile_size)
+        cols = slice(start + 1, None)
         #Calculate the point coordinates of the intersection
-        x11 = np.maximum(x1[sort_idx[i]], x1[sort_idx[i+1:]]) 
-        y11 = np.maximum(y1[sort_idx[i]], y1[sort_idx[i+1:]])
-        x22 = np.minimum(x2[sort_idx[i]], x2[sort_idx[i+1:]])
-        y22 = np.minimum(y2[sort_idx[i]], y2[sort_idx[i+1:]])
+        x11 = np.maximum(x1[rows, np.newaxis], x1[np.newaxis, cols])
+        y11 = np.maximum(y1[rows, np.newaxis], y1[np.newaxis, cols])
+        x22 = np.minimum(x2[rows, np.newaxis], x2[np.newaxis, cols])
+        y22 = np.minimum(y2[rows, np.newaxis], y2[np.newaxis, cols])
         #Calculate the intersection area
-        w = np.maximum(0, x22-x11+1)    
-        h = np.maximum(0, y22-y11+1)  
+        w = np.maximum(0, x22-x11+1)
+        h = np.maximum(0, y22-y11+1)
         overlaps = w * h
-        
-        ratios = overlaps / bbox_areas[sort_idx[i]]
-        num = ratios[ratios > cover_thr]
-        if num.size == 0:  
-            keep_idx.append(sort_idx[i])
-            
-    return bboxes[keep_idx]
+
+        ratios = overlaps / bbox_areas[rows, np.newaxis]
+        # only bboxes after the current one in the sorted order are compared
+        row_idx = np.arange(start, start + ratios.shape[0])
+        later = np.arange(start + 1, start + 1 + ratios.shape[1])[np.newaxis, :] > row_idx[:, np.newaxis]
+        keep[rows] = ~np.any((ratios > cover_thr) & later, axis=1)
+
+    return bboxes[sort_idx[keep]]
         
         
 
@@ -125,36 +140,82 @@ def imshow_bboxes(img,
         imwrite(img, out_file)
 
         
-def getFgBboxes(cur_img, img_batch, bboxes, dataset_name, verbose=False):
+class MotionDiffCache(object):
+    """Blurred frames and absdiffs of adjacent frames kept in a ring buffer keyed by frame index.
+
+    In a sequential pass over the frames, every frame is blurred once and
+    every adjacent pair is differenced once, instead of once per window.
+
+    Args:
+        capacity (int): Number of blurred frames and of diffs kept.
+    """
+
+    def __init__(self, capacity=8):
+        self.capacity = capacity
+        self.blurred = OrderedDict()
+        self.diffs = OrderedDict()
+
+    def put(self, buffer, key, value):
+        # cached arrays are shared by the windows, so they must never be modified in place
+        value.flags.writeable = False
+        buffer[key] = value
+        while len(buffer) > self.capacity:
+            buffer.popitem(last=False)
+        return value
+
+    def blur(self, frame_idx, img, gauss_mask_size):
+        key = (frame_idx, gauss_mask_size)
+        if key not in self.blurred:
+            return self.put(self.blurred, key, cv2.GaussianBlur(img, (gauss_mask_size, gauss_mask_size), 0))
+        return self.blurred[key]
+
+    def diff(self, frame_idx1, img1, frame_idx2, img2, gauss_mask_size):
+        key = (frame_idx1, frame_idx2, gauss_mask_size)
+        if key not in self.diffs:
+            grad = cv2.absdiff(self.blur(frame_idx1, img1, gauss_mask_size), self.blur(frame_idx2, img2, gauss_mask_size))
+            return self.put(self.diffs, key, grad)
+        return self.diffs[key]
+
+    def sumGrad(self, frame_range, img_batch, gauss_mask_size):
+        # same accumulation as getFgBboxes, including the uint8 wrap-around of the sum
+        sum_grad = 0
+        for i in range(img_batch.shape[0]-1):
+            grad = self.diff(int(frame_range[i]), img_batch[i], int(frame_range[i+1]), img_batch[i+1], gauss_mask_size)
+            sum_grad = grad + sum_grad
+        return sum_grad
+
+
+def getFgParams(dataset_name):
+    # area_thr, binary_thr, extend, gauss_mask_size of the motion bboxes
     if dataset_name == 'UCSDped2':
-        area_thr = 10 * 10
-        binary_thr = 18
-        extend = 2
-        gauss_mask_size = 3
+        return 10 * 10, 18, 2, 3
     elif dataset_name == 'avenue':
-        area_thr = 40 * 40
-        binary_thr = 18
-        extend = 2
-        gauss_mask_size = 5
+        return 40 * 40, 18, 2, 5
     elif dataset_name == 'ShanghaiTech':
-        area_thr = 8 * 8
-        binary_thr = 15
-        extend = 2
-        gauss_mask_size = 5
+        return 8 * 8, 15, 2, 5
     else:
         raise NotImplementedError
 
-    sum_grad = 0
-    for i in range(img_batch.shape[0]-1):
-        img1 = img_batch[i,:,:,:]
-        img2 = img_batch[i+1,:,:,:]
-        img1 = cv2.GaussianBlur(img1, (gauss_mask_size, gauss_mask_size), 0)
-        img2 = cv2.GaussianBlur(img2, (gauss_mask_size, gauss_mask_size), 0)
-        
-        grad = cv2.absdiff(img1, img2)
-        sum_grad = grad + sum_grad
+def getFgBboxes(cur_img, img_batch, bboxes, dataset_name, verbose=False, frame_range=None, motion_cache=None, roi=None):
+    area_thr, binary_thr, extend, gauss_mask_size = getFgParams(dataset_name)
+
+    if motion_cache is not None and frame_range is not None:
+        # blurred frames and diffs shared with the neighbouring windows
+        sum_grad = motion_cache.sumGrad(frame_range, img_batch, gauss_mask_size)
+    else:
+        sum_grad = 0
+        for i in range(img_batch.shape[0]-1):
+            img1 = img_batch[i,:,:,:]
+            img2 = img_batch[i+1,:,:,:]
+            img1 = cv2.GaussianBlur(img1, (gauss_mask_size, gauss_mask_size), 0)
+            img2 = cv2.GaussianBlur(img2, (gauss_mask_size, gauss_mask_size), 0)
+
+            grad = cv2.absdiff(img1, img2)
+            sum_grad = grad + sum_grad
 
     sum_grad = cv2.threshold(sum_grad, binary_thr, 255, cv2.THRESH_BINARY)[1]
+    if roi is not None:
+        sum_grad = roi.maskGrad(sum_grad)
     if verbose is True:
         cv2.imshow('grad', sum_grad)
         cv2.waitKey(0)
@@ -170,6 +231,10 @@ def getFgBboxes(cur_img, img_batch, bboxes, dataset_name, verbose=False):
         cv2.imshow('del_ob_bboxes', sum_grad)
         cv2.waitKey(0)
 
+    return getMaskBboxes(sum_grad, cur_img, area_thr, extend, verbose=verbose)
+
+def getMaskBboxes(sum_grad, cur_img, area_thr, extend, verbose=False):
+    # bboxes of the external contours of a binary (h, w, 3) motion mask, cur_img is only drawn on for visualization
     sum_grad = cv2.cvtColor(sum_grad, cv2.COLOR_BGR2GRAY)
     contours, hierarchy = cv2.findContours(sum_grad, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     fg_bboxes = []
@@ -183,7 +248,8 @@ def getFgBboxes(cur_img, img_batch, bboxes, dataset_name, verbose=False):
             extend_x2 = np.minimum(x+w+extend, sum_grad.shape[1])
             extend_y2 = np.minimum(y+h+extend, sum_grad.shape[0])
             fg_bboxes.append([extend_x1, extend_y1, extend_x2, extend_y2])
-            cur_img = cv2.rectangle(cur_img, (extend_x1,extend_y1), (extend_x2,extend_y2), (0,255,0), 1)
+            if cur_img is not None:
+                cur_img = cv2.rectangle(cur_img, (extend_x1,extend_y1), (extend_x2,extend_y2), (0,255,0), 1)
 
     if verbose is True:
         cv2.imshow('all_fg_bboxes', sum_grad)
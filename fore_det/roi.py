@@ -0,0 +1,80 @@
+import os
+import json
+import numpy as np
+import cv2
+
+
+def roiPath(dataset_dir):
+    # {scene: [polygon, ...]}, polygons are lists of [x, y] points in frame coordinates
+    return os.path.join(dataset_dir, 'roi.json')
+
+
+def frameScene(dataset, idx):
+    # ShanghaiTech frames belong to the scene of their video name, the other datasets have a single scene
+    save_scene_idx = getattr(dataset, 'save_scene_idx', None)
+    if save_scene_idx:
+        return '{:02d}'.format(save_scene_idx[idx])
+    return '01'
+
+
+class SceneROI(object):
+    """Region of interest of a scene, the union of polygons.
+
+    Args:
+        polygons (list): Polygons as lists of [x, y] points.
+    """
+
+    def __init__(self, polygons):
+        self.polygons = [np.round(np.array(x, dtype=np.float64)).astype(np.int32).reshape(-1, 2) for x in polygons]
+        self.shape = None
+        self.mask = None
+        self.rect = None
+
+    def rasterize(self, shape):
+        # the mask and its bounding rectangle (x1, y1, x2, y2), x2 and y2 exclusive, of frames of shape (h, w)
+        shape = tuple(shape)
+        if self.shape != shape:
+            self.shape = shape
+            self.mask = np.zeros(shape, dtype=np.uint8)
+            cv2.fillPoly(self.mask, self.polygons, 1)
+            ys, xs = np.nonzero(self.mask)
+            if len(xs) == 0:
+                self.rect = (0, 0, shape[1], shape[0])
+            else:
+                self.rect = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+        return self.mask, self.rect
+
+    def cropFrame(self, img):
+        # the detector input and the offset of its bboxes
+        _, (x1, y1, x2, y2) = self.rasterize(img.shape[:2])
+        return img[y1:y2, x1:x2], (x1, y1)
+
+    def maskGrad(self, grad):
+        # motion outside the region is ignored, grad is (h, w) or (h, w, c)
+        mask, _ = self.rasterize(grad.shape[:2])
+        if grad.ndim == 3:
+            mask = mask[:, :, np.newaxis]
+        return grad * mask
+
+
+def loadRoi(dataset_dir, frame_shape=None):
+    '''
+    Per-scene ROIs of a dataset, an empty dict if the dataset has no roi.json
+    :param frame_shape: (h, w) of the frames, to rasterize the ROIs before any frame is read
+    '''
+    path = roiPath(dataset_dir)
+    if not os.path.exists(path):
+        return dict()
+    with open(path) as f:
+        rois = {scene: SceneROI(polygons) for scene, polygons in json.load(f).items()}
+    if frame_shape is not None:
+        for roi in rois.values():
+            roi.rasterize(frame_shape)
+    return rois
+
+
+def translateBboxes(bboxes, offset):
+    # bboxes of a cropped frame back to full-frame coordinates
+    if offset == (0, 0):
+        return bboxes
+    return bboxes + np.array([offset[0], offset[1], offset[0], offset[1]], dtype=bboxes.dtype)
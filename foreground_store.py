@@ -0,0 +1,384 @@
+import os
+import json
+import shutil
+import queue
+import threading
+import numpy as np
+
+# cubes are stored as uint8 raw frames and float16 optical flow
+modality_dtypes = {'raw': np.uint8, 'flow': np.float16}
+
+def block_name(block):
+    return '{}_{}_{}'.format(*block)
+
+def block_path(store_dir, block):
+    # crop table rows of the cubes of a block
+    return os.path.join(store_dir, '{}_rows.bin'.format(block_name(block)))
+
+def crop_path(store_dir, column):
+    return os.path.join(store_dir, 'crops_{}.bin'.format(column))
+
+def calc_block_idx(bboxes, h_step, w_step, mode):
+    '''
+    Blocks of all bboxes of a frame at once: the block of the bbox center and, for mode > 1, the blocks of the points
+    halfway between the center and the middles of the bbox edges, for mode >= 9 also halfway to the bbox corners
+    :param bboxes: (N, 4) array of [x_min, y_min, x_max, y_max]
+    :param mode: 1, 5 or 9 points per bbox, train_block_mode/test_block_mode of config.cfg
+    :return: (M, 3) int64 array of the unique (bbox_idx, h_block_idx, w_block_idx), sorted
+    '''
+    bboxes = np.asarray(bboxes).reshape(-1, 4)
+    x_min, y_min, x_max, y_max = bboxes[:, 0:1], bboxes[:, 1:2], bboxes[:, 2:3], bboxes[:, 3:4]
+    center_y, center_x = (y_min + y_max) / 2, (x_min + x_max) / 2
+    ys, xs = [center_y], [center_x]
+    if mode > 1:
+        ys += [y_min, y_max, center_y, center_y]
+        xs += [center_x, center_x, x_min, x_max]
+    if mode >= 9:
+        ys += [y_min, y_max, y_max, y_min]
+        xs += [x_min, x_max, x_min, x_max]
+    # computed in the dtype of the bboxes and truncated, as the per-bbox version did
+    h_block_idxes = ((np.concatenate(ys, axis=1) + center_y) / 2 / h_step).astype(np.int64)
+    w_block_idxes = ((np.concatenate(xs, axis=1) + center_x) / 2 / w_step).astype(np.int64)
+    bbox_idxes = np.repeat(np.arange(len(bboxes)), h_block_idxes.shape[1])
+    return np.unique(np.stack([bbox_idxes, h_block_idxes.ravel(), w_block_idxes.ravel()], axis=1), axis=0)
+
+class foreground_store_writer:
+    '''
+    Appends every foreground crop once to a crop table, one contiguous file per modality plus the frame id and bbox of
+    every crop, and the table row of the crop to the row list of each (scene, h_block, w_block) block it belongs to.
+    Every checkpoint_interval frames the files are synced and the number of frames done, of crops and of rows of every
+    block are appended to journal.jsonl. A writer created on the journal of an interrupted run with the same meta
+    truncates the files to the last checkpoint, rows written after it are discarded, and continues with the frames of
+    the saved order that are not done yet.
+    '''
+    def __init__(self, store_dir, modalities, order, meta=None, buffer_size=256, checkpoint_interval=500):
+        '''
+        :param modalities: names of the stored modalities, see modality_dtypes
+        :param order: frame indices in the order they are extracted, replaced by the order of the resumed run
+        :param meta: settings of the extraction, a journal written with other settings is not resumed
+        :param buffer_size: crops kept in memory before they are written
+        :param checkpoint_interval: frames between two checkpoints
+        '''
+        self.store_dir = store_dir
+        self.modalities = modalities
+        self.buffer_size = buffer_size
+        self.checkpoint_interval = checkpoint_interval
+        self.header = {'modalities': modalities, 'frame_num': len(order), 'meta': meta}
+        self.shapes = dict()
+        self.crops = {column: list() for column in self.columns()}
+        self.crop_num = 0
+        self.buffers = dict()
+        self.counts = dict()
+        # number of frames of self.order that are done
+        self.done = 0
+        if not self.resume():
+            if os.path.exists(store_dir):
+                shutil.rmtree(store_dir)
+            os.makedirs(store_dir)
+            self.order = np.asarray(order, dtype=np.int64)
+            np.save(os.path.join(store_dir, 'order.npy'), self.order)
+            with open(self.journal_path(), 'w') as f:
+                f.write(json.dumps(self.header) + '\n')
+
+    def columns(self):
+        return self.modalities + ['frames', 'bboxes']
+
+    def journal_path(self):
+        return os.path.join(self.store_dir, 'journal.jsonl')
+
+    def row_bytes(self, column):
+        if column == 'frames':
+            return 8
+        if column == 'bboxes':
+            return 16
+        return int(np.prod(self.shapes[column])) * np.dtype(modality_dtypes[column]).itemsize
+
+    def resume(self):
+        '''
+        Restore the last checkpoint of an interrupted run, False if there is none to resume
+        '''
+        if not os.path.exists(self.journal_path()) or not os.path.exists(os.path.join(self.store_dir, 'order.npy')):
+            return False
+        with open(self.journal_path()) as f:
+            lines = f.read().split('\n')
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            return False
+        if header != json.loads(json.dumps(self.header)):
+            return False
+        checkpoint = {'done': 0, 'shapes': {}, 'crops': 0, 'blocks': []}
+        # the last line is incomplete if the run stopped while writing it
+        for line in lines[1:]:
+            try:
+                checkpoint = json.loads(line)
+            except ValueError:
+                break
+        self.order = np.load(os.path.join(self.store_dir, 'order.npy'))
+        self.shapes = checkpoint['shapes']
+        self.crop_num = checkpoint['crops']
+        self.counts = {tuple(block): count for block, count in checkpoint['blocks']}
+        sizes = [(crop_path(self.store_dir, column), self.crop_num * self.row_bytes(column)) for column in self.columns()] if self.crop_num > 0 else []
+        sizes += [(block_path(self.store_dir, block), count * 8) for block, count in self.counts.items()]
+        files = set(x for x in os.listdir(self.store_dir) if x.endswith('.bin'))
+        for path, size in sizes:
+            if not os.path.exists(path) or os.path.getsize(path) < size:
+                # rows of the checkpoint are missing, the files cannot be trusted
+                return False
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+            files.discard(os.path.basename(path))
+        # files first written after the checkpoint
+        for name in files:
+            os.remove(os.path.join(self.store_dir, name))
+        self.buffers = {block: list() for block in self.counts}
+        self.done = checkpoint['done']
+        return True
+
+    def append(self, blocks, frame_id, bbox, cubes):
+        '''
+        :param blocks: the (scene, h_block, w_block) blocks of the crop
+        :param cubes: dict of the cube of each modality
+        '''
+        for modality in self.modalities:
+            cube = np.asarray(cubes[modality], dtype=modality_dtypes[modality])
+            self.shapes.setdefault(modality, list(cube.shape))
+            self.crops[modality].append(cube)
+        self.crops['frames'].append(np.int64(frame_id))
+        self.crops['bboxes'].append(np.asarray(bbox, dtype=np.float32).reshape(4))
+        for block in blocks:
+            block = tuple(int(x) for x in block)
+            if block not in self.buffers:
+                self.buffers[block] = list()
+                self.counts[block] = 0
+            self.buffers[block].append(np.int64(self.crop_num))
+            self.counts[block] += 1
+        self.crop_num += 1
+        if len(self.crops['frames']) >= self.buffer_size:
+            self.flush()
+
+    def flush(self, sync=False):
+        def write(path, values):
+            with open(path, 'ab') as f:
+                f.write(np.ascontiguousarray(np.stack(values)).tobytes())
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            del values[:]
+
+        if len(self.crops['frames']) > 0:
+            for column, values in self.crops.items():
+                write(crop_path(self.store_dir, column), values)
+        for block, rows in self.buffers.items():
+            if len(rows) > 0:
+                write(block_path(self.store_dir, block), rows)
+
+    def frame_done(self):
+        # called after all cubes of the next frame of self.order are appended
+        self.done += 1
+        if self.done % self.checkpoint_interval == 0:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.flush(sync=True)
+        # the journal entry is written after the rows it counts are on disk
+        with open(self.journal_path(), 'a') as f:
+            f.write(json.dumps({'done': self.done, 'shapes': self.shapes, 'crops': self.crop_num,
+                                'blocks': [[list(block), self.counts[block]] for block in sorted(self.counts)]}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self, **attrs):
+        '''
+        :param attrs: saved with the index, e.g. the number of frames
+        '''
+        self.flush(sync=True)
+        index = {'modalities': self.modalities, 'shapes': self.shapes, 'attrs': attrs, 'crops': self.crop_num,
+                 'blocks': [[list(block), self.counts[block]] for block in sorted(self.counts)]}
+        # the index is written last, a store without index is resumed from its journal
+        with open(os.path.join(self.store_dir, 'index.json'), 'w') as f:
+            json.dump(index, f)
+        os.remove(self.journal_path())
+        os.remove(os.path.join(self.store_dir, 'order.npy'))
+
+class foreground_store:
+    '''
+    Memory-mapped reader of a store written by foreground_store_writer. The cubes of a block are gathered from the
+    crop table by the rows of the block, a crop shared by several blocks is stored once.
+    '''
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.modalities = index['modalities']
+        self.shapes = {modality: tuple(shape) for modality, shape in index['shapes'].items()}
+        self.attrs = index['attrs']
+        self.crop_num = index['crops']
+        self.counts = {tuple(block): count for block, count in index['blocks']}
+        # files are opened once
+        self.files = dict()
+
+    @staticmethod
+    def exists(store_dir):
+        return os.path.exists(os.path.join(store_dir, 'index.json'))
+
+    def __len__(self):
+        return self.crop_num
+
+    def blocks(self):
+        return sorted(self.counts)
+
+    def count(self, block):
+        return self.counts.get(tuple(block), 0)
+
+    def read(self, path, count, dtype, shape):
+        if count == 0:
+            return np.zeros((0,) + shape, dtype=dtype)
+        if path not in self.files:
+            self.files[path] = np.memmap(path, dtype=dtype, mode='r', shape=(count,) + shape)
+        return self.files[path]
+
+    def crops(self, column):
+        # the crop table of a modality, 'frames' or 'bboxes'
+        if column == 'frames':
+            return self.read(crop_path(self.store_dir, column), self.crop_num, np.int64, ())
+        if column == 'bboxes':
+            return self.read(crop_path(self.store_dir, column), self.crop_num, np.float32, (4,))
+        return self.read(crop_path(self.store_dir, column), self.crop_num, modality_dtypes[column], self.shapes.get(column, ()))
+
+    def rows(self, block):
+        return self.read(block_path(self.store_dir, tuple(block)), self.count(block), np.int64, ())
+
+    def cubes(self, block, modality):
+        return self.crops(modality)[self.rows(block)]
+
+    def frame_ids(self, block):
+        return self.crops('frames')[self.rows(block)]
+
+    def bboxes(self, block):
+        return self.crops('bboxes')[self.rows(block)]
+
+class sorted_file_cursor:
+    '''
+    Forward-only search in a file of sorted int64 values, e.g. the frame ids of the crop table or the rows of a block,
+    read chunk_size values at a time
+    '''
+    def __init__(self, path, count, chunk_size=4096):
+        self.path = path
+        self.count = count
+        self.chunk_size = chunk_size
+        self.chunk_start = 0
+        self.chunk = np.zeros(0, dtype=np.int64)
+        self.pos = 0
+
+    def seek(self, value):
+        '''
+        :return: position of the first value >= value, value must not be smaller than in the previous call
+        '''
+        while True:
+            i = self.pos - self.chunk_start
+            i += np.searchsorted(self.chunk[i:], value)
+            if i < len(self.chunk) or self.chunk_start + len(self.chunk) >= self.count:
+                self.pos = self.chunk_start + i
+                return self.pos
+            self.chunk_start += len(self.chunk)
+            self.pos = self.chunk_start
+            self.chunk = self.values(self.chunk_start, min(self.chunk_start + self.chunk_size, self.count))
+
+    def values(self, start, end):
+        return np.fromfile(self.path, dtype=np.int64, count=end - start, offset=start * np.dtype(np.int64).itemsize)
+
+class foreground_frame_reader:
+    '''
+    Frame-ordered reader of a store whose crops were written in increasing frame order, as by test.py. The crops of a
+    frame are a contiguous range of the crop table and are read with plain file reads by a read-ahead thread, at most
+    read_ahead frames wait in memory, so the memory of a pass does not grow with the length of the dataset. The frame
+    ids of the crops and the rows of the blocks are not loaded either, a pass reads them in chunks through
+    sorted_file_cursor and read_frame finds the range of a frame by binary search in their memory maps.
+    '''
+    def __init__(self, store, read_ahead=8):
+        self.store = store
+        self.read_ahead = read_ahead
+
+    def __len__(self):
+        return self.store.attrs['frame_num']
+
+    def read_rows(self, column, start, end):
+        shape = (4,) if column == 'bboxes' else self.store.shapes[column]
+        dtype = np.float32 if column == 'bboxes' else modality_dtypes[column]
+        row_size = int(np.prod(shape))
+        values = np.fromfile(crop_path(self.store.store_dir, column), dtype=dtype, count=(end - start) * row_size,
+                             offset=start * row_size * np.dtype(dtype).itemsize)
+        return values.reshape((end - start,) + tuple(shape))
+
+    def gather(self, start, end, block_rows):
+        # (cubes of each modality, bboxes) of the blocks from crops [start, end) and the rows of each block among them
+        frame_blocks = dict()
+        if start == end:
+            return frame_blocks
+        columns = [self.read_rows(column, start, end) for column in self.store.modalities + ['bboxes']]
+        for block, rows in block_rows.items():
+            if len(rows) > 0:
+                frame_blocks[block] = tuple(x[rows - start] for x in columns)
+        return frame_blocks
+
+    def read_frame(self, frame_idx):
+        '''
+        :return: dict of (cubes of each modality, bboxes) of the blocks with crops of the frame
+        '''
+        frame_ids = self.store.crops('frames')
+        start, end = np.searchsorted(frame_ids, frame_idx, side='left'), np.searchsorted(frame_ids, frame_idx, side='right')
+        block_rows = dict()
+        for block in self.store.blocks():
+            rows = self.store.rows(block)
+            block_rows[block] = np.asarray(rows[np.searchsorted(rows, start):np.searchsorted(rows, end)])
+        return self.gather(start, end, block_rows)
+
+    def read_frames(self):
+        # read_frame of every frame in order, the cursors only move forward
+        frames = sorted_file_cursor(crop_path(self.store.store_dir, 'frames'), len(self.store))
+        blocks = {block: sorted_file_cursor(block_path(self.store.store_dir, block), self.store.count(block))
+                  for block in self.store.blocks()}
+        for frame_idx in range(self.__len__()):
+            start, end = frames.seek(frame_idx), frames.seek(frame_idx + 1)
+            block_rows = dict()
+            for block, rows in blocks.items():
+                block_rows[block] = rows.values(rows.seek(start), rows.seek(end))
+            yield frame_idx, self.gather(start, end, block_rows)
+
+    def __iter__(self):
+        '''
+        (frame_idx, frame_blocks) of every frame in order, see read_frame
+        '''
+        frames = queue.Queue(maxsize=self.read_ahead)
+        stop = threading.Event()
+
+        def put(item):
+            # gives up when the consumer stopped iterating
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read_ahead():
+            try:
+                for item in self.read_frames():
+                    if not put(item):
+                        return
+            except Exception as e:
+                put(e)
+
+        reader = threading.Thread(target=read_ahead, daemon=True)
+        reader.start()
+        try:
+            for _ in range(self.__len__()):
+                item = frames.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            reader.join()
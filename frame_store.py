@@ -0,0 +1,221 @@
+import os
+import json
+import cv2
+import numpy as np
+from collections import OrderedDict
+
+manifest_name = 'manifest.json'
+
+def packed_store_dir(dataset_dir, mode):
+    # packed frames are stored alongside the frames they are converted from
+    return os.path.join(dataset_dir, 'packed', mode)
+
+def encode_frame(frame, dtype, scale=None):
+    if scale is not None:
+        # scaled integers, e.g. optical flow stored as int16 with a resolution of scale pixels
+        info = np.iinfo(dtype)
+        return np.clip(np.round(frame / scale), info.min, info.max).astype(dtype)
+    return frame.astype(dtype)
+
+def pack_frames(dataset, store_dir, dtype=np.uint8, scale=None):
+    '''
+    Pack the frames of each video of a dataset into one contiguous (T, H, W, C) array file and describe them in a json manifest
+    :param dataset: ped_dataset/avenue_dataset/shanghaiTech_dataset reading frames from files, frames are packed in the order of dataset.videos
+    :param store_dir: directory of the packed store
+    :param dtype: uint8 for raw frames, float16 or int16 (with scale) for optical flow
+    :param scale: quantization step of integer dtypes for optical flow, None to store values as they are
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    manifest = {'dtype': np.dtype(dtype).name, 'scale': scale, 'videos': list()}
+    offset = 0
+    for video_name, cont in dataset.videos.items():
+        print('Packing {} frames of video {}'.format(cont['length'], video_name))
+        file_name = video_name + '.npy'
+        if cont['length'] > 0:
+            frame = dataset.get_frame(offset)
+            video = np.lib.format.open_memmap(os.path.join(store_dir, file_name), mode='w+', dtype=dtype, shape=(cont['length'],) + frame.shape)
+            for i in range(cont['length']):
+                video[i] = encode_frame(dataset.get_frame(offset + i), dtype, scale)
+            video.flush()
+            shape = list(frame.shape)
+            del video
+        else:
+            shape = list()
+        manifest['videos'].append({'name': video_name, 'file': file_name, 'length': cont['length'], 'shape': shape,
+                                   'frames': [os.path.basename(x) for x in cont['frame']]})
+        offset += cont['length']
+    # the manifest is written last, an interrupted conversion leaves no usable store behind
+    with open(os.path.join(store_dir, manifest_name), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+class packed_frame_store:
+    '''
+    Frames of a packed store served as np.memmap views, indexed by the global frame index of the dataset.
+    Compact optical flow (float16 or scaled int16) is decoded to float32 on access.
+    '''
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, manifest_name)) as f:
+            manifest = json.load(f)
+        self.dtype = np.dtype(manifest['dtype'])
+        self.scale = manifest.get('scale')
+        self.videos = manifest['videos']
+        self.video_offsets = np.cumsum([0] + [x['length'] for x in self.videos])
+        self.arrays = None
+
+    def __len__(self):
+        return int(self.video_offsets[-1])
+
+    def __getstate__(self):
+        # memmaps are reopened in worker processes instead of being pickled with their content
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def open(self):
+        self.arrays = [np.load(os.path.join(self.store_dir, x['file']), mmap_mode='r') if x['length'] > 0 else None for x in self.videos]
+
+    def locate(self, indice):
+        video_idx = np.searchsorted(self.video_offsets, indice, side='right') - 1
+        return video_idx, indice - self.video_offsets[video_idx]
+
+    def decode(self, frames):
+        if self.scale is not None:
+            return frames.astype(np.float32) * np.float32(self.scale)
+        elif self.dtype == np.float16:
+            # sums of squared flow overflow float16, so flow is always served as float32
+            return frames.astype(np.float32)
+        return frames
+
+    def __getitem__(self, indice):
+        if self.arrays is None:
+            self.open()
+        video_idx, frame_idx = self.locate(indice)
+        return self.decode(self.arrays[video_idx][frame_idx])
+
+    def get_window(self, frame_range):
+        '''
+        Frames of a context window as a (T, H, W, C) array, gathered from one video file when possible
+        '''
+        if self.arrays is None:
+            self.open()
+        frame_range = np.asarray(frame_range)
+        video_idx, frame_idx = self.locate(frame_range)
+        if (video_idx == video_idx[0]).all():
+            return self.decode(self.arrays[video_idx[0]][frame_idx])
+        return self.decode(np.array([self.arrays[v][f] for v, f in zip(video_idx, frame_idx)]))
+
+video_formats = ['.avi', '.mp4', '.mkv', '.mov']
+
+def video_index_path(video_addr):
+    return video_addr + '.index.json'
+
+def load_video_index(video_addr):
+    '''
+    Frame index of a video file, built by decoding the video once and persisted next to it
+    :return: dict with the exact frame number and the frame shape
+    '''
+    stat = os.stat(video_addr)
+    index_path = video_index_path(video_addr)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime_ns:
+            return index
+    cap = cv2.VideoCapture(video_addr)
+    if not cap.isOpened():
+        raise IOError('cannot open video {}'.format(video_addr))
+    # the frame count reported by the container is not reliable, so frames are counted by grabbing them
+    length = 0
+    shape = list()
+    while cap.grab():
+        if length == 0:
+            shape = list(cap.retrieve()[1].shape)
+        length += 1
+    cap.release()
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'length': length, 'shape': shape}
+    try:
+        with open(index_path, 'w') as f:
+            json.dump(index, f)
+    except OSError:
+        pass
+    return index
+
+class video_frame_store:
+    '''
+    Frames decoded directly from video files with cv2.VideoCapture, indexed by the global frame index of the dataset.
+    Frames are decoded forward from the current position of each video, seeking only for frames behind it or far ahead,
+    and the most recently decoded frames are kept so that overlapping context windows are decoded once.
+    '''
+    def __init__(self, video_addrs, lengths, buffer_size=64, max_skip=64, max_open=4):
+        '''
+        :param video_addrs: video files in the order of the dataset
+        :param lengths: number of frames of each video, see load_video_index
+        :param buffer_size: number of decoded frames kept
+        :param max_skip: frames ahead of the decoding position that are grabbed instead of seeked to
+        :param max_open: number of videos kept open
+        '''
+        self.video_addrs = video_addrs
+        self.video_offsets = np.cumsum([0] + list(lengths))
+        self.buffer_size = buffer_size
+        self.max_skip = max_skip
+        self.max_open = max_open
+        self.captures = OrderedDict()
+        self.buffer = OrderedDict()
+
+    def __len__(self):
+        return int(self.video_offsets[-1])
+
+    def __getstate__(self):
+        # captures cannot be pickled, worker processes open their own
+        state = self.__dict__.copy()
+        state['captures'] = OrderedDict()
+        state['buffer'] = OrderedDict()
+        return state
+
+    def locate(self, indice):
+        video_idx = np.searchsorted(self.video_offsets, indice, side='right') - 1
+        return video_idx, indice - self.video_offsets[video_idx]
+
+    def open(self, video_idx):
+        if video_idx in self.captures:
+            self.captures.move_to_end(video_idx)
+            return self.captures[video_idx]
+        cap = [cv2.VideoCapture(self.video_addrs[video_idx]), 0]
+        self.captures[video_idx] = cap
+        while len(self.captures) > self.max_open:
+            self.captures.popitem(last=False)[1][0].release()
+        return cap
+
+    def decode(self, video_idx, frame_idx):
+        cap = self.open(video_idx)
+        if frame_idx < cap[1] or frame_idx - cap[1] > self.max_skip:
+            cap[0].set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+            cap[1] = frame_idx
+        while cap[1] < frame_idx:
+            cap[0].grab()
+            cap[1] += 1
+        ok, frame = cap[0].read()
+        cap[1] += 1
+        if not ok:
+            raise IOError('cannot decode frame {} of {}'.format(frame_idx, self.video_addrs[video_idx]))
+        return frame
+
+    def __getitem__(self, indice):
+        key = tuple(int(x) for x in self.locate(indice))
+        if key in self.buffer:
+            self.buffer.move_to_end(key)
+            return self.buffer[key]
+        frame = self.decode(*key)
+        self.buffer[key] = frame
+        while len(self.buffer) > self.buffer_size:
+            self.buffer.popitem(last=False)
+        return frame
+
+    def get_window(self, frame_range):
+        '''
+        Frames of a context window as a (T, H, W, C) array, decoded in frame order
+        '''
+        frames = {x: self[x] for x in sorted(set(int(x) for x in frame_range))}
+        return np.array([frames[int(x)] for x in frame_range])
@@ -0,0 +1,93 @@
+import os
+import json
+import numpy as np
+
+def gt_store_dir(dataset_dir):
+    # the compact ground truth is stored alongside the ground truth it is converted from
+    return os.path.join(dataset_dir, 'gt_cache')
+
+def file_mtime(file_addr):
+    return os.stat(file_addr).st_mtime_ns
+
+class gt_store:
+    '''
+    Ground truth of the test frames, frame labels are kept as a bool vector and pixel masks are bit-packed in a
+    memory-mapped file, a mask is only unpacked when it is asked for
+    '''
+    def __init__(self, store_dir, mode, gt_addr, load_func, tot_frame_num):
+        '''
+        :param store_dir: directory of the compact ground truth, built from the gt files on first use
+        :param mode: prefix of the stored files, e.g. test
+        :param gt_addr: list of gt files in the order of the frames
+        :param load_func: reads a gt file into (T, H, W) pixel masks or (T,) frame labels
+        :param tot_frame_num: number of frames covered by the gt files
+        '''
+        self.store_dir = store_dir
+        self.info_path = os.path.join(store_dir, mode + '_gt.json')
+        self.labels_path = os.path.join(store_dir, mode + '_labels.npy')
+        self.masks_path = os.path.join(store_dir, mode + '_masks.npy')
+        sources = [[x, file_mtime(x)] for x in gt_addr]
+        info = None
+        if os.path.exists(self.info_path):
+            with open(self.info_path) as f:
+                info = json.load(f)
+        if info is None or info['sources'] != sources:
+            info = self.build(gt_addr, load_func, tot_frame_num)
+            info['sources'] = sources
+            # the info file is written last, an interrupted conversion is redone on the next run
+            with open(self.info_path, 'w') as f:
+                json.dump(info, f)
+        self.mask_shape = info['mask_shape']
+        self.labels = np.load(self.labels_path)
+        self.masks = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getstate__(self):
+        # the memmap is reopened in worker processes instead of being pickled with its content
+        state = self.__dict__.copy()
+        state['masks'] = None
+        return state
+
+    @property
+    def has_masks(self):
+        return self.mask_shape is not None
+
+    def build(self, gt_addr, load_func, tot_frame_num):
+        os.makedirs(self.store_dir, exist_ok=True)
+        labels = np.zeros(tot_frame_num, dtype=np.bool_)
+        masks = None
+        mask_shape = None
+        offset = 0
+        for addr in gt_addr:
+            gt = np.asarray(load_func(addr))
+            if gt.ndim == 1:
+                labels[offset:offset + len(gt)] = gt > 0
+            else:
+                flat = gt.reshape(len(gt), -1) > 0
+                if masks is None:
+                    mask_shape = list(gt.shape[1:])
+                    masks = np.lib.format.open_memmap(self.masks_path, mode='w+', dtype=np.uint8,
+                                                      shape=(tot_frame_num, (flat.shape[1] + 7) // 8))
+                labels[offset:offset + len(gt)] = flat.any(axis=1)
+                masks[offset:offset + len(gt)] = np.packbits(flat, axis=1)
+            offset += len(gt)
+        if offset != tot_frame_num:
+            raise ValueError('ground truth in {} covers {} frames, but there are {} frames'.format(self.store_dir, offset, tot_frame_num))
+        if masks is not None:
+            masks.flush()
+            del masks
+        np.save(self.labels_path, labels)
+        return {'mask_shape': mask_shape}
+
+    def label(self, indice):
+        return self.labels[indice]
+
+    def mask(self, indice):
+        if not self.has_masks:
+            raise NotImplementedError
+        if self.masks is None:
+            self.masks = np.load(self.masks_path, mmap_mode='r')
+        h, w = self.mask_shape
+        return np.unpackbits(self.masks[indice])[:h * w].reshape(h, w)
@@ -0,0 +1,25 @@
+import os
+import numpy as np
+from configparser import ConfigParser
+from vad_datasets import unified_dataset_interface
+from frame_store import pack_frames, packed_store_dir
+
+def pack_dataset(dataset_name, dataset_dir, mode, file_format=None, dtype=np.uint8, scale=None):
+    # frames are decoded once without the shared cache, which would only be filled with frames that are never read again
+    dataset = unified_dataset_interface(dataset_name=dataset_name, dir=dataset_dir, context_frame_num=0, mode=mode, border_mode='hard', file_format=file_format, cache=None)
+    store_dir = packed_store_dir(dataset.dir, mode)
+    pack_frames(dataset, store_dir, dtype=dtype, scale=scale)
+    print('{} frames of {} packed into {}'.format(dataset.tot_frame_num, dataset.dir, store_dir))
+
+
+if __name__ == '__main__':
+    # Pack raw frames and optical flow of the dataset in config.cfg,
+    # set frame_backend=packed and flow_backend=packed in config.cfg to train and test on the packed frames
+    cp = ConfigParser()
+    cp.read("config.cfg")
+    dataset_name = cp.get('shared_parameters', 'dataset_name')
+    raw_dataset_dir = cp.get('shared_parameters', 'raw_dataset_dir')
+    for mode in ['train', 'test']:
+        pack_dataset(dataset_name, os.path.join(raw_dataset_dir, dataset_name), mode)
+        # optical flow is packed as float16, use dtype=np.int16 and e.g. scale=1/64 for fixed-point flow
+        pack_dataset(dataset_name, os.path.join('optical_flow', dataset_name), mode, file_format='.npy', dtype=np.float16)
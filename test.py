@@ -4,7 +4,14 @@ import os
 from torch.utils.data import DataLoader
 from vad_datasets import unified_dataset_interface
 from fore_det.inference import init_detector
-from vad_datasets import bbox_collate, img_tensor2numpy, img_batch_tensor2numpy, frame_size, cube_to_train_dataset
+from fore_det.det_cache import DetectionCache, detectorKey
+from fore_det.bbox_extraction import extractBboxes
+from fore_det.bbox_shards import extractBboxesSharded
+from fore_det.det_scheduler import KeyframeScheduler, StaticFrameGate
+from fore_det.roi import loadRoi
+from bbox_store import save_bboxes, load_bboxes
+from foreground_store import foreground_store, foreground_store_writer, foreground_frame_reader, calc_block_idx
+from vad_datasets import bbox_collate, img_tensor2numpy, img_batch_tensor2numpy, frame_size, cube_block_dataset, shared_frame_cache, prefetch_loader
 from fore_det.obj_det_with_motion import imshow_bboxes, getObBboxes, getFgBboxes, delCoverBboxes
 from fore_det.simple_patch import get_patch_loc
 import cv2
@@ -15,30 +22,6 @@ from utils import save_roc_pr_curve_data
 from configparser import ConfigParser
 from helper.visualization_helper import visualize_pair, visualize_batch, visualize_pair_map
 
-def calc_block_idx(x_min, x_max, y_min, y_max, h_step, w_step, mode):
-    all_blocks = list()
-    center = np.array([(y_min+y_max)/2, (x_min+x_max)/2])
-    all_blocks.append(center + center)
-    if mode > 1:
-        all_blocks.append(np.array([y_min, center[1]]) + center)
-        all_blocks.append(np.array([y_max, center[1]]) + center)
-        all_blocks.append(np.array([center[0], x_min]) + center)
-        all_blocks.append(np.array([center[0], x_max]) + center)
-    if mode >= 9:
-        all_blocks.append(np.array([y_min, x_min]) + center)
-        all_blocks.append(np.array([y_max, x_max]) + center)
-        all_blocks.append(np.array([y_max, x_min]) + center)
-        all_blocks.append(np.array([y_min, x_max]) + center)
-    all_blocks = np.array(all_blocks) / 2
-    h_block_idxes = all_blocks[:, 0] / h_step
-    w_block_idxes = all_blocks[:, 1] / w_step
-    h_block_idxes, w_block_idxes = list(h_block_idxes.astype(np.int)), list(w_block_idxes.astype(np.int))
-    # delete repeated elements
-    all_blocks = set([x for x in zip(h_block_idxes, w_block_idxes)])
-    all_blocks = [x for x in all_blocks]
-    return all_blocks
-
-
 #  /*------------------------------------overall parameter setting------------------------------------------*/
 cp = ConfigParser()
 cp.read("config.cfg")
@@ -50,6 +33,16 @@ data_root_dir = cp.get('shared_parameters', 'data_root_dir')
 modality = cp.get('shared_parameters', 'modality') 
 mode = cp.get('test_parameters', 'mode')
 method = cp.get('shared_parameters', 'method')
+frame_cache_size = cp.getint('shared_parameters', 'frame_cache_size')
+frame_backend = cp.get('shared_parameters', 'frame_backend')
+flow_backend = cp.get('shared_parameters', 'flow_backend')
+num_workers = cp.getint('shared_parameters', 'num_workers')
+prefetch_depth = cp.getint('shared_parameters', 'prefetch_depth')
+det_batch_size = cp.getint('shared_parameters', 'det_batch_size')
+det_cache_path = cp.get('shared_parameters', 'det_cache')
+det_interval = cp.getint('shared_parameters', 'det_interval')
+det_motion_change_thr = cp.getfloat('shared_parameters', 'det_motion_change_thr')
+static_thr = cp.getfloat('shared_parameters', 'static_thr')
 try:
     patch_size = cp.getint(dataset_name, 'patch_size')
     h_block = cp.getint(dataset_name, 'h_block')
@@ -61,56 +54,56 @@ try:
 except:
     raise NotImplementedError
 
+shared_frame_cache.resize(frame_cache_size * 1024 ** 2)
+flow_frame_backend = 'packed' if flow_backend == 'packed' else 'file'
+
 #  /*------------------------------------------foreground extraction----------------------------------------------*/
 config_file = './obj_det_config/cascade_rcnn_r101_fpn_1x.py'
 checkpoint_file = './obj_det_checkpoints/cascade_rcnn_r101_fpn_1x_20181129-d64ebac7.pth'
 
 # set dataset for foreground extraction
-dataset = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join(raw_dataset_dir, dataset_name), context_frame_num=1, mode=mode, border_mode='hard')
+dataset = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join(raw_dataset_dir, dataset_name), context_frame_num=1, mode=mode, border_mode='hard', frame_backend=frame_backend)
 
 if not bbox_saved:
     # build the model from a config file and a checkpoint file
-    model = init_detector(config_file, checkpoint_file, device='cuda:0')
-
-    collate_func = bbox_collate('test')
-    dataset_loader = DataLoader(dataset=dataset, batch_size=1, shuffle=False, num_workers=1, collate_fn=collate_func.collate)
-    all_bboxes = list()
-
-    for idx in range(dataset.__len__()):
-        batch, _ = dataset.__getitem__(idx)
-
-        print('Extracting bboxes of {}-th frame'.format(idx + 1))
-
-        cur_img = img_tensor2numpy(batch[1])
-        if foreground_extraction_mode == 'obj_det_with_motion':
-            # A coarse detection of bboxes by pretrained object detector
-            ob_bboxes = getObBboxes(cur_img, model, dataset_name)
-            ob_bboxes = delCoverBboxes(ob_bboxes, dataset_name)
-
-            # further foreground detection by motion
-            fg_bboxes = getFgBboxes(cur_img, img_batch_tensor2numpy(batch), ob_bboxes, dataset_name, verbose=False)
-            if fg_bboxes.shape[0] > 0:
-                cur_bboxes = np.concatenate((ob_bboxes, fg_bboxes), axis=0)
-            else:
-                cur_bboxes = ob_bboxes
-        elif foreground_extraction_mode == 'obj_det':
-            # A coarse detection of bboxes by pretrained object detector
-            ob_bboxes = getObBboxes(cur_img, model, dataset_name)
-            cur_bboxes = delCoverBboxes(ob_bboxes, dataset_name)
-        elif foreground_extraction_mode == 'simple_patch':
-            patch_num_list = [(3, 4), (6, 8)]
-            cur_bboxes = list()
-            for h_num, w_num in patch_num_list:
-                cur_bboxes.append(get_patch_loc(frame_size[dataset_name][0], frame_size[dataset_name][1], h_num, w_num))
-            cur_bboxes = np.concatenate(cur_bboxes, axis=0)
-        else:
-            raise NotImplementedError
-
-        all_bboxes.append(cur_bboxes)
-    np.save(os.path.join(dataset.dir, 'bboxes_test_{}.npy'.format(foreground_extraction_mode)), all_bboxes)
+    if foreground_extraction_mode in ['obj_det', 'obj_det_with_motion']:
+        model = init_detector(config_file, checkpoint_file, device='cuda:0')
+        detector_key = detectorKey(config_file, checkpoint_file)
+        det_cache = DetectionCache(det_cache_path, detector_key) if det_cache_path else None
+    else:
+        model = None
+        detector_key = None
+        det_cache = None
+    scheduler = None
+    if det_interval > 1 and model is not None:
+        # the flow of frame t is the motion from frame t to frame t + 1, as computed by calc_img_inputs.py
+        flow_dataset = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join('optical_flow', dataset_name), context_frame_num=0,
+                                                 mode=mode, border_mode='hard', file_format='.npy', frame_backend=flow_frame_backend)
+        scheduler = KeyframeScheduler(flow_dataset, interval=det_interval, motion_change_thr=det_motion_change_thr)
+    static_gate = StaticFrameGate(thr=static_thr) if static_thr > 0 and foreground_extraction_mode != 'motion_bg' else None
+    rois = loadRoi(dataset.dir, frame_size[dataset_name][:2])
+
+    bbox_prefix = os.path.join(dataset.dir, 'bboxes_test_{}'.format(foreground_extraction_mode))
+    if num_workers > 0:
+        # videos are extracted in worker processes and saved as shards, an interrupted run resumes from them
+        all_bboxes = extractBboxesSharded(dataset, model, dataset_name, foreground_extraction_mode, bbox_prefix, num_workers,
+                                          det_batch_size=det_batch_size, prefetch_depth=prefetch_depth, det_cache=det_cache,
+                                          scheduler=scheduler, static_gate=static_gate, rois=rois, detector_key=detector_key)
+    else:
+        all_bboxes = extractBboxes(dataset, model, dataset_name, foreground_extraction_mode, det_batch_size=det_batch_size,
+                                   prefetch_depth=prefetch_depth, det_cache=det_cache,
+                                   scheduler=scheduler, static_gate=static_gate, rois=rois)
+        save_bboxes(bbox_prefix, all_bboxes)
     print('bboxes for testing data saved!')
+    print(shared_frame_cache)
+    if scheduler is not None:
+        print(scheduler)
+    if static_gate is not None:
+        print(static_gate)
 else:
-    all_bboxes = np.load(os.path.join(dataset.dir, 'bboxes_test_{}.npy'.format(foreground_extraction_mode)), allow_pickle=True)
+    # bboxes saved as a pickled object array by earlier versions are converted once
+    all_bboxes = load_bboxes(os.path.join(dataset.dir, 'bboxes_test_{}'.format(foreground_extraction_mode)),
+                             legacy_path=os.path.join(dataset.dir, 'bboxes_test_{}.npy'.format(foreground_extraction_mode)))
     print('bboxes for testing data loaded!')
 
 # /------------------------- extract foreground using extracted bboxes---------------------------------------/
@@ -119,6 +112,9 @@ if method == 'SelfComplete':
     border_mode = 'predict'
 else:
     border_mode = 'hard'
+# crop table with raw cubes as uint8 and optical flow as float16 and the crop rows of every block, see foreground_store.py
+foreground_dir = os.path.join(data_root_dir, modality, dataset_name + '_' + 'foreground_test_{}'.format(foreground_extraction_mode))
+modality_column = 'flow' if modality == 'optical_flow' else 'raw'
 if not foreground_saved:
     context_frame_num = cp.getint(method, 'context_frame_num')
     context_of_num = cp.getint(method, 'context_of_num')
@@ -135,11 +131,11 @@ if not foreground_saved:
         dataset = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join('raw_datasets', dataset_name),
                                             context_frame_num=context_frame_num, mode=mode,
                                             border_mode=border_mode, all_bboxes=all_bboxes, patch_size=patch_size,
-                                            file_format=file_format1)
+                                            file_format=file_format1, frame_backend=frame_backend)
         dataset2 = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join('optical_flow', dataset_name),
                                             context_frame_num=context_of_num, mode=mode,
                                             border_mode=border_mode, all_bboxes=all_bboxes, patch_size=patch_size,
-                                            file_format=file_format2)
+                                            file_format=file_format2, frame_backend=flow_frame_backend)
     else:
         dataset = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join(modality, dataset_name), context_frame_num=context_frame_num, mode=mode,
                               border_mode=border_mode, all_bboxes=all_bboxes, patch_size=patch_size, file_format=file_format)
@@ -148,18 +144,26 @@ if not foreground_saved:
         np.save(os.path.join(data_root_dir, modality, dataset_name + '_' + 'scene_idx.npy'), dataset.scene_idx)
         scene_idx = dataset.scene_idx
 
-    foreground_set = [[[[] for ww in range(w_block)] for hh in range(h_block)] for ii in range(dataset.__len__())]
-    if modality == 'raw2flow':
-        foreground_set2 = [[[[] for ww in range(w_block)] for hh in range(h_block)] for ii in range(dataset.__len__())]
-    foreground_bbox_set = [[[[] for ww in range(w_block)] for hh in range(h_block)] for ii in range(dataset.__len__())]
+    # cubes of each (0, h_block, w_block) block are appended to the columnar store in frame order, an interrupted
+    # extraction with the same settings resumes from its last checkpoint
+    fg_meta = {'dir': dataset.dir, 'mode': mode, 'foreground_extraction_mode': foreground_extraction_mode,
+               'bbox_num': int(all_bboxes.offsets[-1]), 'bbox_digest': all_bboxes.digest(), 'frame_backend': frame_backend,
+               'flow_backend': flow_backend, 'patch_size': patch_size, 'context_frame_num': context_frame_num,
+               'context_of_num': context_of_num, 'h_block': h_block, 'w_block': w_block, 'block_mode': test_block_mode,
+               'motionThr': motionThr}
+    foreground_set = foreground_store_writer(foreground_dir, ['raw', 'flow'] if modality == 'raw2flow' else [modality_column],
+                                             np.arange(dataset.__len__()), meta=fg_meta)
+    if foreground_set.done > 0:
+        print('Resuming foreground extraction after {} of {} frames'.format(foreground_set.done, dataset.__len__()))
     h_step, w_step = frame_size[dataset_name][0] / h_block, frame_size[dataset_name][1] / w_block
-    dataset_loader = DataLoader(dataset=dataset, batch_size=1, shuffle=False, num_workers=1,
-                                collate_fn=bbox_collate(mode=mode).collate)
-                                
-    for idx in range(dataset.__len__()):
-        batch, _ = dataset.__getitem__(idx)
+    # raw and optical flow windows of the same bboxes are read together
+    dataset_loader = prefetch_loader([dataset, dataset2] if modality == 'raw2flow' else [dataset], indices=foreground_set.order[foreground_set.done:],
+                                     num_workers=num_workers, prefetch_depth=prefetch_depth)
+
+    for idx, items in dataset_loader:
+        batch, _ = items[0]
         if modality == 'raw2flow':
-            batch2, _ = dataset2.__getitem__(idx)
+            batch2, _ = items[1]
         print('Extracting foreground in {}-th batch, {} in total'.format(idx + 1, dataset.__len__() // 1))
         cur_bboxes = all_bboxes[idx]
         if len(cur_bboxes) > 0:
@@ -180,38 +184,24 @@ if not foreground_saved:
             else:
                 mag = np.ones(batch.shape[0]) * 10000
 
-            for idx_bbox in range(cur_bboxes.shape[0]):
-                if mag[idx_bbox] > motionThr:
-                    all_blocks = calc_block_idx(cur_bboxes[idx_bbox, 0], cur_bboxes[idx_bbox, 2],
-                                                cur_bboxes[idx_bbox, 1], cur_bboxes[idx_bbox, 3], h_step, w_step, mode=test_block_mode)
-                    for (h_block_idx, w_block_idx) in all_blocks:
-                        foreground_set[idx][h_block_idx][w_block_idx].append(batch[idx_bbox])
-                        if modality == 'raw2flow':
-                            foreground_set2[idx][h_block_idx][w_block_idx].append(batch2[idx_bbox])
-                        foreground_bbox_set[idx][h_block_idx][w_block_idx].append(cur_bboxes[idx_bbox])                   
-  
-    foreground_set = [[[np.array(foreground_set[ii][hh][ww]) for ww in range(w_block)] for hh in range(h_block)] for ii in range(dataset.__len__())]
-    if modality == 'raw2flow':
-        foreground_set2 = [[[np.array(foreground_set2[ii][hh][ww]) for ww in range(w_block)] for hh in range(h_block)] for ii in range(dataset.__len__())]
-
-    foreground_bbox_set = [[[np.array(foreground_bbox_set[ii][hh][ww]) for ww in range(w_block)] for hh in range(h_block)] for ii in range(dataset.__len__())]
-    if modality == 'raw2flow':
-        np.save(os.path.join(data_root_dir, modality, dataset_name+'_'+'foreground_test_{}-raw.npy'.format(foreground_extraction_mode)), foreground_set)
-        np.save(os.path.join(data_root_dir, modality, dataset_name+'_'+'foreground_test_{}-flow.npy'.format(foreground_extraction_mode)), foreground_set2)
-    else:
-        np.save(os.path.join(data_root_dir, modality, dataset_name+'_'+'foreground_test_{}.npy'.format(foreground_extraction_mode)), foreground_set)
-    np.save(os.path.join(data_root_dir, modality, dataset_name + '_' + 'foreground_bbox_test_{}.npy'.format(foreground_extraction_mode)), foreground_bbox_set)
+            # blocks of all bboxes of the frame, the bboxes without enough motion are dropped
+            all_blocks = calc_block_idx(cur_bboxes, h_step, w_step, mode=test_block_mode)
+            all_blocks = all_blocks[mag[all_blocks[:, 0]] > motionThr]
+            # each crop is stored once and referenced by all of its blocks
+            for idx_bbox in np.unique(all_blocks[:, 0]):
+                cubes = {'raw': batch[idx_bbox], 'flow': batch2[idx_bbox]} if modality == 'raw2flow' else {modality_column: batch[idx_bbox]}
+                blocks = [(0, h_block_idx, w_block_idx) for h_block_idx, w_block_idx in all_blocks[all_blocks[:, 0] == idx_bbox, 1:]]
+                foreground_set.append(blocks, idx, cur_bboxes[idx_bbox], cubes)
+        foreground_set.frame_done()
+
+    foreground_set.close(frame_num=dataset.__len__())
+    foreground_set = foreground_store(foreground_dir)
     print('foreground for testing data saved!')
+    print(shared_frame_cache)
 else:
     if dataset_name == 'ShanghaiTech':
         scene_idx = np.load(os.path.join(data_root_dir, modality, dataset_name + '_' + 'scene_idx.npy'))
-    if modality == 'raw2flow':
-        foreground_set = np.load(os.path.join(data_root_dir, modality, dataset_name+'_'+'foreground_test_{}-raw.npy'.format(foreground_extraction_mode)), allow_pickle=True)
-        foreground_set2 = np.load(os.path.join(data_root_dir, modality, dataset_name+'_'+'foreground_test_{}-flow.npy'.format(foreground_extraction_mode)), allow_pickle=True)
-    else:
-        foreground_set = np.load(os.path.join(data_root_dir, modality, dataset_name+'_'+'foreground_test_{}.npy'.format(foreground_extraction_mode)), allow_pickle=True)
-
-    foreground_bbox_set = np.load(os.path.join(data_root_dir, modality, dataset_name+'_'+'foreground_bbox_test_{}.npy'.format(foreground_extraction_mode)), allow_pickle=True)
+    foreground_set = foreground_store(foreground_dir)
     print('foreground for testing data loaded!')
 
 #  /*------------------------------------------Abnormal event detection----------------------------------------------*/
@@ -285,22 +275,19 @@ if scores_saved is False:
             del raw_training_scores_set, of_training_scores_set
 
         # Get scores
-        for frame_idx in range(len(foreground_set)):
+        # the cubes and bboxes of the frames are read from the store in frame order by a read-ahead thread
+        for frame_idx, frame_blocks in foreground_frame_reader(foreground_set):
             print('Calculating scores for {}-th frame'.format(frame_idx))
-            cur_data_set = foreground_set[frame_idx]
-            cur_data_set2 = foreground_set2[frame_idx]
-            cur_bboxes = foreground_bbox_set[frame_idx]
             cur_pixel_results = -1 * np.ones(shape=(h, w)) * big_number
-            for h_idx in range(len(cur_data_set)):
-                for w_idx in range(len(cur_data_set[h_idx])):
-                    if len(cur_data_set[h_idx][w_idx]) > 0:
-
+            for h_idx in range(h_block):
+                for w_idx in range(w_block):
+                    if (0, h_idx, w_idx) in frame_blocks:
+                        cur_data, cur_data2, cur_bboxes = frame_blocks[(0, h_idx, w_idx)]
                         if dataset_name == 'ShanghaiTech':
                             if len(model_set[scene_idx[frame_idx] - 1][h_idx][w_idx]) > 0:
                                 cur_model = model_set[scene_idx[frame_idx] - 1][h_idx][w_idx][0]
-                                cur_dataset = cube_to_train_dataset(cur_data_set[h_idx][w_idx], target=cur_data_set2[h_idx][w_idx])
-                                cur_dataloader = DataLoader(dataset=cur_dataset, batch_size=cur_data_set[h_idx][w_idx].shape[0], shuffle=False)
-                                for idx, (inputs, of_targets_all, _) in enumerate(cur_dataloader):
+                                cur_dataset = cube_block_dataset(cur_data, cur_data2)
+                                for idx, (inputs, of_targets_all) in enumerate(cur_dataset.loader(cur_data.shape[0])):
                                     inputs = inputs.cuda().type(torch.cuda.FloatTensor)
                                     of_targets_all = of_targets_all.cuda().type(torch.cuda.FloatTensor)
                                     
@@ -322,14 +309,13 @@ if scores_saved is False:
                                         scores = cp.getfloat(method, 'w_raw') * raw_scores
 
                             else:
-                                scores = np.ones(cur_data_set[h_idx][w_idx].shape[0], ) * big_number
+                                scores = np.ones(cur_data.shape[0], ) * big_number
                         else:
                             if len(model_set[h_idx][w_idx]) > 0:
                                 cur_model = model_set[h_idx][w_idx][0]
-                                cur_dataset = cube_to_train_dataset(cur_data_set[h_idx][w_idx], target=cur_data_set2[h_idx][w_idx])
-                                cur_dataloader = DataLoader(dataset=cur_dataset, batch_size=cur_data_set[h_idx][w_idx].shape[0], shuffle=False)
+                                cur_dataset = cube_block_dataset(cur_data, cur_data2)
                                 
-                                for idx, (inputs, of_targets_all, _) in enumerate(cur_dataloader):
+                                for idx, (inputs, of_targets_all) in enumerate(cur_dataset.loader(cur_data.shape[0])):
                                     inputs = inputs.cuda().type(torch.cuda.FloatTensor)
                                     of_targets_all = of_targets_all.cuda().type(torch.cuda.FloatTensor)
                                     of_outputs, raw_outputs, of_targets, raw_targets = cur_model(inputs, of_targets_all)
@@ -361,12 +347,12 @@ if scores_saved is False:
                                     else:
                                         scores = cp.getfloat(method, 'w_raw') * raw_scores   
                             else:
-                                scores = np.ones(cur_data_set[h_idx][w_idx].shape[0], ) * big_number
+                                scores = np.ones(cur_data.shape[0], ) * big_number
 
                         for m in range(scores.shape[0]):
                             cur_score_mask = -1 * np.ones(shape=(h, w)) * big_number
                             cur_score = scores[m]
-                            bbox = cur_bboxes[h_idx][w_idx][m]
+                            bbox = cur_bboxes[m]
                             x_min, x_max = np.int(np.ceil(bbox[0])), np.int(np.ceil(bbox[2]))
                             y_min, y_max = np.int(np.ceil(bbox[1])), np.int(np.ceil(bbox[3]))
                             cur_score_mask[y_min:y_max, x_min:x_max] = cur_score
@@ -379,7 +365,7 @@ if scores_saved is False:
 criterion = 'frame'
 batch_size = 1
 # set dataset for evaluation
-dataset = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join(raw_dataset_dir, dataset_name), context_frame_num=0, mode=mode, border_mode='hard')
+dataset = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join(raw_dataset_dir, dataset_name), context_frame_num=0, mode=mode, border_mode='hard', frame_backend=frame_backend, gt_criterion=criterion)
 dataset_loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False, num_workers=1, collate_fn=bbox_collate(mode).collate)
 
 print('Evaluating {} by {}-criterion:'.format(dataset_name, criterion))
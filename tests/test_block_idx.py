@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from foreground_store import calc_block_idx
+
+
+def calcBlockIdxLoop(x_min, x_max, y_min, y_max, h_step, w_step, mode):
+    # per-bbox version formerly duplicated in train.py and test.py, the reference of calc_block_idx
+    all_blocks = list()
+    center = np.array([(y_min + y_max) / 2, (x_min + x_max) / 2])
+    all_blocks.append(center + center)
+    if mode > 1:
+        all_blocks.append(np.array([y_min, center[1]]) + center)
+        all_blocks.append(np.array([y_max, center[1]]) + center)
+        all_blocks.append(np.array([center[0], x_min]) + center)
+        all_blocks.append(np.array([center[0], x_max]) + center)
+    if mode >= 9:
+        all_blocks.append(np.array([y_min, x_min]) + center)
+        all_blocks.append(np.array([y_max, x_max]) + center)
+        all_blocks.append(np.array([y_max, x_min]) + center)
+        all_blocks.append(np.array([y_min, x_max]) + center)
+    all_blocks = np.array(all_blocks) / 2
+    h_block_idxes = all_blocks[:, 0] / h_step
+    w_block_idxes = all_blocks[:, 1] / w_step
+    return set(zip(h_block_idxes.astype(int), w_block_idxes.astype(int)))
+
+
+def random_bboxes(rng, n, h_step, w_step, snap):
+    xy = rng.rand(n, 2) * [360, 240]
+    wh = rng.rand(n, 2) * 120
+    bboxes = np.concatenate([xy, xy + wh], axis=1)
+    if snap:
+        # corners and centers on the block boundaries
+        steps = np.array([w_step, h_step, w_step, h_step]) / 2
+        bboxes = np.round(bboxes / steps) * steps
+    return bboxes
+
+
+@pytest.mark.parametrize('mode', [1, 5, 9])
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('snap', [False, True])
+def test_calc_block_idx_parity(mode, dtype, snap):
+    rng = np.random.RandomState(mode)
+    for _ in range(300):
+        h_step, w_step = 240 / rng.randint(1, 6), 360 / rng.randint(1, 6)
+        bboxes = random_bboxes(rng, rng.randint(0, 12), h_step, w_step, snap).astype(dtype)
+        ref = sorted((i, h, w) for i, x in enumerate(bboxes) for h, w in calcBlockIdxLoop(x[0], x[2], x[1], x[3], h_step, w_step, mode))
+        out = calc_block_idx(bboxes, h_step, w_step, mode)
+        assert out.dtype == np.int64 and out.shape[1:] == (3,)
+        assert [tuple(x) for x in out.tolist()] == ref
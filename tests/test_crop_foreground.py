@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from vad_datasets import crop_foreground, get_foreground
+
+
+def random_bboxes(rng, n, h, w):
+    # at least 2 pixels wide after np.ceil, so that cv2.resize gets a non-empty crop
+    xy = rng.uniform(0, [w - 8, h - 8], (n, 2))
+    wh = rng.uniform(2, [w / 2, h / 2], (n, 2))
+    bboxes = np.concatenate([xy, np.minimum(xy + wh, [w, h])], axis=1)
+    # half of the boxes on integer coordinates, where np.ceil does not move them
+    bboxes[::2] = np.round(bboxes[::2])
+    return bboxes
+
+
+@pytest.mark.parametrize('patch_size', [8, 32])
+@pytest.mark.parametrize('shape', [(3, 60, 80), (5, 3, 60, 80), (2, 60, 80), (3, 2, 60, 80)])
+def test_crop_foreground_uint8(shape, patch_size):
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        img = rng.randint(0, 256, shape).astype(np.uint8)
+        bboxes = random_bboxes(rng, 6, shape[-2], shape[-1])
+        ref = get_foreground(img, bboxes, patch_size)
+        out = crop_foreground(img, bboxes, patch_size)
+        assert out.shape == ref.shape and out.dtype == np.uint8
+        assert np.abs(out.astype(np.int16) - ref.astype(np.int16)).max() <= 1
+
+
+@pytest.mark.parametrize('patch_size', [8, 32])
+@pytest.mark.parametrize('shape', [(3, 60, 80), (5, 3, 60, 80), (2, 60, 80), (3, 2, 60, 80)])
+def test_crop_foreground_float(shape, patch_size):
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        img = rng.rand(*shape).astype(np.float32)
+        bboxes = random_bboxes(rng, 6, shape[-2], shape[-1])
+        ref = get_foreground(img, bboxes, patch_size)
+        out = crop_foreground(img, bboxes, patch_size)
+        assert out.shape == ref.shape and out.dtype == np.float32
+        np.testing.assert_allclose(out, ref, rtol=0, atol=1e-6)
+
+
+def test_crop_foreground_no_bboxes():
+    img = np.zeros((3, 60, 80), dtype=np.uint8)
+    assert crop_foreground(img, np.zeros((0, 4)), 32).shape == (0, 3, 32, 32)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('mmcv')
+pytest.importorskip('sklearn')
+from fore_det.obj_det_with_motion import delCoverBboxes
+
+
+def delCoverBboxesLoop(bboxes, dataset_name):
+    # per-bbox loop that delCoverBboxes replaced, the reference of its keep sets
+    cover_thr = 0.65 if dataset_name == 'ShanghaiTech' else 0.6
+    x1, y1, x2, y2 = bboxes[:, 0], bboxes[:, 1], bboxes[:, 2], bboxes[:, 3]
+    bbox_areas = (y2 - y1 + 1) * (x2 - x1 + 1)
+    sort_idx = bbox_areas.argsort()
+    keep_idx = []
+    for i in range(sort_idx.size):
+        x11 = np.maximum(x1[sort_idx[i]], x1[sort_idx[i + 1:]])
+        y11 = np.maximum(y1[sort_idx[i]], y1[sort_idx[i + 1:]])
+        x22 = np.minimum(x2[sort_idx[i]], x2[sort_idx[i + 1:]])
+        y22 = np.minimum(y2[sort_idx[i]], y2[sort_idx[i + 1:]])
+        w = np.maximum(0, x22 - x11 + 1)
+        h = np.maximum(0, y22 - y11 + 1)
+        ratios = w * h / bbox_areas[sort_idx[i]]
+        if not np.any(ratios > cover_thr):
+            keep_idx.append(sort_idx[i])
+    return bboxes[keep_idx]
+
+
+def random_bboxes(rng, n, dtype):
+    xy = rng.uniform(0, 300, (n, 2))
+    wh = rng.uniform(1, 120, (n, 2))
+    bboxes = np.concatenate([xy, xy + wh], axis=1)
+    # integer boxes, nested and duplicated boxes are the ties of the area sort
+    if rng.rand() < 0.5:
+        bboxes = np.round(bboxes)
+    if n > 3:
+        bboxes[1] = bboxes[0]
+        bboxes[2] = bboxes[0]
+        bboxes[3] = bboxes[0] + [5, 5, -5, -5]
+    return bboxes.astype(dtype)
+
+
+@pytest.mark.parametrize('dataset_name', ['UCSDped2', 'ShanghaiTech'])
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('tile_size', [1, 7, 64])
+def test_del_cover_bboxes_parity(dataset_name, dtype, tile_size):
+    rng = np.random.RandomState(tile_size)
+    for _ in range(300):
+        bboxes = random_bboxes(rng, rng.randint(0, 60), dtype)
+        ref = delCoverBboxesLoop(bboxes, dataset_name)
+        out = delCoverBboxes(bboxes, dataset_name, tile_size=tile_size)
+        assert out.shape == ref.shape and np.array_equal(out, ref)
+
+
+def test_del_cover_bboxes_empty():
+    assert delCoverBboxes(np.zeros((0, 4), dtype=np.float32), 'avenue').shape == (0, 4)
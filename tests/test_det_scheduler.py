@@ -0,0 +1,58 @@
+import numpy as np
+from fore_det.det_scheduler import KeyframeScheduler, StaticFrameGate
+
+
+class flow_frames:
+    # stands in for the optical flow dataset, get_frame(t) is the motion from frame t to frame t + 1
+    def __init__(self, flows):
+        self.flows = flows
+
+    def get_frame(self, idx):
+        return self.flows[idx]
+
+
+def moving_box(frame_num=40, shape=(48, 64), size=12):
+    # a bright box moving one pixel to the right per frame, its bbox in every frame and the flow between frames
+    frames, flows, bboxes = list(), list(), list()
+    for t in range(frame_num):
+        x, y = 4 + t, 18
+        frame = np.full(shape + (3,), 50, dtype=np.uint8)
+        frame[y:y + size, x:x + size] = 200
+        flow = np.zeros(shape + (2,), dtype=np.float32)
+        flow[y:y + size, x:x + size, 0] = 1
+        frames.append(frame)
+        flows.append(flow)
+        bboxes.append(np.array([[x, y, x + size - 1, y + size - 1]], dtype=np.float32))
+    return frames, flows, bboxes
+
+
+def test_propagation_across_static_frames():
+    frames, flows, true_bboxes = moving_box()
+    scheduler = KeyframeScheduler(flow_frames(flows), interval=100, drift_thr=10.)
+    gate = StaticFrameGate(thr=2.5)
+    propagated = 0
+    for idx, frame in enumerate(frames):
+        # as in extractBboxes, static frames reuse the previous bboxes and are not passed to the scheduler
+        if gate.isStatic(frame, 0):
+            continue
+        if scheduler.scheduleKeyframes([idx], [0])[0]:
+            bboxes = true_bboxes[idx]
+            scheduler.setKeyframe(bboxes, idx)
+        else:
+            bboxes = scheduler.propagate(idx)
+            propagated += 1
+        # the motion of the skipped frames is applied too
+        np.testing.assert_allclose(bboxes, true_bboxes[idx])
+    assert gate.skipped > len(frames) // 2 and propagated > 5 and scheduler.detected == 1
+
+
+def test_left_out_interval_frame_moves_the_keyframe():
+    flows = [np.zeros((8, 8, 2), dtype=np.float32)] * 20
+    scheduler = KeyframeScheduler(flow_frames(flows), interval=5)
+    indices = [0, 1, 2, 4, 6, 7, 11, 15, 16]
+    is_key = scheduler.scheduleKeyframes(indices, [0] * len(indices))
+    assert [idx for idx, key in zip(indices, is_key) if key] == [0, 6, 11, 15]
+    # without left out frames every interval-th frame is a keyframe, as before
+    scheduler = KeyframeScheduler(flow_frames(flows), interval=5)
+    is_key = scheduler.scheduleKeyframes(list(range(20)), [0] * 20)
+    assert [idx for idx, key in enumerate(is_key) if key] == [0, 5, 10, 15]
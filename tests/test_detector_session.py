@@ -0,0 +1,38 @@
+import os
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('mmdet')
+from fore_det.inference import init_detector, DetectorSession
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+config_file = os.path.join(root, 'obj_det_config', 'cascade_rcnn_r101_fpn_1x.py')
+checkpoint_file = os.path.join(root, 'obj_det_checkpoints', 'cascade_rcnn_r101_fpn_1x_20181129-d64ebac7.pth')
+
+
+def synthetic_frames(frame_num=2, shape=(240, 360)):
+    # noise with bright and dark rectangles, frames of one shape as in a dataset
+    rng = np.random.RandomState(0)
+    frames = list()
+    for _ in range(frame_num):
+        frame = rng.randint(60, 120, shape + (3,)).astype(np.uint8)
+        for _ in range(4):
+            x, y = rng.randint(0, shape[1] - 60), rng.randint(0, shape[0] - 80)
+            frame[y:y + rng.randint(30, 80), x:x + rng.randint(20, 60)] = rng.randint(0, 256, 3)
+        frames.append(frame)
+    return frames
+
+
+@pytest.mark.skipif(not torch.cuda.is_available() or not os.path.exists(checkpoint_file),
+                    reason='needs a gpu and the detector checkpoint')
+def test_batched_detections_match_single():
+    model = init_detector(config_file, checkpoint_file, device='cuda:0')
+    frames = synthetic_frames()
+    single = DetectorSession(model, batch_size=1)(frames)
+    batched = DetectorSession(model, batch_size=len(frames))(frames)
+    assert len(single) == len(batched) == len(frames)
+    for single_result, batched_result in zip(single, batched):
+        assert len(single_result) == len(batched_result)
+        for single_dets, batched_dets in zip(single_result, batched_result):
+            np.testing.assert_allclose(batched_dets, single_dets, rtol=1e-4, atol=1e-2)
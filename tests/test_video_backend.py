@@ -0,0 +1,49 @@
+import os
+import cv2
+import numpy as np
+from vad_datasets import unified_dataset_interface
+
+
+def write_clips(root, video_num=2, frame_num=100, shape=(48, 64)):
+    '''
+    MJPG clips in <root>/video/Train/TrainXXX.avi and their frames, decoded in order, as images in <root>/raw
+    '''
+    rng = np.random.RandomState(0)
+    for v in range(video_num):
+        name = 'Train{:03d}'.format(v + 1)
+        os.makedirs(os.path.join(root, 'video', 'Train'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'raw', 'Train', name))
+        video_addr = os.path.join(root, 'video', 'Train', name + '.avi')
+        writer = cv2.VideoWriter(video_addr, cv2.VideoWriter_fourcc(*'MJPG'), 25, (shape[1], shape[0]))
+        for t in range(frame_num):
+            # a moving box on noise, so that neighbouring frames differ
+            frame = rng.randint(0, 64, shape + (3,)).astype(np.uint8)
+            frame[10:30, t // 3:t // 3 + 20] = 200
+            writer.write(frame)
+        writer.release()
+        cap = cv2.VideoCapture(video_addr)
+        t = 0
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            cv2.imwrite(os.path.join(root, 'raw', 'Train', name, '{:03d}.tif'.format(t + 1)), frame)
+            t += 1
+        cap.release()
+        assert t == frame_num
+
+
+def test_video_backend_matches_frames(tmp_path):
+    root = str(tmp_path)
+    write_clips(root)
+    video = unified_dataset_interface('UCSDped2', os.path.join(root, 'video'), context_frame_num=2, border_mode='hard',
+                                      cache=None, frame_backend='video')
+    raw = unified_dataset_interface('UCSDped2', os.path.join(root, 'raw'), context_frame_num=2, border_mode='hard',
+                                    cache=None, frame_backend='file')
+    assert len(video) == len(raw) == 200
+    # in order, then in random order, which seeks backwards and further ahead than video_frame_store.max_skip
+    order = list(range(len(raw))) + list(np.random.RandomState(1).permutation(len(raw)))
+    for idx in order:
+        video_frames, raw_frames = video[idx][0].numpy(), raw[idx][0].numpy()
+        assert video_frames.shape == (5, 3, 48, 64)
+        assert np.array_equal(video_frames, raw_frames)
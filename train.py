@@ -1,9 +1,15 @@
 import numpy as np
 import os
-from torch.utils.data import DataLoader
-from vad_datasets import unified_dataset_interface, cube_to_train_dataset
+from vad_datasets import unified_dataset_interface, cube_block_dataset, cube_block_stream
 from fore_det.inference import init_detector
-from vad_datasets import bbox_collate, img_tensor2numpy, img_batch_tensor2numpy, frame_size
+from fore_det.det_cache import DetectionCache, detectorKey
+from fore_det.bbox_extraction import extractBboxes
+from fore_det.bbox_shards import extractBboxesSharded
+from fore_det.det_scheduler import KeyframeScheduler, StaticFrameGate
+from fore_det.roi import loadRoi
+from bbox_store import save_bboxes, load_bboxes
+from foreground_store import foreground_store, foreground_store_writer, calc_block_idx
+from vad_datasets import bbox_collate, img_tensor2numpy, img_batch_tensor2numpy, frame_size, shared_frame_cache, prefetch_loader
 from fore_det.obj_det_with_motion import imshow_bboxes, getObBboxes, getFgBboxes, delCoverBboxes
 from fore_det.simple_patch import get_patch_loc
 import cv2
@@ -14,40 +20,27 @@ import torch.optim as optim
 import torch.nn as nn
 from configparser import ConfigParser
 
-def calc_block_idx(x_min, x_max, y_min, y_max, h_step, w_step, mode):
-    all_blocks = list()
-    center = np.array([(y_min+y_max)/2, (x_min+x_max)/2])
-    all_blocks.append(center + center)
-    if mode > 1:
-        all_blocks.append(np.array([y_min, center[1]]) + center)
-        all_blocks.append(np.array([y_max, center[1]]) + center)
-        all_blocks.append(np.array([center[0], x_min]) + center)
-        all_blocks.append(np.array([center[0], x_max]) + center)
-    if mode >= 9:
-        all_blocks.append(np.array([y_min, x_min]) + center)
-        all_blocks.append(np.array([y_max, x_max]) + center)
-        all_blocks.append(np.array([y_max, x_min]) + center)
-        all_blocks.append(np.array([y_min, x_max]) + center)
-    all_blocks = np.array(all_blocks) / 2
-    h_block_idxes = all_blocks[:, 0] / h_step
-    w_block_idxes = all_blocks[:, 1] / w_step
-    h_block_idxes, w_block_idxes = list(h_block_idxes.astype(np.int)), list(w_block_idxes.astype(np.int))
-    # delete repeated elements
-    all_blocks = set([x for x in zip(h_block_idxes, w_block_idxes)])
-    all_blocks = [x for x in all_blocks]
-    return all_blocks
-
 #  /*------------------------------------overall parameter setting------------------------------------------*/
 cp = ConfigParser()
 cp.read("config.cfg")
 
 dataset_name = cp.get('shared_parameters', 'dataset_name')  # appoint the name of dataset for testing
 raw_dataset_dir = cp.get('shared_parameters', 'raw_dataset_dir')  # fixed
-foreground_extraction_mode = cp.get('shared_parameters', 'foreground_extraction_mode') # obj_det/simple_patch/obj_det_with_motion
+foreground_extraction_mode = cp.get('shared_parameters', 'foreground_extraction_mode') # obj_det/simple_patch/obj_det_with_motion/motion_bg
 data_root_dir = cp.get('shared_parameters', 'data_root_dir')  # fixed
 modality = cp.get('shared_parameters', 'modality')  # raw2flow
 mode = cp.get('train_parameters', 'mode')  # fixed
 method = cp.get('shared_parameters', 'method') 
+frame_cache_size = cp.getint('shared_parameters', 'frame_cache_size')  # MB of decoded frames kept in memory
+frame_backend = cp.get('shared_parameters', 'frame_backend')  # file/packed/video
+flow_backend = cp.get('shared_parameters', 'flow_backend')  # npy/packed
+num_workers = cp.getint('shared_parameters', 'num_workers')  # processes reading frames for foreground extraction, 0 to read in the main process
+prefetch_depth = cp.getint('shared_parameters', 'prefetch_depth')  # chunks of frames read ahead of the extraction loops
+det_batch_size = cp.getint('shared_parameters', 'det_batch_size')  # frames forwarded together by the object detector
+det_cache_path = cp.get('shared_parameters', 'det_cache')  # sqlite file of the raw detections shared across runs, empty to disable
+det_interval = cp.getint('shared_parameters', 'det_interval')  # run the object detector every det_interval frames and propagate its bboxes by optical flow in between, 1 to detect every frame
+det_motion_change_thr = cp.getfloat('shared_parameters', 'det_motion_change_thr')  # change of the mean flow magnitude (pixels) between frames that triggers a detection
+static_thr = cp.getfloat('shared_parameters', 'static_thr')  # mean absolute difference (0-255) to the last processed frame below which a frame reuses the previous bboxes, 0 to process every frame
 try:
     patch_size = cp.getint(dataset_name, 'patch_size')  # resize the foreground bboxes
     # Define h_block * w_block sub-regions of video frames for localized training
@@ -60,58 +53,56 @@ try:
 except:
     raise NotImplementedError
 
+shared_frame_cache.resize(frame_cache_size * 1024 ** 2)
+flow_frame_backend = 'packed' if flow_backend == 'packed' else 'file'
+
 #  /*------------------------------------------foreground extraction----------------------------------------------*/
 config_file = './obj_det_config/cascade_rcnn_r101_fpn_1x.py'
 checkpoint_file = './obj_det_checkpoints/cascade_rcnn_r101_fpn_1x_20181129-d64ebac7.pth'
 
 # set dataset for foreground extraction
-dataset = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join(raw_dataset_dir, dataset_name), context_frame_num=1, mode=mode, border_mode='hard')
+dataset = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join(raw_dataset_dir, dataset_name), context_frame_num=1, mode=mode, border_mode='hard', frame_backend=frame_backend)
 
 if not bbox_saved:
     # build the model from a config file and a checkpoint file
-    model = init_detector(config_file, checkpoint_file, device='cuda:0')
-
-    collate_func = bbox_collate('train')
-    dataset_loader = DataLoader(dataset=dataset, batch_size=1, shuffle=False, num_workers=1, collate_fn=collate_func.collate)
-    all_bboxes = list()
-
-    for idx in range(dataset.__len__()):
-        batch, _ = dataset.__getitem__(idx)
-        print('Extracting bboxes of {}-th frame'.format(idx + 1))
-        cur_img = img_tensor2numpy(batch[1])
-
-        if foreground_extraction_mode == 'obj_det_with_motion':
-            # A coarse detection of bboxes by pretrained object detector
-            ob_bboxes = getObBboxes(cur_img, model, dataset_name)
-            
-            ob_bboxes = delCoverBboxes(ob_bboxes, dataset_name)
-
-            # further foreground detection by motion
-            fg_bboxes = getFgBboxes(cur_img, img_batch_tensor2numpy(batch), ob_bboxes, dataset_name, verbose=False)
-
-            if fg_bboxes.shape[0] > 0:
-                cur_bboxes = np.concatenate((ob_bboxes, fg_bboxes), axis=0)
-            else:
-                cur_bboxes = ob_bboxes
-        elif foreground_extraction_mode == 'obj_det':
-            # A coarse detection of bboxes by pretrained object detector
-            ob_bboxes = getObBboxes(cur_img, model, dataset_name)
-            cur_bboxes = delCoverBboxes(ob_bboxes, dataset_name)
-        elif foreground_extraction_mode == 'simple_patch':
-            patch_num_list = [(3, 4), (6, 8)]
-            cur_bboxes = list()
-            for h_num, w_num in patch_num_list:
-                cur_bboxes.append(get_patch_loc(frame_size[dataset_name][0], frame_size[dataset_name][1], h_num, w_num))
-            cur_bboxes = np.concatenate(cur_bboxes, axis=0)
-        else:
-            raise NotImplementedError
-
-        # imshow_bboxes(cur_img, cur_bboxes)
-        all_bboxes.append(cur_bboxes)
-    np.save(os.path.join(dataset.dir, 'bboxes_train_{}.npy'.format(foreground_extraction_mode)), all_bboxes)
+    if foreground_extraction_mode in ['obj_det', 'obj_det_with_motion']:
+        model = init_detector(config_file, checkpoint_file, device='cuda:0')
+        detector_key = detectorKey(config_file, checkpoint_file)
+        det_cache = DetectionCache(det_cache_path, detector_key) if det_cache_path else None
+    else:
+        model = None
+        detector_key = None
+        det_cache = None
+    scheduler = None
+    if det_interval > 1 and model is not None:
+        # the flow of frame t is the motion from frame t to frame t + 1, as computed by calc_img_inputs.py
+        flow_dataset = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join('optical_flow', dataset_name), context_frame_num=0,
+                                                 mode=mode, border_mode='hard', file_format='.npy', frame_backend=flow_frame_backend)
+        scheduler = KeyframeScheduler(flow_dataset, interval=det_interval, motion_change_thr=det_motion_change_thr)
+    static_gate = StaticFrameGate(thr=static_thr) if static_thr > 0 and foreground_extraction_mode != 'motion_bg' else None
+    rois = loadRoi(dataset.dir, frame_size[dataset_name][:2])  # per-scene regions of interest in roi.json of the dataset, if it exists
+
+    bbox_prefix = os.path.join(dataset.dir, 'bboxes_train_{}'.format(foreground_extraction_mode))
+    if num_workers > 0:
+        # videos are extracted in worker processes and saved as shards, an interrupted run resumes from them
+        all_bboxes = extractBboxesSharded(dataset, model, dataset_name, foreground_extraction_mode, bbox_prefix, num_workers,
+                                          det_batch_size=det_batch_size, prefetch_depth=prefetch_depth, det_cache=det_cache,
+                                          scheduler=scheduler, static_gate=static_gate, rois=rois, detector_key=detector_key)
+    else:
+        all_bboxes = extractBboxes(dataset, model, dataset_name, foreground_extraction_mode, det_batch_size=det_batch_size,
+                                   prefetch_depth=prefetch_depth, det_cache=det_cache,
+                                   scheduler=scheduler, static_gate=static_gate, rois=rois)
+        save_bboxes(bbox_prefix, all_bboxes)
     print('bboxes for training data saved!')
+    print(shared_frame_cache)
+    if scheduler is not None:
+        print(scheduler)
+    if static_gate is not None:
+        print(static_gate)
 else:
-    all_bboxes = np.load(os.path.join(dataset.dir, 'bboxes_train_{}.npy'.format(foreground_extraction_mode)), allow_pickle=True)
+    # bboxes saved as a pickled object array by earlier versions are converted once
+    all_bboxes = load_bboxes(os.path.join(dataset.dir, 'bboxes_train_{}'.format(foreground_extraction_mode)),
+                             legacy_path=os.path.join(dataset.dir, 'bboxes_train_{}.npy'.format(foreground_extraction_mode)))
     print('bboxes for training data loaded!')
 
 # /------------------------- extract foreground using extracted bboxes---------------------------------------/
@@ -120,6 +111,9 @@ if method == 'SelfComplete':
     border_mode = 'predict'
 else:
     border_mode = 'hard'
+# crop table with raw cubes as uint8 and optical flow as float16 and the crop rows of every block, see foreground_store.py
+foreground_dir = os.path.join(data_root_dir, modality, dataset_name + '_' + 'foreground_train_{}'.format(foreground_extraction_mode))
+modality_column = 'flow' if modality == 'optical_flow' else 'raw'
 if not foreground_saved:
     context_frame_num = cp.getint(method, 'context_frame_num')
     context_of_num = cp.getint(method, 'context_of_num')
@@ -134,43 +128,42 @@ if not foreground_saved:
     if modality == 'raw2flow':
         dataset = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join('raw_datasets', dataset_name),
                                             context_frame_num=context_frame_num, mode=mode, border_mode=border_mode, 
-                                            all_bboxes=all_bboxes, patch_size=patch_size, file_format=file_format1)
+                                            all_bboxes=all_bboxes, patch_size=patch_size, file_format=file_format1, frame_backend=frame_backend)
         dataset2 = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join('optical_flow', dataset_name),
                                              context_frame_num=context_of_num, mode=mode, border_mode=border_mode, 
-                                             all_bboxes=all_bboxes, patch_size=patch_size, file_format=file_format2)
+                                             all_bboxes=all_bboxes, patch_size=patch_size, file_format=file_format2, frame_backend=flow_frame_backend)
     else:
         dataset = unified_dataset_interface(dataset_name=dataset_name, dir=os.path.join(modality, dataset_name),
                                             context_frame_num=context_frame_num, mode=mode, border_mode=border_mode, 
                                             all_bboxes=all_bboxes, patch_size=patch_size, file_format=file_format)
     
-    if dataset_name == 'ShanghaiTech':
-        foreground_set = [[[[] for ww in range(w_block)] for hh in range(h_block)] for ss in range(dataset.scene_num)]
-        if modality == 'raw2flow':
-            foreground_set2 = [[[[] for ww in range(w_block)] for hh in range(h_block)] for ss in range(dataset.scene_num)]
-    else:
-        foreground_set = [[[] for ww in range(w_block)] for hh in range(h_block)]
-        if modality == 'raw2flow':
-            foreground_set2 = [[[] for ww in range(w_block)] for hh in range(h_block)]
-
     h_step, w_step = frame_size[dataset_name][0] / h_block, frame_size[dataset_name][1] / w_block
-    dataset_loader = DataLoader(dataset=dataset, batch_size=1, shuffle=False, num_workers=1, collate_fn=bbox_collate(mode=mode).collate)
-
     if dataset_name == 'ShanghaiTech' and modality == 'raw2flow':
+        # frames in random order, the chunks streamed from a block hold cubes of frames from all over the dataset
         randIdx = np.random.permutation(dataset.__len__())
-        cout = 0
-        segIdx = 0
-        saveSegNum = cp.getint(dataset_name, 'saveSegNum')
-
-    for iidx in range(dataset.__len__()):
-        if dataset_name == 'ShanghaiTech' and modality == 'raw2flow':
-            idx = randIdx[iidx]
-            cout += 1
-        else:
-            idx = iidx
-
-        batch, _ = dataset.__getitem__(idx)
+    else:
+        randIdx = np.arange(dataset.__len__())
+
+    # cubes of each (scene, h_block, w_block) block are appended to the columnar store as they are extracted, an
+    # interrupted extraction with the same settings resumes from its last checkpoint in the order it was started with
+    fg_meta = {'dir': dataset.dir, 'mode': mode, 'foreground_extraction_mode': foreground_extraction_mode,
+               'bbox_num': int(all_bboxes.offsets[-1]), 'bbox_digest': all_bboxes.digest(), 'frame_backend': frame_backend,
+               'flow_backend': flow_backend, 'patch_size': patch_size, 'context_frame_num': context_frame_num,
+               'context_of_num': context_of_num, 'h_block': h_block, 'w_block': w_block, 'block_mode': train_block_mode,
+               'motionThr': motionThr}
+    foreground_set = foreground_store_writer(foreground_dir, ['raw', 'flow'] if modality == 'raw2flow' else [modality_column],
+                                             randIdx, meta=fg_meta)
+    if foreground_set.done > 0:
+        print('Resuming foreground extraction after {} of {} frames'.format(foreground_set.done, dataset.__len__()))
+
+    # raw and optical flow windows of the same bboxes are read together
+    dataset_loader = prefetch_loader([dataset, dataset2] if modality == 'raw2flow' else [dataset], indices=foreground_set.order[foreground_set.done:],
+                                     num_workers=num_workers, prefetch_depth=prefetch_depth)
+
+    for iidx, (idx, items) in enumerate(dataset_loader, foreground_set.done):
+        batch, _ = items[0]
         if modality == 'raw2flow':
-            batch2, _ = dataset2.__getitem__(idx)
+            batch2, _ = items[1]
 
         if dataset_name == 'ShanghaiTech':
             print('Extracting foreground in {}-th batch, {} in total, scene: {}'.format(iidx + 1, dataset.__len__() // 1, dataset.scene_idx[idx]))
@@ -196,70 +189,24 @@ if not foreground_saved:
             else:
                 mag = np.ones(batch.shape[0]) * 10000
 
-            for idx_bbox in range(cur_bboxes.shape[0]):
-                if mag[idx_bbox] > motionThr:
-                    all_blocks = calc_block_idx(cur_bboxes[idx_bbox, 0], cur_bboxes[idx_bbox, 2], cur_bboxes[idx_bbox, 1], cur_bboxes[idx_bbox, 3], h_step, w_step, mode=train_block_mode)
-                    for (h_block_idx, w_block_idx) in all_blocks:
-                        if dataset_name == 'ShanghaiTech':
-                            foreground_set[dataset.scene_idx[idx] - 1][h_block_idx][w_block_idx].append(batch[idx_bbox])
-                            if modality == 'raw2flow':
-                                foreground_set2[dataset.scene_idx[idx] - 1][h_block_idx][w_block_idx].append(batch2[idx_bbox])
-                        else:
-                            foreground_set[h_block_idx][w_block_idx].append(batch[idx_bbox])
-                            if modality == 'raw2flow':
-                                foreground_set2[h_block_idx][w_block_idx].append(batch2[idx_bbox])
-
-        if dataset_name == 'ShanghaiTech' and modality == 'raw2flow':
-            if cout == saveSegNum:
-                foreground_set = [[[np.array(foreground_set[ss][hh][ww]) for ww in range(w_block)] for hh in range(h_block)] for ss in range(dataset.scene_num)]
-                foreground_set2 = [[[np.array(foreground_set2[ss][hh][ww]) for ww in range(w_block)] for hh in range(h_block)] for ss in range(dataset.scene_num)]
-                np.save(os.path.join(data_root_dir, modality, dataset_name + '_' + 'foreground_train_{}_seg_{}-raw.npy'.format(foreground_extraction_mode, segIdx)), foreground_set)
-                np.save(os.path.join(data_root_dir, modality, dataset_name + '_' + 'foreground_train_{}_seg_{}-flow.npy'.format(foreground_extraction_mode, segIdx)), foreground_set2)
-                del foreground_set, foreground_set2
-
-                cout = 0
-                segIdx += 1
-                foreground_set = [[[[] for ww in range(w_block)] for hh in range(h_block)] for ss in range(dataset.scene_num)]
-                foreground_set2 = [[[[] for ww in range(w_block)] for hh in range(h_block)] for ss in range(dataset.scene_num)]
-
-    if dataset_name == 'ShanghaiTech':
-        if modality != 'raw2flow':
-            foreground_set = [[[np.array(foreground_set[ss][hh][ww]) for ww in range(w_block)] for hh in range(h_block)] for ss in range(dataset.scene_num)]
-            np.save(os.path.join(data_root_dir, modality, dataset_name + '_' + 'foreground_train_{}.npy'.format(foreground_extraction_mode)), foreground_set)
-        else:
-            if dataset.__len__() % saveSegNum != 0:
-                foreground_set = [[[np.array(foreground_set[ss][hh][ww]) for ww in range(w_block)] for hh in range(h_block)]
-                                  for ss in range(dataset.scene_num)]
-                foreground_set2 = [
-                    [[np.array(foreground_set2[ss][hh][ww]) for ww in range(w_block)] for hh in range(h_block)] for ss in
-                    range(dataset.scene_num)]
-                np.save(os.path.join(data_root_dir, modality,
-                                     dataset_name + '_' + 'foreground_train_{}_seg_{}-raw.npy'.format(
-                                         foreground_extraction_mode, segIdx)), foreground_set)
-                np.save(os.path.join(data_root_dir, modality,
-                                     dataset_name + '_' + 'foreground_train_{}_seg_{}-flow.npy'.format(
-                                         foreground_extraction_mode, segIdx)), foreground_set2)
-    else:
-        if modality == 'raw2flow':
-            foreground_set = [[np.array(foreground_set[hh][ww]) for ww in range(w_block)] for hh in range(h_block)]
-            np.save(os.path.join(data_root_dir, modality, dataset_name + '_' + 'foreground_train_{}-raw.npy'.format(foreground_extraction_mode)), foreground_set)
-            foreground_set2 = [[np.array(foreground_set2[hh][ww]) for ww in range(w_block)] for hh in range(h_block)]
-            np.save(os.path.join(data_root_dir, modality, dataset_name + '_' + 'foreground_train_{}-flow.npy'.format(foreground_extraction_mode)), foreground_set2)
-        else:
-            foreground_set = [[np.array(foreground_set[hh][ww]) for ww in range(w_block)] for hh in range(h_block)]
-            np.save(os.path.join(data_root_dir, modality, dataset_name+'_'+'foreground_train_{}.npy'.format(foreground_extraction_mode)), foreground_set)
+            # blocks of all bboxes of the frame, the bboxes without enough motion are dropped
+            all_blocks = calc_block_idx(cur_bboxes, h_step, w_step, mode=train_block_mode)
+            all_blocks = all_blocks[mag[all_blocks[:, 0]] > motionThr]
+            scene = dataset.scene_idx[idx] - 1 if dataset_name == 'ShanghaiTech' else 0
+            # each crop is stored once and referenced by all of its blocks
+            for idx_bbox in np.unique(all_blocks[:, 0]):
+                cubes = {'raw': batch[idx_bbox], 'flow': batch2[idx_bbox]} if modality == 'raw2flow' else {modality_column: batch[idx_bbox]}
+                blocks = [(scene, h_block_idx, w_block_idx) for h_block_idx, w_block_idx in all_blocks[all_blocks[:, 0] == idx_bbox, 1:]]
+                foreground_set.append(blocks, idx, cur_bboxes[idx_bbox], cubes)
+        foreground_set.frame_done()
+
+    foreground_set.close(frame_num=dataset.__len__())
+    foreground_set = foreground_store(foreground_dir)
     print('foreground for training data saved!')
+    print(shared_frame_cache)
 else:
-    if dataset_name != 'ShanghaiTech':
-        if modality == 'raw2flow':
-            foreground_set = np.load(os.path.join(data_root_dir, modality, dataset_name+'_'+'foreground_train_{}-raw.npy'.format(foreground_extraction_mode)), allow_pickle=True)
-            foreground_set2 = np.load(os.path.join(data_root_dir, modality, dataset_name+'_'+'foreground_train_{}-flow.npy'.format(foreground_extraction_mode)), allow_pickle=True)
-        else:
-            foreground_set = np.load(os.path.join(data_root_dir, modality, dataset_name+'_'+'foreground_train_{}.npy'.format(foreground_extraction_mode)), allow_pickle=True)
-        print('foreground for training data loaded!')
-    else:
-        if modality != 'raw2flow':
-            foreground_set = np.load(os.path.join(data_root_dir, modality, dataset_name + '_' + 'foreground_train_{}.npy'.format(foreground_extraction_mode)), allow_pickle=True)
+    foreground_set = foreground_store(foreground_dir)
+    print('foreground for training data loaded!')
 
 #  /*------------------------------------------Normal event modeling----------------------------------------------*/
 
@@ -288,14 +235,14 @@ if method == 'SelfComplete':
         raw_training_scores_set = [[[[] for ww in range(w_block)] for hh in range(h_block)] for ss in range(frame_size[dataset_name][-1])]
         of_training_scores_set = [[[[] for ww in range(w_block)] for hh in range(h_block)] for ss in range(frame_size[dataset_name][-1])]
     else:
-        model_set = [[[] for ww in range(len(foreground_set[hh]))] for hh in range(len(foreground_set))]
-        raw_training_scores_set = [[[] for ww in range(len(foreground_set[hh]))] for hh in range(len(foreground_set))]
-        of_training_scores_set = [[[] for ww in range(len(foreground_set[hh]))] for hh in range(len(foreground_set))]
+        model_set = [[[] for ww in range(w_block)] for hh in range(h_block)]
+        raw_training_scores_set = [[[] for ww in range(w_block)] for hh in range(h_block)]
+        of_training_scores_set = [[[] for ww in range(w_block)] for hh in range(h_block)]
 
     # Prepare training data in current block
     if dataset_name == 'ShanghaiTech':
-        saveSegNum = cp.getint(dataset_name, 'saveSegNum')
-        totSegNum = np.int(np.ceil(dataset.__len__() / saveSegNum))
+        # the cubes of a block are streamed from the store, at most shuffle_buffer of them are in memory
+        shuffle_buffer = cp.getint(dataset_name, 'shuffle_buffer')
         for s_idx in range(len(model_set)):
             for h_idx in range(len(model_set[s_idx])):
                 for w_idx in range(len(model_set[s_idx][h_idx])):
@@ -306,75 +253,57 @@ if method == 'SelfComplete':
                         SelfCompleteNetFull(features_root=cp.getint(method, 'nf'),
                                         tot_raw_num=tot_frame_num, tot_of_num=tot_of_num, border_mode=border_mode, rawRange=rawRange, useFlow=useFlow, padding=padding)).cuda()
                     optimizer = optim.Adam(cur_model.parameters(), eps=1e-7, weight_decay=0.000)
+                    cur_dataset = cube_block_stream(foreground_set.crops('raw'), foreground_set.crops('flow'),
+                                                    indices=foreground_set.rows((s_idx, h_idx, w_idx)), buffer_size=shuffle_buffer)
                     cur_model.train()
                     for epoch in range(epochs):
-                        for segIdx in range(totSegNum):
-                            foreground_set = np.load(os.path.join(data_root_dir, modality, dataset_name + '_' + 'foreground_train_{}_seg_{}-raw.npy'.format(foreground_extraction_mode, segIdx)))
-                            foreground_set2 = np.load(os.path.join(data_root_dir, modality, dataset_name + '_' + 'foreground_train_{}_seg_{}-flow.npy'.format(foreground_extraction_mode, segIdx)))
-                            cur_training_data = foreground_set[s_idx][h_idx][w_idx]
-                            cur_training_data2 = foreground_set2[s_idx][h_idx][w_idx]
-                            cur_dataset = cube_to_train_dataset(cur_training_data, target=cur_training_data2)
-                            cur_dataloader = DataLoader(dataset=cur_dataset, batch_size=batch_size, shuffle=True)
-
-                            for idx, (inputs, of_targets_all, _) in enumerate(cur_dataloader):
-                                inputs = inputs.cuda().type(torch.cuda.FloatTensor)
-                                of_targets_all = of_targets_all.cuda().type(torch.cuda.FloatTensor)
-
-                                of_outputs, raw_outputs, of_targets, raw_targets = cur_model(inputs, of_targets_all)
-
-                                loss_raw = loss_func(raw_targets.detach(), raw_outputs)
-                                if useFlow:
-                                    loss_of = loss_func(of_targets.detach(), of_outputs)
-
-                                if useFlow:
-                                    loss = lambda_raw * loss_raw + lambda_of * loss_of
-                                else:
-                                    loss = loss_raw
-
-                                raw_losses.update(loss_raw.item(), inputs.size(0))
-                                if useFlow:
-                                    of_losses.update(loss_of.item(), inputs.size(0))
-                                else:
-                                    of_losses.update(0., inputs.size(0))
-
-                                optimizer.zero_grad()
-                                loss.backward()
-                                optimizer.step()
-
-                                if idx % 5 == 0:
-                                    print('Block: ({}, {}), epoch {}, seg {}, batch {} of {}, raw loss: {}, of loss: {}'.format(
-                                        h_idx, w_idx, epoch, segIdx, idx, cur_dataset.__len__() // batch_size, raw_losses.avg,
-                                        of_losses.avg))
-
-                    model_set[s_idx][h_idx][w_idx].append(cur_model.state_dict())
-
-                    #  /*--  A forward pass to store the training scores of optical flow and raw datasets respectively*/
-                    for segIdx in range(totSegNum):
-                        foreground_set = np.load(os.path.join(data_root_dir, modality,
-                                                              dataset_name + '_' + 'foreground_train_{}_seg_{}-raw.npy'.format(
-                                                                  foreground_extraction_mode, segIdx)))
-                        foreground_set2 = np.load(os.path.join(data_root_dir, modality,
-                                                               dataset_name + '_' +  'foreground_train_{}_seg_{}-flow.npy'.format(
-                                                                   foreground_extraction_mode, segIdx)))
-                        cur_training_data = foreground_set[s_idx][h_idx][w_idx]
-                        cur_training_data2 = foreground_set2[s_idx][h_idx][w_idx]
-                        cur_dataset = cube_to_train_dataset(cur_training_data, target=cur_training_data2)
-
-                        forward_dataloader = DataLoader(dataset=cur_dataset, batch_size=batch_size, shuffle=False)
-                        score_func = nn.MSELoss(reduce=False)
-                        cur_model.eval()
-                        for idx, (inputs, of_targets_all, _) in enumerate(forward_dataloader):
+                        for idx, (inputs, of_targets_all) in enumerate(cur_dataset.loader(batch_size, shuffle=True)):
                             inputs = inputs.cuda().type(torch.cuda.FloatTensor)
                             of_targets_all = of_targets_all.cuda().type(torch.cuda.FloatTensor)
 
                             of_outputs, raw_outputs, of_targets, raw_targets = cur_model(inputs, of_targets_all)
-                            raw_scores = score_func(raw_targets, raw_outputs).cpu().data.numpy()
-                            raw_scores = np.sum(np.sum(np.sum(raw_scores, axis=3), axis=2), axis=1)  # mse
-                            raw_training_scores_set[s_idx][h_idx][w_idx].append(raw_scores)
+
+                            loss_raw = loss_func(raw_targets.detach(), raw_outputs)
                             if useFlow:
-                                of_scores = score_func(of_targets, of_outputs).cpu().data.numpy()
-                                of_scores = np.sum(np.sum(np.sum(of_scores, axis=3), axis=2), axis=1)  # mse
-                                of_training_scores_set[s_idx][h_idx][w_idx].append(of_scores)
+                                loss_of = loss_func(of_targets.detach(), of_outputs)
+
+                            if useFlow:
+                                loss = lambda_raw * loss_raw + lambda_of * loss_of
+                            else:
+                                loss = loss_raw
+
+                            raw_losses.update(loss_raw.item(), inputs.size(0))
+                            if useFlow:
+                                of_losses.update(loss_of.item(), inputs.size(0))
+                            else:
+                                of_losses.update(0., inputs.size(0))
+
+                            optimizer.zero_grad()
+                            loss.backward()
+                            optimizer.step()
+
+                            if idx % 5 == 0:
+                                print('Block: ({}, {}), epoch {}, batch {} of {}, raw loss: {}, of loss: {}'.format(
+                                    h_idx, w_idx, epoch, idx, cur_dataset.__len__() // batch_size, raw_losses.avg,
+                                    of_losses.avg))
+
+                    model_set[s_idx][h_idx][w_idx].append(cur_model.state_dict())
+
+                    #  /*--  A forward pass to store the training scores of optical flow and raw datasets respectively*/
+                    score_func = nn.MSELoss(reduce=False)
+                    cur_model.eval()
+                    for idx, (inputs, of_targets_all) in enumerate(cur_dataset.loader(batch_size)):
+                        inputs = inputs.cuda().type(torch.cuda.FloatTensor)
+                        of_targets_all = of_targets_all.cuda().type(torch.cuda.FloatTensor)
+
+                        of_outputs, raw_outputs, of_targets, raw_targets = cur_model(inputs, of_targets_all)
+                        raw_scores = score_func(raw_targets, raw_outputs).cpu().data.numpy()
+                        raw_scores = np.sum(np.sum(np.sum(raw_scores, axis=3), axis=2), axis=1)  # mse
+                        raw_training_scores_set[s_idx][h_idx][w_idx].append(raw_scores)
+                        if useFlow:
+                            of_scores = score_func(of_targets, of_outputs).cpu().data.numpy()
+                            of_scores = np.sum(np.sum(np.sum(of_scores, axis=3), axis=2), axis=1)  # mse
+                            of_training_scores_set[s_idx][h_idx][w_idx].append(of_scores)
 
                     raw_training_scores_set[s_idx][h_idx][w_idx] = np.concatenate(raw_training_scores_set[s_idx][h_idx][w_idx], axis=0)
                     if useFlow:
@@ -386,14 +315,13 @@ if method == 'SelfComplete':
     else:
         raw_losses = AverageMeter()
         of_losses = AverageMeter()
-        for h_idx in range(len(foreground_set)):
-            for w_idx in range(len(foreground_set[h_idx])):
-                cur_training_data = foreground_set[h_idx][w_idx]
+        for h_idx in range(h_block):
+            for w_idx in range(w_block):
+                cur_training_data = foreground_set.cubes((0, h_idx, w_idx), 'raw')
 
                 if len(cur_training_data) > 1:  # num > 1 for data parallel
-                    cur_training_data2 = foreground_set2[h_idx][w_idx]
-                    cur_dataset = cube_to_train_dataset(cur_training_data, target=cur_training_data2)
-                    cur_dataloader = DataLoader(dataset=cur_dataset, batch_size=batch_size, shuffle=True)
+                    cur_training_data2 = foreground_set.cubes((0, h_idx, w_idx), 'flow')
+                    cur_dataset = cube_block_dataset(cur_training_data, cur_training_data2)
 
                     cur_model = torch.nn.DataParallel(SelfCompleteNetFull(features_root=cp.getint(method, 'nf'),
                                         tot_raw_num=tot_frame_num, tot_of_num=tot_of_num, border_mode=border_mode,
@@ -405,7 +333,7 @@ if method == 'SelfComplete':
 
                     cur_model.train()
                     for epoch in range(epochs):
-                        for idx, (inputs, of_targets_all, _) in enumerate(cur_dataloader):
+                        for idx, (inputs, of_targets_all) in enumerate(cur_dataset.loader(batch_size, shuffle=True)):
                             inputs = inputs.cuda().type(torch.cuda.FloatTensor)
                             of_targets_all = of_targets_all.cuda().type(torch.cuda.FloatTensor)
 
@@ -438,12 +366,11 @@ if method == 'SelfComplete':
                     model_set[h_idx][w_idx].append(cur_model.state_dict())
 
                     #  /*--  A forward pass to store the training scores of optical flow and raw datasets respectively*/
-                    forward_dataloader = DataLoader(dataset=cur_dataset, batch_size=128, shuffle=False)
                     raw_score_func = nn.MSELoss(reduce=False)
                     of_score_func = nn.L1Loss(reduce=False)
                     score_func = nn.MSELoss(reduce=False)
                     cur_model.eval()
-                    for idx, (inputs, of_targets_all, _) in enumerate(forward_dataloader):
+                    for idx, (inputs, of_targets_all) in enumerate(cur_dataset.loader(128)):
                         inputs = inputs.cuda().type(torch.cuda.FloatTensor)
                         of_targets_all = of_targets_all.cuda().type(torch.cuda.FloatTensor)
                         of_outputs, raw_outputs, of_targets, raw_targets = cur_model(inputs, of_targets_all)
@@ -1,13 +1,19 @@
 import torch
 import numpy as np
 import cv2
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import multiprocessing
 import os
+import json
 import glob
 import scipy.io as sio
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, BatchSampler, SubsetRandomSampler
 import torchvision.transforms as transforms
+from frame_store import packed_frame_store, packed_store_dir, video_frame_store, load_video_index, video_formats
+from gt_store import gt_store, gt_store_dir
+
+INTER_RESIZE_COEF_BITS = 11  # fixed-point precision of cv2.resize for 8-bit images
 
 transform = transforms.Compose([
         transforms.ToTensor(),
@@ -24,6 +30,67 @@ def get_inputs(file_addr):
     else:
         return cv2.imread(file_addr)
 
+class frame_cache:
+    '''
+    LRU cache of decoded frames shared by the dataset classes, keyed by frame address
+    '''
+    def __init__(self, capacity=2048 * 1024 ** 2):
+        '''
+        :param capacity: maximal number of bytes held by the cache
+        '''
+        self.capacity = capacity
+        self.frames = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __str__(self):
+        tot = self.hits + self.misses
+        return 'frame cache: {} hits, {} misses, hit rate {:.3f}, {} frames ({:.1f} MB) cached'.format(
+            self.hits, self.misses, self.hits / tot if tot > 0 else 0., len(self.frames), self.size / 1024 ** 2)
+
+    def get(self, file_addr):
+        if file_addr in self.frames:
+            self.frames.move_to_end(file_addr)
+            self.hits += 1
+            return self.frames[file_addr]
+        self.misses += 1
+        frame = get_inputs(file_addr)
+        self.put(file_addr, frame)
+        return frame
+
+    def put(self, file_addr, frame):
+        if frame.nbytes > self.capacity:
+            return
+        # cached frames are shared by all windows, so they must never be modified in place
+        frame.flags.writeable = False
+        if file_addr in self.frames:
+            self.size -= self.frames.pop(file_addr).nbytes
+        self.frames[file_addr] = frame
+        self.size += frame.nbytes
+        self.shrink()
+
+    def shrink(self):
+        while self.size > self.capacity:
+            _, frame = self.frames.popitem(last=False)
+            self.size -= frame.nbytes
+
+    def resize(self, capacity):
+        self.capacity = capacity
+        self.shrink()
+
+    def clear(self):
+        self.frames.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+# decoded frames are shared by all datasets, e.g. raw frames and optical flow of the same run
+shared_frame_cache = frame_cache()
+
 def img_tensor2numpy(img):
     # mutual transformation between ndarray-like imgs and Tensor-like images
     # both intensity and rgb images are represented by 3-dim data
@@ -67,20 +134,99 @@ def bbox_collate_test(batch):
     batch_target = [x[1] for x in batch]
     return batch_data, batch_target
 
+# datasets read by the worker processes of prefetch_loader
+prefetch_datasets = None
+
+def dataset_caches(datasets):
+    # distinct frame caches of the datasets, in the same order in the main process and the workers
+    caches = list()
+    for x in datasets:
+        cache = getattr(x, 'cache', None)
+        if cache is not None and all(cache is not y for y in caches):
+            caches.append(cache)
+    return caches
+
+def init_prefetch_worker(datasets):
+    global prefetch_datasets
+    prefetch_datasets = datasets
+    # one decoding thread per worker, the workers already occupy the cores
+    cv2.setNumThreads(1)
+
+def load_prefetch_chunk(indices):
+    # a worker reads strided chunks, frames are only shared by the windows of a chunk, so the caches inherited from the
+    # main process are emptied before each chunk and hold the frames of one chunk at most
+    caches = dataset_caches(prefetch_datasets)
+    for cache in caches:
+        cache.clear()
+    items = [(idx, tuple(x.__getitem__(idx) for x in prefetch_datasets)) for idx in indices]
+    return items, [(cache.hits, cache.misses) for cache in caches]
+
+class prefetch_loader:
+    '''
+    Order-preserving multi-process prefetching of dataset items, yielding (idx, items) with one item per dataset,
+    e.g. the paired raw and optical flow windows of the same bboxes
+    :param datasets: list of datasets read at the same indices
+    :param indices: order in which items are read, all indices of the first dataset in order by default
+    :param num_workers: number of worker processes, 0 to read the items in the main process
+    :param prefetch_depth: max number of chunks being read or waiting to be consumed, 2 * num_workers by default
+    :param chunk_size: number of consecutive indices read by a worker at once, neighbouring context windows share frames
+    '''
+    def __init__(self, datasets, indices=None, num_workers=0, prefetch_depth=None, chunk_size=8):
+        self.datasets = datasets
+        self.indices = list(range(len(datasets[0]))) if indices is None else list(indices)
+        self.num_workers = num_workers
+        self.prefetch_depth = max(prefetch_depth or 2 * num_workers, num_workers, 1)
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        if self.num_workers <= 0:
+            for idx in self.indices:
+                yield idx, tuple(x.__getitem__(idx) for x in self.datasets)
+            return
+        chunks = [self.indices[i:i + self.chunk_size] for i in range(0, len(self.indices), self.chunk_size)]
+        caches = dataset_caches(self.datasets)
+
+        def collect(result):
+            # the hits and misses of the workers are counted by the caches of the main process
+            items, stats = result.get()
+            for cache, (hits, misses) in zip(caches, stats):
+                cache.hits += hits
+                cache.misses += misses
+            return items
+
+        pool = multiprocessing.Pool(self.num_workers, initializer=init_prefetch_worker, initargs=(self.datasets,))
+        try:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(load_prefetch_chunk, (chunk,)))
+                # bounded queue, results are consumed in submission order
+                if len(pending) >= self.prefetch_depth:
+                    for item in collect(pending.popleft()):
+                        yield item
+            while len(pending) > 0:
+                for item in collect(pending.popleft()):
+                    yield item
+        finally:
+            pool.terminate()
+            pool.join()
+
 def get_foreground(img, bboxes, patch_size):
     img_patches = list()
     if len(img.shape) == 3:
         for i in range(len(bboxes)):
-            x_min, x_max = np.int(np.ceil(bboxes[i][0])), np.int(np.ceil(bboxes[i][2]))
-            y_min, y_max = np.int(np.ceil(bboxes[i][1])), np.int(np.ceil(bboxes[i][3]))
+            x_min, x_max = int(np.ceil(bboxes[i][0])), int(np.ceil(bboxes[i][2]))
+            y_min, y_max = int(np.ceil(bboxes[i][1])), int(np.ceil(bboxes[i][3]))
             cur_patch = img[:, y_min:y_max, x_min:x_max]
             cur_patch = cv2.resize(np.transpose(cur_patch, [1, 2, 0]), (patch_size, patch_size))
             img_patches.append(np.transpose(cur_patch, [2, 0, 1]))
         img_patches = np.array(img_patches)
     elif len(img.shape) == 4:
         for i in range(len(bboxes)):
-            x_min, x_max = np.int(np.ceil(bboxes[i][0])), np.int(np.ceil(bboxes[i][2]))
-            y_min, y_max = np.int(np.ceil(bboxes[i][1])), np.int(np.ceil(bboxes[i][3]))
+            x_min, x_max = int(np.ceil(bboxes[i][0])), int(np.ceil(bboxes[i][2]))
+            y_min, y_max = int(np.ceil(bboxes[i][1])), int(np.ceil(bboxes[i][3]))
             cur_patch_set = img[:, :, y_min:y_max, x_min:x_max]
             tmp_set = list()
             for j in range(img.shape[0]):
@@ -92,7 +238,111 @@ def get_foreground(img, bboxes, patch_size):
         img_patches = np.array(img_patches)
     return img_patches
 
-def unified_dataset_interface(dataset_name, dir, mode='train', context_frame_num=0, border_mode='elastic', file_format=None, all_bboxes=None, patch_size=32):
+def calc_resize_grid(start, end, patch_size):
+    # source pixels and weights of resizing the ranges [start, end) to patch_size pixels like cv2.resize (INTER_LINEAR),
+    # the border pixels of each range are replicated
+    length = np.maximum(end - start, 1)[:, np.newaxis]
+    src = ((np.arange(patch_size)[np.newaxis, :] + 0.5) * (length / patch_size) - 0.5).astype(np.float32)
+    idx0 = np.floor(src).astype(np.int64)
+    weight = src - idx0.astype(np.float32)
+    weight[idx0 < 0] = 0
+    idx0 = np.maximum(idx0, 0)
+    weight[idx0 >= length - 1] = 0
+    idx0 = np.minimum(idx0, length - 1)
+    idx1 = np.minimum(idx0 + 1, length - 1)
+    return idx0 + start[:, np.newaxis], idx1 + start[:, np.newaxis], weight
+
+def crop_foreground(img, bboxes, patch_size):
+    '''
+    Batched get_foreground: all bboxes of a (C, H, W) frame or a (T, C, H, W) context window are cropped and resized
+    by one vectorized bilinear sampling into (N, C, p, p) or (N, T, C, p, p) patches. Boxes follow the np.ceil semantics
+    of get_foreground, float inputs match the cv2 path up to rounding and uint8 inputs up to 1 intensity level.
+    '''
+    squeeze = len(img.shape) == 3
+    if squeeze:
+        img = img[np.newaxis]
+    t, c, h, w = img.shape
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    x_min, y_min = np.clip(np.ceil(bboxes[:, 0]), 0, w).astype(np.int64), np.clip(np.ceil(bboxes[:, 1]), 0, h).astype(np.int64)
+    x_max, y_max = np.clip(np.ceil(bboxes[:, 2]), 0, w).astype(np.int64), np.clip(np.ceil(bboxes[:, 3]), 0, h).astype(np.int64)
+    x0, x1, wx = calc_resize_grid(x_min, x_max, patch_size)
+    y0, y1, wy = calc_resize_grid(y_min, y_max, patch_size)
+    x0, x1 = np.minimum(x0, w - 1)[:, np.newaxis, :], np.minimum(x1, w - 1)[:, np.newaxis, :]
+    y0, y1 = (np.minimum(y0, h - 1) * w)[:, :, np.newaxis], (np.minimum(y1, h - 1) * w)[:, :, np.newaxis]
+    flat = img.reshape(t * c, h * w)
+    # (T * C, N, p, p) samples of the four neighbours, interpolated horizontally then vertically
+    if img.dtype == np.uint8:
+        # fixed-point arithmetic of cv2.resize for 8-bit images
+        scale = 1 << INTER_RESIZE_COEF_BITS
+        ax0 = np.round((1 - wx) * scale).astype(np.int32)[:, np.newaxis, :]
+        ax1 = scale - ax0
+        ay0 = np.round((1 - wy) * scale).astype(np.int32)[:, :, np.newaxis]
+        ay1 = scale - ay0
+        top = np.take(flat, y0 + x0, axis=1) * ax0 + np.take(flat, y0 + x1, axis=1) * ax1
+        bottom = np.take(flat, y1 + x0, axis=1) * ax0 + np.take(flat, y1 + x1, axis=1) * ax1
+        patches = (((ay0 * (top >> 4)) >> 16) + ((ay1 * (bottom >> 4)) >> 16) + 2) >> 2
+        patches = patches.astype(np.uint8)
+    else:
+        wx, wy = wx[:, np.newaxis, :], wy[:, :, np.newaxis]
+        top = np.take(flat, y0 + x0, axis=1) * (1 - wx) + np.take(flat, y0 + x1, axis=1) * wx
+        bottom = np.take(flat, y1 + x0, axis=1) * (1 - wx) + np.take(flat, y1 + x1, axis=1) * wx
+        patches = (top * (1 - wy) + bottom * wy).astype(img.dtype)
+    patches = np.ascontiguousarray(np.transpose(patches.reshape((t, c) + patches.shape[1:]), [2, 0, 1, 3, 4]))
+    if squeeze:
+        patches = patches[:, 0]
+    return patches
+
+def calc_context_table(frame_video_idx, context_frame_num, border_mode):
+    '''
+    Context frame indices of all frames as a (tot_frame_num, window) int32 table, the row of a frame is what
+    context_range returned for it. Rows that context_range could not serve (videos shorter than the window)
+    are marked in the returned valid mask.
+    '''
+    video_idx = np.asarray(frame_video_idx, dtype=np.int64)
+    tot_frame_num, c = video_idx.shape[0], context_frame_num
+    indice = np.arange(tot_frame_num)
+    if border_mode == 'elastic':
+        indice = np.where(indice - c < 0, c, np.where(indice + c > tot_frame_num - 1, tot_frame_num - 1 - c, indice))
+        start_idx, end_idx = indice - c, indice + c
+        need_context_num = 2 * c + 1
+    elif border_mode == 'predict':
+        start_idx, end_idx = np.maximum(indice - c, 0), indice
+        need_context_num = c + 1
+    else:
+        start_idx, end_idx = np.maximum(indice - c, 0), np.minimum(indice + c, tot_frame_num - 1)
+        need_context_num = 2 * c + 1
+    valid = (start_idx >= 0) & (end_idx <= tot_frame_num - 1)
+    indice = np.clip(indice, 0, tot_frame_num - 1)
+    start_idx, end_idx = np.clip(start_idx, 0, tot_frame_num - 1), np.clip(end_idx, 0, tot_frame_num - 1)
+    start_idx, end_idx = start_idx[:, np.newaxis], end_idx[:, np.newaxis]
+
+    # video idx of the window, padded by repeating the first (head of dataset) or last (tail) frame
+    k = np.arange(need_context_num)[np.newaxis, :]
+    pad = need_context_num - (end_idx - start_idx + 1)
+    head_pad = (pad > 0) & (start_idx == 0)
+    window = np.where(head_pad, np.maximum(start_idx + k - pad, start_idx), np.minimum(start_idx + k, end_idx))
+    tmp = video_idx[window] - video_idx[indice][:, np.newaxis]
+    offset = tmp.sum(axis=1, keepdims=True)
+    valid &= ~((tmp[:, 0] != 0) & (tmp[:, -1] != 0))
+
+    if border_mode == 'elastic':
+        valid &= pad[:, 0] <= 0
+        table = start_idx - offset + k
+        valid &= ((table >= 0) & (table <= tot_frame_num - 1)).all(axis=1)
+    else:
+        valid &= ~((pad[:, 0] > 0) & (offset[:, 0] != 0))
+        if border_mode == 'predict':
+            low_idx = start_idx - offset
+            table = np.maximum(low_idx + k - np.maximum(np.abs(offset), pad), low_idx)
+        else:
+            table = np.where(offset > 0, np.minimum(start_idx + k, end_idx - offset),
+                             np.where(offset < 0, np.maximum(start_idx + k, start_idx - offset), window))
+        # windows spanning more than two videos break the offset arithmetic above
+        valid &= ((table >= start_idx) & (table <= end_idx)).all(axis=1)
+    table = np.where(valid[:, np.newaxis], table, -1)
+    return table.astype(np.int32), valid
+
+def unified_dataset_interface(dataset_name, dir, mode='train', context_frame_num=0, border_mode='elastic', file_format=None, all_bboxes=None, patch_size=32, cache=shared_frame_cache, frame_backend='file', gt_criterion='pixel'):
 
     if file_format is None:
         if dataset_name in ['UCSDped1', 'UCSDped2']:
@@ -103,11 +353,11 @@ def unified_dataset_interface(dataset_name, dir, mode='train', context_frame_num
             raise NotImplementedError
 
     if dataset_name in ['UCSDped1', 'UCSDped2']:
-        dataset = ped_dataset(dir=dir, context_frame_num=context_frame_num, mode=mode, border_mode=border_mode, all_bboxes=all_bboxes, patch_size=patch_size, file_format=file_format)
+        dataset = ped_dataset(dir=dir, context_frame_num=context_frame_num, mode=mode, border_mode=border_mode, all_bboxes=all_bboxes, patch_size=patch_size, file_format=file_format, cache=cache, frame_backend=frame_backend, gt_criterion=gt_criterion)
     elif dataset_name == 'avenue':
-        dataset = avenue_dataset(dir=dir, context_frame_num=context_frame_num, mode=mode, border_mode=border_mode, all_bboxes=all_bboxes, patch_size=patch_size, file_format=file_format)
+        dataset = avenue_dataset(dir=dir, context_frame_num=context_frame_num, mode=mode, border_mode=border_mode, all_bboxes=all_bboxes, patch_size=patch_size, file_format=file_format, cache=cache, frame_backend=frame_backend, gt_criterion=gt_criterion)
     elif dataset_name == 'ShanghaiTech':
-        dataset = shanghaiTech_dataset(dir=dir, context_frame_num=context_frame_num, mode=mode, border_mode=border_mode, all_bboxes=all_bboxes, patch_size=patch_size, file_format=file_format)
+        dataset = shanghaiTech_dataset(dir=dir, context_frame_num=context_frame_num, mode=mode, border_mode=border_mode, all_bboxes=all_bboxes, patch_size=patch_size, file_format=file_format, cache=cache, frame_backend=frame_backend, gt_criterion=gt_criterion)
     else:
         raise NotImplementedError
 
@@ -167,14 +417,255 @@ class cube_to_train_dataset(Dataset):
             else:
                 return cur_train_data, cur_target, cur_target2
 
-class ped_dataset(Dataset):
+def cube_to_channels(cubes):
+    # (N, T, p, p, C) cubes to (N, T*C, p, p) in the channel order of cube_to_train_dataset, copied once into one contiguous block
+    cubes = np.asarray(cubes)
+    if len(cubes) == 0:
+        return torch.zeros(0)
+    if len(cubes.shape) == 4:
+        cubes = cubes[:, np.newaxis, :, :, :]
+    n, t, h, w, c = cubes.shape
+    channels = np.ascontiguousarray(np.transpose(cubes, [0, 1, 4, 2, 3]))
+    if not channels.flags.writeable:
+        # read-only memory-mapped cubes that are already laid out
+        channels = channels.copy()
+    return torch.from_numpy(channels.reshape(n, t * c, h, w))
+
+class cube_block_dataset(Dataset):
+    '''
+    Cubes and targets of one block laid out as (N, T*C, p, p) tensors, items are whole batches indexed by lists of indices.
+    Outputs match the first two outputs of cube_to_train_dataset, uint8 cubes are scaled to [0, 1] per batch as ToTensor does.
+    '''
+    def __init__(self, data, target):
+        self.data = cube_to_channels(data)
+        self.target = cube_to_channels(target)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, indices):
+        return to_float_tensor(self.data[indices]), to_float_tensor(self.target[indices])
+
+    def loader(self, batch_size, shuffle=False):
+        '''
+        Batches of (inputs, targets), sequential batches are slices of the laid out tensors
+        '''
+        if shuffle:
+            for indices in BatchSampler(SubsetRandomSampler(range(self.__len__())), batch_size=batch_size, drop_last=False):
+                yield self[torch.LongTensor(indices)]
+        else:
+            for start in range(0, self.__len__(), batch_size):
+                yield self[start:start + batch_size]
+
+class cube_block_stream:
+    '''
+    Mini-batches of the cubes of one block streamed from memory-mapped arrays, e.g. the crop table of a foreground_store,
+    without loading the whole block. Outputs match cube_block_dataset. Shuffled batches are drawn from a buffer of at
+    most buffer_size + chunk_size cubes that is refilled with chunks in random order, every cube is read once per pass.
+    '''
+    def __init__(self, data, target, indices=None, buffer_size=20000, chunk_size=1024):
+        '''
+        :param indices: rows of data and target that belong to the block, e.g. foreground_store.rows, all rows by default
+        '''
+        self.data = data
+        self.target = target
+        self.indices = np.arange(len(data)) if indices is None else indices
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.indices)
+
+    def chunk(self, start, size):
+        rows = np.asarray(self.indices[start:start + size])
+        return cube_to_channels(self.data[rows]), cube_to_channels(self.target[rows])
+
+    def loader(self, batch_size, shuffle=False):
+        '''
+        Batches of (inputs, targets), sequential batches follow the order of the arrays
+        '''
+        if not shuffle:
+            for start in range(0, self.__len__(), batch_size):
+                data, target = self.chunk(start, batch_size)
+                yield to_float_tensor(data), to_float_tensor(target)
+            return
+
+        buffer_data, buffer_target, size = None, None, 0
+        # a full batch is always drawn from the buffer, even if buffer_size is smaller than batch_size
+        fill = max(self.buffer_size, batch_size)
+
+        def take(num):
+            # random cubes of the buffer, their slots are refilled with the last cubes of the buffer
+            nonlocal size
+            pick = torch.randperm(size)[:num]
+            batch = to_float_tensor(buffer_data[pick]), to_float_tensor(buffer_target[pick])
+            taken = torch.zeros(size, dtype=torch.bool)
+            taken[pick] = True
+            holes = pick[pick < size - num]
+            tail = torch.nonzero(~taken[size - num:]).flatten() + size - num
+            buffer_data[holes] = buffer_data[tail]
+            buffer_target[holes] = buffer_target[tail]
+            size -= num
+            return batch
+
+        for start in np.random.permutation(np.arange(0, self.__len__(), self.chunk_size)):
+            data, target = self.chunk(start, self.chunk_size)
+            if buffer_data is None:
+                buffer_data = torch.empty((fill + self.chunk_size,) + data.shape[1:], dtype=data.dtype)
+                buffer_target = torch.empty((fill + self.chunk_size,) + target.shape[1:], dtype=target.dtype)
+            buffer_data[size:size + len(data)] = data
+            buffer_target[size:size + len(target)] = target
+            size += len(data)
+            while size >= fill:
+                yield take(batch_size)
+        while size > 0:
+            yield take(min(batch_size, size))
+
+def to_float_tensor(batch):
+    if batch.dtype == torch.uint8:
+        return batch.float().div(255)
+    if batch.dtype == torch.float16:
+        # optical flow stored as float16 by foreground_store
+        return batch.float()
+    return batch
+
+def path_mtime(path):
+    # None for directories and files that do not exist (yet)
+    return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+class frame_dataset(Dataset):
+    '''
+    Frame access shared by the dataset classes
+    '''
+    # attributes found by scan_dataset and persisted in the dataset manifest
+    manifest_keys = ['videos', 'all_frame_addr', 'frame_video_idx', 'tot_frame_num', 'return_gt', 'all_gt_addr', 'gts',
+                     'save_scene_idx', 'scene_idx', 'scene_num']
+
+    def dataset_init(self):
+        # the directories are only walked when the manifest of a previous run is missing or out of date
+        if not self.load_manifest():
+            self.scan_paths = list()
+            self.scan_dataset()
+            self.save_manifest()
+        self.load_gt()
+
+    def glob_dir(self, dir, pattern='*'):
+        # scanned directories are recorded, their mtimes tell whether the manifest is still valid
+        self.scan_paths.append(dir)
+        return sorted(glob.glob(os.path.join(dir, pattern)))
+
+    def filter_videos(self, video_list):
+        # the video backend reads video files lying where the frame folders would be
+        if self.frame_backend == 'video':
+            return [x for x in video_list if os.path.splitext(x)[1].lower() in video_formats]
+        return video_list
+
+    def video_name(self, video):
+        if self.frame_backend == 'video':
+            return os.path.splitext(video.split('/')[-1])[0]
+        return video.split('/')[-1]
+
+    def list_frames(self, video):
+        if self.frame_backend == 'video':
+            # frames of video files are addressed as <video file>#<frame number>
+            self.scan_paths.append(video)
+            return ['{}#{}'.format(video, x) for x in range(load_video_index(video)['length'])]
+        return self.glob_dir(video, '*'+self.file_format)
+
+    def manifest_path(self):
+        file_format = 'video' if self.frame_backend == 'video' else self.file_format.strip('.')
+        return os.path.join(self.dir, 'frame_manifest_{}_{}.json'.format(self.mode, file_format))
+
+    def load_manifest(self):
+        path = self.manifest_path()
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path) as f:
+                manifest = json.load(f, object_pairs_hook=OrderedDict)
+        except ValueError:
+            return False
+        paths = manifest.get('paths')
+        if manifest.get('dir') != self.dir or paths is None or any(path_mtime(x) != t for x, t in paths.items()):
+            return False
+        for key, value in manifest['state'].items():
+            setattr(self, key, value)
+        return True
+
+    def save_manifest(self):
+        manifest = {'dir': self.dir, 'paths': OrderedDict((x, path_mtime(x)) for x in self.scan_paths),
+                    'state': OrderedDict((x, getattr(self, x)) for x in self.manifest_keys if hasattr(self, x))}
+        try:
+            with open(self.manifest_path(), 'w') as f:
+                json.dump(manifest, f)
+        except OSError:
+            # read-only datasets are simply scanned on every construction
+            pass
+
+    def scan_dataset(self):
+        raise NotImplementedError
+
+    def load_gt(self):
+        pass
+
+    def init_gt_store(self, load_func):
+        self.gt = gt_store(gt_store_dir(self.dir), self.mode, self.all_gt_addr, load_func, self.tot_frame_num)
+
+    def get_gt(self, indice):
+        # the pixel mask is only unpacked for the pixel criterion, datasets with frame labels only always return the label
+        if self.gt_criterion == 'pixel' and self.gt.has_masks:
+            return torch.from_numpy(self.gt.mask(indice))
+        return torch.from_numpy(np.array([self.gt.label(indice)], dtype=np.uint8))
+
+    def init_context_table(self):
+        self.context_table, self.context_valid = calc_context_table(self.frame_video_idx, self.context_frame_num, self.border_mode)
+
+    def context_range(self, indice):
+        if not self.context_valid[indice]:
+            print('The video is too short or the context frame number is too large!')
+            raise NotImplementedError
+        return self.context_table[indice]
+
+    def init_frame_store(self, frame_backend):
+        # 'file': decode frames from image/npy files, 'packed': serve frames from the packed store built by pack_frames.py,
+        # 'video': decode frames from video files
+        if frame_backend == 'file':
+            self.frame_store = None
+        elif frame_backend == 'packed':
+            self.frame_store = packed_frame_store(packed_store_dir(self.dir, self.mode))
+            if len(self.frame_store) != self.tot_frame_num:
+                raise ValueError('packed store of {} has {} frames, but {} frames are found, please pack the frames again'.format(
+                    self.dir, len(self.frame_store), self.tot_frame_num))
+        elif frame_backend == 'video':
+            self.frame_store = video_frame_store([x['path'] for x in self.videos.values()], [x['length'] for x in self.videos.values()])
+        else:
+            raise NotImplementedError
+
+    def get_frame(self, indice):
+        if self.frame_store is not None:
+            return self.frame_store[indice]
+        elif self.cache is None:
+            return get_inputs(self.all_frame_addr[indice])
+        else:
+            return self.cache.get(self.all_frame_addr[indice])
+
+    def get_frames(self, frame_range):
+        # frames are copied into a new (T, C, H, W) array, so the cached or memory-mapped frames stay untouched
+        if self.frame_store is not None:
+            return np.ascontiguousarray(np.transpose(self.frame_store.get_window(frame_range), [0, 3, 1, 2]))
+        return np.array([np.transpose(self.get_frame(idx), [2, 0, 1]) for idx in frame_range])
+
+class ped_dataset(frame_dataset):
     '''
     Loading dataset for UCSD ped2
     '''
-    def __init__(self, dir, mode='train', context_frame_num=0, border_mode='elastic', file_format='.tif', all_bboxes=None, patch_size=32):
+    def __init__(self, dir, mode='train', context_frame_num=0, border_mode='elastic', file_format='.tif', all_bboxes=None, patch_size=32, cache=shared_frame_cache, frame_backend='file', gt_criterion='pixel'):
         '''
         :param dir: The directory to load UCSD ped2 dataset
         mode: train/test dataset
+        cache: frame_cache shared by datasets, None to decode frames on every access
+        frame_backend: file/packed/video, where frames are read from
+        gt_criterion: frame/pixel, whether test items come with frame labels or pixel masks
         '''
         self.dir = dir
         self.mode = mode
@@ -187,6 +678,8 @@ class ped_dataset(Dataset):
         self.file_format = file_format
         self.all_bboxes = all_bboxes
         self.patch_size = patch_size
+        self.cache = cache
+        self.gt_criterion = gt_criterion
         self.return_gt = False
         if mode == 'test':
             self.all_gt_addr = list()
@@ -197,12 +690,15 @@ class ped_dataset(Dataset):
         else:
             self.h = 240
             self.w = 360
+        self.frame_backend = frame_backend
         self.dataset_init()
+        self.init_context_table()
+        self.init_frame_store(frame_backend)
 
     def __len__(self):
         return self.tot_frame_num
 
-    def dataset_init(self):
+    def scan_dataset(self):
         if self.mode == 'train':
             data_dir = os.path.join(self.dir, 'Train')
         elif self.mode == 'test':
@@ -211,15 +707,14 @@ class ped_dataset(Dataset):
             raise NotImplementedError
 
         if self.mode == 'train':
-            video_dir_list = glob.glob(os.path.join(data_dir, '*'))
+            video_dir_list = self.filter_videos(self.glob_dir(data_dir))
             idx = 1
             for video in sorted(video_dir_list):
-                video_name = video.split('/')[-1]
+                video_name = self.video_name(video)
                 if 'Train' in video_name:
                     self.videos[video_name] = {}
                     self.videos[video_name]['path'] = video
-                    self.videos[video_name]['frame'] = glob.glob(os.path.join(video, '*'+self.file_format))
-                    self.videos[video_name]['frame'].sort()
+                    self.videos[video_name]['frame'] = self.list_frames(video)
                     self.videos[video_name]['length'] = len(self.videos[video_name]['frame'])
                     self.frame_video_idx += [idx] * self.videos[video_name]['length']
                     idx += 1
@@ -230,7 +725,7 @@ class ped_dataset(Dataset):
             self.tot_frame_num = len(self.all_frame_addr)
 
         elif self.mode == 'test':
-            dir_list = glob.glob(os.path.join(data_dir, '*'))
+            dir_list = self.glob_dir(data_dir)
             video_dir_list = []
             gt_dir_list = []
             for dir in sorted(dir_list):
@@ -244,12 +739,11 @@ class ped_dataset(Dataset):
 
             # load frames for test
             idx = 1
-            for video in sorted(video_dir_list):
-                video_name = video.split('/')[-1]
+            for video in sorted(self.filter_videos(video_dir_list)):
+                video_name = self.video_name(video)
                 self.videos[video_name] = {}
                 self.videos[video_name]['path'] = video
-                self.videos[video_name]['frame'] = glob.glob(os.path.join(video, '*'+self.file_format))
-                self.videos[video_name]['frame'].sort()
+                self.videos[video_name]['frame'] = self.list_frames(video)
                 self.videos[video_name]['length'] = len(self.videos[video_name]['frame'])
                 self.frame_video_idx += [idx] * self.videos[video_name]['length']
                 idx += 1
@@ -264,8 +758,7 @@ class ped_dataset(Dataset):
                 for gt in sorted(gt_dir_list):
                     gt_name = gt.split('/')[-1]
                     self.gts[gt_name] = {}
-                    self.gts[gt_name]['gt_frame'] = glob.glob(os.path.join(gt, '*.bmp'))
-                    self.gts[gt_name]['gt_frame'].sort()
+                    self.gts[gt_name]['gt_frame'] = self.glob_dir(gt, '*.bmp')
 
                 # merge different frames of different videos into one list
                 for _, cont in self.gts.items():
@@ -274,126 +767,41 @@ class ped_dataset(Dataset):
         else:
             raise NotImplementedError
 
-    def context_range(self, indice):
-        if self.border_mode == 'elastic':
-            # check head and tail
-            if indice - self.context_frame_num < 0:
-                indice = self.context_frame_num
-            elif indice + self.context_frame_num > self.tot_frame_num - 1:
-                indice = self.tot_frame_num - 1 - self.context_frame_num
-            start_idx = indice - self.context_frame_num
-            end_idx = indice + self.context_frame_num
-            need_context_num = 2 * self.context_frame_num + 1
-        elif self.border_mode == 'predict':
-            if indice - self.context_frame_num < 0:
-                start_idx = 0
-            else:
-                start_idx = indice - self.context_frame_num
-            end_idx = indice
-            need_context_num = self.context_frame_num + 1
-        else:
-            # check head and tail
-            if indice - self.context_frame_num < 0:
-                start_idx = 0
-            else:
-                start_idx = indice - self.context_frame_num
-
-            if indice + self.context_frame_num > self.tot_frame_num - 1:
-                end_idx = self.tot_frame_num - 1
-            else:
-                end_idx = indice + self.context_frame_num
-            need_context_num = 2 * self.context_frame_num + 1
-
-        center_idx = self.frame_video_idx[indice]
-        video_idx = self.frame_video_idx[start_idx:end_idx + 1]
-        pad = need_context_num - len(video_idx)
-        if pad > 0:
-            if start_idx == 0:
-                video_idx = [video_idx[0]] * pad + video_idx
-            else:
-                video_idx = video_idx + [video_idx[-1]] * pad
-        tmp = np.array(video_idx) - center_idx
-        offset = tmp.sum()
-        if tmp[0] != 0 and tmp[-1] != 0:  # extreme condition that is not likely to happen
-            print('The video is too short or the context frame number is too large!')
-            raise NotImplementedError
-        if pad == 0 and offset == 0:  # all frames are from the same video
-            idx = [x for x in range(start_idx, end_idx+1)]
-            return idx
-        else:
-            if self.border_mode == 'elastic':
-                idx = [x for x in range(start_idx - offset, end_idx - offset + 1)]
-                return idx
-            elif self.border_mode == 'predict':
-                if pad > 0 and np.abs(offset) > 0:
-                    print('The video is too short or the context frame number is too large!')
-                    raise NotImplementedError
-                idx = [x for x in range(start_idx - offset, end_idx + 1)]
-                idx = [idx[0]] * np.maximum(np.abs(offset), pad) + idx
-                return idx
-            else:
-                if pad > 0 and np.abs(offset) > 0:
-                    print('The video is too short or the context frame number is too large!')
-                    raise NotImplementedError
-                if offset > 0:
-                    idx = [x for x in range(start_idx, end_idx - offset + 1)]
-                    idx = idx + [idx[-1]] * np.abs(offset)
-                    return idx
-                elif offset < 0:
-                    idx = [x for x in range(start_idx - offset, end_idx + 1)]
-                    idx = [idx[0]] * np.abs(offset) + idx
-                    return idx
-                if pad > 0:
-                    if start_idx == 0:
-                        idx = [x for x in range(start_idx - offset, end_idx + 1)]
-                        idx = [idx[0]] * pad + idx
-                        return idx
-                    else:
-                        idx = [x for x in range(start_idx, end_idx - offset + 1)]
-                        idx = idx + [idx[-1]] * pad
-                        return idx
+    def load_gt(self):
+        if self.mode == 'test' and self.return_gt:
+            self.init_gt_store(lambda x: cv2.imread(x, cv2.IMREAD_GRAYSCALE)[np.newaxis])
 
     def __getitem__(self, indice):
 
         if self.mode == 'train':
             if self.context_frame_num == 0:
-                img_batch = np.transpose(get_inputs(self.all_frame_addr[indice]), [2, 0, 1])
+                img_batch = self.get_frames([indice])[0]
                 if self.all_bboxes is not None:
-                    img_batch = get_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
+                    img_batch = crop_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
                 img_batch = torch.from_numpy(img_batch)
             else:
                 frame_range = self.context_range(indice=indice)
-                img_batch = []
-                for idx in frame_range:
-                    cur_img = np.transpose(get_inputs(self.all_frame_addr[idx]), [2, 0, 1])
-                    img_batch.append(cur_img)
-                img_batch = np.array(img_batch)
+                img_batch = self.get_frames(frame_range)
                 if self.all_bboxes is not None:
-                    img_batch = get_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
+                    img_batch = crop_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
                 img_batch = torch.from_numpy(img_batch)
             return img_batch, torch.zeros(1)  # to unify the interface
         elif self.mode == 'test':
             if self.context_frame_num == 0:
-                img_batch = np.transpose(get_inputs(self.all_frame_addr[indice]), [2, 0, 1])
+                img_batch = self.get_frames([indice])[0]
                 if self.all_bboxes is not None:
-                    img_batch = get_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
+                    img_batch = crop_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
                 img_batch = torch.from_numpy(img_batch)
                 if self.return_gt:
-                    gt_batch = cv2.imread(self.all_gt_addr[indice], cv2.IMREAD_GRAYSCALE)
-                    gt_batch = torch.from_numpy(gt_batch)
+                    gt_batch = self.get_gt(indice)
             else:
                 frame_range = self.context_range(indice=indice)
-                img_batch = []
-                for idx in frame_range:
-                    cur_img = np.transpose(get_inputs(self.all_frame_addr[idx]), [2, 0, 1])
-                    img_batch.append(cur_img)
-                img_batch = np.array(img_batch)
+                img_batch = self.get_frames(frame_range)
                 if self.all_bboxes is not None:
-                    img_batch = get_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
+                    img_batch = crop_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
                 img_batch = torch.from_numpy(img_batch)
                 if self.return_gt:
-                    gt_batch = cv2.imread(self.all_gt_addr[indice], cv2.IMREAD_GRAYSCALE)
-                    gt_batch = torch.from_numpy(gt_batch)
+                    gt_batch = self.get_gt(indice)
             if self.return_gt:
                 return img_batch, gt_batch
             else:
@@ -401,14 +809,17 @@ class ped_dataset(Dataset):
         else:
             raise NotImplementedError
 
-class avenue_dataset(Dataset):
+class avenue_dataset(frame_dataset):
     '''
     Loading dataset for Avenue
     '''
-    def __init__(self, dir, mode='train', context_frame_num=0, border_mode='elastic', file_format='.jpg', all_bboxes=None, patch_size=32):
+    def __init__(self, dir, mode='train', context_frame_num=0, border_mode='elastic', file_format='.jpg', all_bboxes=None, patch_size=32, cache=shared_frame_cache, frame_backend='file', gt_criterion='pixel'):
         '''
         :param dir: The directory to load Avenue dataset
         mode: train/test dataset
+        cache: frame_cache shared by datasets, None to decode frames on every access
+        frame_backend: file/packed/video, where frames are read from
+        gt_criterion: frame/pixel, whether test items come with frame labels or pixel masks
         '''
         self.dir = dir
         self.mode = mode
@@ -421,35 +832,40 @@ class avenue_dataset(Dataset):
         self.file_format = file_format
         self.all_bboxes = all_bboxes
         self.patch_size = patch_size
+        self.cache = cache
+        self.gt_criterion = gt_criterion
         self.return_gt = False
         if mode == 'test':
-            self.all_gt = list()
+            self.all_gt_addr = list()
+        self.frame_backend = frame_backend
         self.dataset_init()
+        self.init_context_table()
+        self.init_frame_store(frame_backend)
         pass
 
     def __len__(self):
         return self.tot_frame_num
 
-    def dataset_init(self):
+    def scan_dataset(self):
         if self.mode == 'train':
             data_dir = os.path.join(self.dir, 'training', 'frames')
         elif self.mode == 'test':
             data_dir = os.path.join(self.dir, 'testing', 'frames')
             gt_dir = os.path.join(self.dir, 'ground_truth_demo', 'testing_label_mask')
+            self.scan_paths.append(gt_dir)
             if os.path.exists(gt_dir):
                 self.return_gt = True
         else:
             raise NotImplementedError
 
         if self.mode == 'train':
-            video_dir_list = glob.glob(os.path.join(data_dir, '*'))
+            video_dir_list = self.filter_videos(self.glob_dir(data_dir))
             idx = 1
             for video in sorted(video_dir_list):
-                video_name = video.split('/')[-1]
+                video_name = self.video_name(video)
                 self.videos[video_name] = {}
                 self.videos[video_name]['path'] = video
-                self.videos[video_name]['frame'] = glob.glob(os.path.join(video, '*'+self.file_format))
-                self.videos[video_name]['frame'].sort()
+                self.videos[video_name]['frame'] = self.list_frames(video)
                 self.videos[video_name]['length'] = len(self.videos[video_name]['frame'])
                 self.frame_video_idx += [idx] * self.videos[video_name]['length']
                 idx += 1
@@ -460,14 +876,13 @@ class avenue_dataset(Dataset):
             self.tot_frame_num = len(self.all_frame_addr)
 
         elif self.mode == 'test':
-            video_dir_list = glob.glob(os.path.join(data_dir, '*'))
+            video_dir_list = self.filter_videos(self.glob_dir(data_dir))
             idx = 1
             for video in sorted(video_dir_list):
-                video_name = video.split('/')[-1]
+                video_name = self.video_name(video)
                 self.videos[video_name] = {}
                 self.videos[video_name]['path'] = video
-                self.videos[video_name]['frame'] = glob.glob(os.path.join(video, '*'+self.file_format))
-                self.videos[video_name]['frame'].sort()
+                self.videos[video_name]['frame'] = self.list_frames(video)
                 self.videos[video_name]['length'] = len(self.videos[video_name]['frame'])
                 self.frame_video_idx += [idx] * self.videos[video_name]['length']
                 idx += 1
@@ -479,130 +894,45 @@ class avenue_dataset(Dataset):
 
             # set address of ground truth of frames
             if self.return_gt:
-                self.all_gt = [sio.loadmat(os.path.join(gt_dir, str(x + 1)+'_label.mat'))['volLabel'] for x in range(len(self.videos))]
-                self.all_gt = np.concatenate(self.all_gt, axis=1)
+                self.all_gt_addr = [os.path.join(gt_dir, str(x + 1)+'_label.mat') for x in range(len(self.videos))]
         else:
             raise NotImplementedError
 
-    def context_range(self, indice):
-        if self.border_mode == 'elastic':
-            # check head and tail
-            if indice - self.context_frame_num < 0:
-                indice = self.context_frame_num
-            elif indice + self.context_frame_num > self.tot_frame_num - 1:
-                indice = self.tot_frame_num - 1 - self.context_frame_num
-            start_idx = indice - self.context_frame_num
-            end_idx = indice + self.context_frame_num
-            need_context_num = 2 * self.context_frame_num + 1
-        elif self.border_mode == 'predict':
-            if indice - self.context_frame_num < 0:
-                start_idx = 0
-            else:
-                start_idx = indice - self.context_frame_num
-            end_idx = indice
-            need_context_num = self.context_frame_num + 1
-        else:
-            # check head and tail
-            if indice - self.context_frame_num < 0:
-                start_idx = 0
-            else:
-                start_idx = indice - self.context_frame_num
-
-            if indice + self.context_frame_num > self.tot_frame_num - 1:
-                end_idx = self.tot_frame_num - 1
-            else:
-                end_idx = indice + self.context_frame_num
-            need_context_num = 2 * self.context_frame_num + 1
-
-        center_idx = self.frame_video_idx[indice]
-        video_idx = self.frame_video_idx[start_idx:end_idx + 1]
-        pad = need_context_num - len(video_idx)
-        if pad > 0:
-            if start_idx == 0:
-                video_idx = [video_idx[0]] * pad + video_idx
-            else:
-                video_idx = video_idx + [video_idx[-1]] * pad
-        tmp = np.array(video_idx) - center_idx
-        offset = tmp.sum()
-        if tmp[0] != 0 and tmp[-1] != 0:  # extreme condition that is not likely to happen
-            print('The video is too short or the context frame number is too large!')
-            raise NotImplementedError
-        if pad == 0 and offset == 0:  # all frames are from the same video
-            idx = [x for x in range(start_idx, end_idx+1)]
-            return idx
-        else:
-            if self.border_mode == 'elastic':
-                idx = [x for x in range(start_idx - offset, end_idx - offset + 1)]
-                return idx
-            elif self.border_mode == 'predict':
-                if pad > 0 and np.abs(offset) > 0:
-                    print('The video is too short or the context frame number is too large!')
-                    raise NotImplementedError
-                idx = [x for x in range(start_idx - offset, end_idx + 1)]
-                idx = [idx[0]] * np.maximum(np.abs(offset), pad) + idx
-                return idx
-            else:
-                if pad > 0 and np.abs(offset) > 0:
-                    print('The video is too short or the context frame number is too large!')
-                    raise NotImplementedError
-                if offset > 0:
-                    idx = [x for x in range(start_idx, end_idx - offset + 1)]
-                    idx = idx + [idx[-1]] * np.abs(offset)
-                    return idx
-                elif offset < 0:
-                    idx = [x for x in range(start_idx - offset, end_idx + 1)]
-                    idx = [idx[0]] * np.abs(offset) + idx
-                    return idx
-                if pad > 0:
-                    if start_idx == 0:
-                        idx = [x for x in range(start_idx - offset, end_idx + 1)]
-                        idx = [idx[0]] * pad + idx
-                        return idx
-                    else:
-                        idx = [x for x in range(start_idx, end_idx - offset + 1)]
-                        idx = idx + [idx[-1]] * pad
-                        return idx
+    def load_gt(self):
+        if self.mode == 'test' and self.return_gt:
+            # volLabel holds one pixel mask per frame of the video
+            self.init_gt_store(lambda x: np.array(list(sio.loadmat(x)['volLabel'][0])))
 
     def __getitem__(self, indice):
         if self.mode == 'train':
             if self.context_frame_num == 0:
-                img_batch = np.transpose(get_inputs(self.all_frame_addr[indice]), [2, 0, 1])
+                img_batch = self.get_frames([indice])[0]
                 if self.all_bboxes is not None:
-                    img_batch = get_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
+                    img_batch = crop_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
                 img_batch = torch.from_numpy(img_batch)
             else:
                 frame_range = self.context_range(indice=indice)
-                img_batch = []
-                for idx in frame_range:
-                    cur_img = np.transpose(get_inputs(self.all_frame_addr[idx]), [2, 0, 1])
-                    img_batch.append(cur_img)
-                img_batch = np.array(img_batch)
+                img_batch = self.get_frames(frame_range)
                 if self.all_bboxes is not None:
-                    img_batch = get_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
+                    img_batch = crop_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
                 img_batch = torch.from_numpy(img_batch)
             return img_batch, torch.zeros(1)  # to unify the interface
         elif self.mode == 'test':
             if self.context_frame_num == 0:
-                img_batch = np.transpose(get_inputs(self.all_frame_addr[indice]), [2, 0, 1])
+                img_batch = self.get_frames([indice])[0]
                 if self.all_bboxes is not None:
-                    img_batch = get_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
+                    img_batch = crop_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
                 img_batch = torch.from_numpy(img_batch)
                 if self.return_gt:
-                    gt_batch = self.all_gt[0, indice]
-                    gt_batch = torch.from_numpy(gt_batch)
+                    gt_batch = self.get_gt(indice)
             else:
                 frame_range = self.context_range(indice=indice)
-                img_batch = []
-                for idx in frame_range:
-                    cur_img = np.transpose(get_inputs(self.all_frame_addr[idx]), [2, 0, 1])
-                    img_batch.append(cur_img)
-                img_batch = np.array(img_batch)
+                img_batch = self.get_frames(frame_range)
                 if self.all_bboxes is not None:
-                    img_batch = get_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
+                    img_batch = crop_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
                 img_batch = torch.from_numpy(img_batch)
                 if self.return_gt:
-                    gt_batch = self.all_gt[0, indice]
-                    gt_batch = torch.from_numpy(gt_batch)
+                    gt_batch = self.get_gt(indice)
             if self.return_gt:
                 return img_batch, gt_batch
             else:
@@ -610,14 +940,17 @@ class avenue_dataset(Dataset):
         else:
             raise NotImplementedError
 
-class shanghaiTech_dataset(Dataset):
+class shanghaiTech_dataset(frame_dataset):
     '''
     Loading dataset for ShanghaiTech
     '''
-    def __init__(self, dir, mode='train', context_frame_num=0, border_mode='elastic', file_format='.jpg', all_bboxes=None, patch_size=32):
+    def __init__(self, dir, mode='train', context_frame_num=0, border_mode='elastic', file_format='.jpg', all_bboxes=None, patch_size=32, cache=shared_frame_cache, frame_backend='file', gt_criterion='pixel'):
         '''
         :param dir: The directory to load ShanghaiTech dataset
         mode: train/test dataset
+        cache: frame_cache shared by datasets, None to decode frames on every access
+        frame_backend: file/packed/video, where frames are read from
+        gt_criterion: frame/pixel, whether test items come with frame labels or pixel masks
         '''
         self.dir = dir
         self.mode = mode
@@ -630,38 +963,43 @@ class shanghaiTech_dataset(Dataset):
         self.file_format = file_format
         self.all_bboxes = all_bboxes
         self.patch_size = patch_size
+        self.cache = cache
+        self.gt_criterion = gt_criterion
         self.return_gt = False
         self.save_scene_idx = list()
         self.scene_idx = list()
         self.scene_num = 0
         if mode == 'test':
-            self.all_gt = list()
+            self.all_gt_addr = list()
+        self.frame_backend = frame_backend
         self.dataset_init()
+        self.init_context_table()
+        self.init_frame_store(frame_backend)
         pass
 
     def __len__(self):
         return self.tot_frame_num
 
-    def dataset_init(self):
+    def scan_dataset(self):
         if self.mode == 'train':
             data_dir = os.path.join(self.dir, 'training', 'videosFrame')
         elif self.mode == 'test':
             data_dir = os.path.join(self.dir, 'Testing', 'frames_part')
             gt_dir = os.path.join(self.dir, 'Testing', 'test_frame_mask')
+            self.scan_paths.append(gt_dir)
             if os.path.exists(gt_dir):
                 self.return_gt = True
         else:
             raise NotImplementedError
 
         if self.mode == 'train':
-            video_dir_list = glob.glob(os.path.join(data_dir, '*'))
+            video_dir_list = self.filter_videos(self.glob_dir(data_dir))
             idx = 1
             for video in sorted(video_dir_list):
-                video_name = video.split('/')[-1]
+                video_name = self.video_name(video)
                 self.videos[video_name] = {}
                 self.videos[video_name]['path'] = video
-                self.videos[video_name]['frame'] = glob.glob(os.path.join(video, '*'+self.file_format))
-                self.videos[video_name]['frame'].sort()
+                self.videos[video_name]['frame'] = self.list_frames(video)
                 self.videos[video_name]['length'] = len(self.videos[video_name]['frame'])
                 self.frame_video_idx += [idx] * self.videos[video_name]['length']
                 idx += 1
@@ -677,13 +1015,12 @@ class shanghaiTech_dataset(Dataset):
         elif self.mode == 'test':
             idx = 1
             for j in [1, 2]:
-                video_dir_list = glob.glob(os.path.join(data_dir+str(j), '*'))
+                video_dir_list = self.filter_videos(self.glob_dir(data_dir+str(j)))
                 for video in sorted(video_dir_list):
-                    video_name = video.split('/')[-1]
+                    video_name = self.video_name(video)
                     self.videos[video_name] = {}
                     self.videos[video_name]['path'] = video
-                    self.videos[video_name]['frame'] = glob.glob(os.path.join(video, '*'+self.file_format))
-                    self.videos[video_name]['frame'].sort()
+                    self.videos[video_name]['frame'] = self.list_frames(video)
                     self.videos[video_name]['length'] = len(self.videos[video_name]['frame'])
                     self.frame_video_idx += [idx] * self.videos[video_name]['length']
                     idx += 1
@@ -696,137 +1033,48 @@ class shanghaiTech_dataset(Dataset):
                 self.all_frame_addr += cont['frame']
             self.tot_frame_num = len(self.all_frame_addr)
 
-            # load ground truth of frames
+            # set address of ground truth of frames
             if self.return_gt:
-                gt_dir_list = glob.glob(os.path.join(gt_dir, '*'))
-                for gt in sorted(gt_dir_list):
-                    self.all_gt.append(np.load(gt))
-
-                # merge different frames of different videos into one list, only support frame gt now due to memory issue
-                self.all_gt = np.concatenate(self.all_gt, axis=0)
+                self.all_gt_addr = self.glob_dir(gt_dir)
         else:
             raise NotImplementedError
 
+    def load_gt(self):
+        if self.mode == 'test' and self.return_gt:
+            # only frame labels are provided
+            self.init_gt_store(np.load)
 
-    def context_range(self, indice):
-        if self.border_mode == 'elastic':
-            # check head and tail
-            if indice - self.context_frame_num < 0:
-                indice = self.context_frame_num
-            elif indice + self.context_frame_num > self.tot_frame_num - 1:
-                indice = self.tot_frame_num - 1 - self.context_frame_num
-            start_idx = indice - self.context_frame_num
-            end_idx = indice + self.context_frame_num
-            need_context_num = 2 * self.context_frame_num + 1
-        elif self.border_mode == 'predict':
-            if indice - self.context_frame_num < 0:
-                start_idx = 0
-            else:
-                start_idx = indice - self.context_frame_num
-            end_idx = indice
-            need_context_num = self.context_frame_num + 1
-        else:
-            # check head and tail
-            if indice - self.context_frame_num < 0:
-                start_idx = 0
-            else:
-                start_idx = indice - self.context_frame_num
-
-            if indice + self.context_frame_num > self.tot_frame_num - 1:
-                end_idx = self.tot_frame_num - 1
-            else:
-                end_idx = indice + self.context_frame_num
-            need_context_num = 2 * self.context_frame_num + 1
-
-        center_idx = self.frame_video_idx[indice]
-        video_idx = self.frame_video_idx[start_idx:end_idx + 1]
-        pad = need_context_num - len(video_idx)
-        if pad > 0:
-            if start_idx == 0:
-                video_idx = [video_idx[0]] * pad + video_idx
-            else:
-                video_idx = video_idx + [video_idx[-1]] * pad
-        tmp = np.array(video_idx) - center_idx
-        offset = tmp.sum()
-        if tmp[0] != 0 and tmp[-1] != 0:  # extreme condition that is not likely to happen
-            print('The video is too short or the context frame number is too large!')
-            raise NotImplementedError
-        if pad == 0 and offset == 0:  # all frames are from the same video
-            idx = [x for x in range(start_idx, end_idx+1)]
-            return idx
-        else:
-            if self.border_mode == 'elastic':
-                idx = [x for x in range(start_idx - offset, end_idx - offset + 1)]
-                return idx
-            elif self.border_mode == 'predict':
-                if pad > 0 and np.abs(offset) > 0:
-                    print('The video is too short or the context frame number is too large!')
-                    raise NotImplementedError
-                idx = [x for x in range(start_idx - offset, end_idx + 1)]
-                idx = [idx[0]] * np.maximum(np.abs(offset), pad) + idx
-                return idx
-            else:
-                if pad > 0 and np.abs(offset) > 0:
-                    print('The video is too short or the context frame number is too large!')
-                    raise NotImplementedError
-                if offset > 0:
-                    idx = [x for x in range(start_idx, end_idx - offset + 1)]
-                    idx = idx + [idx[-1]] * np.abs(offset)
-                    return idx
-                elif offset < 0:
-                    idx = [x for x in range(start_idx - offset, end_idx + 1)]
-                    idx = [idx[0]] * np.abs(offset) + idx
-                    return idx
-                if pad > 0:
-                    if start_idx == 0:
-                        idx = [x for x in range(start_idx - offset, end_idx + 1)]
-                        idx = [idx[0]] * pad + idx
-                        return idx
-                    else:
-                        idx = [x for x in range(start_idx, end_idx - offset + 1)]
-                        idx = idx + [idx[-1]] * pad
-                        return idx
 
     def __getitem__(self, indice):
         if self.mode == 'train':
             if self.context_frame_num == 0:
-                img_batch = np.transpose(get_inputs(self.all_frame_addr[indice]), [2, 0, 1])
+                img_batch = self.get_frames([indice])[0]
                 if self.all_bboxes is not None:
-                    img_batch = get_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
+                    img_batch = crop_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
                 img_batch = torch.from_numpy(img_batch)
             else:
                 frame_range = self.context_range(indice=indice)
-                img_batch = []
-                for idx in frame_range:
-                    cur_img = np.transpose(get_inputs(self.all_frame_addr[idx]), [2, 0, 1])
-                    img_batch.append(cur_img)
-                img_batch = np.array(img_batch)
+                img_batch = self.get_frames(frame_range)
                 if self.all_bboxes is not None:
-                    img_batch = get_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
+                    img_batch = crop_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
                 img_batch = torch.from_numpy(img_batch)
             return img_batch, torch.zeros(1)  # to unify the interface
         elif self.mode == 'test':
             if self.context_frame_num == 0:
-                img_batch = np.transpose(get_inputs(self.all_frame_addr[indice]), [2, 0, 1])
+                img_batch = self.get_frames([indice])[0]
                 if self.all_bboxes is not None:
-                    img_batch = get_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
+                    img_batch = crop_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
                 img_batch = torch.from_numpy(img_batch)
                 if self.return_gt:
-                    gt_batch = np.array([self.all_gt[indice]])
-                    gt_batch = torch.from_numpy(gt_batch)
+                    gt_batch = self.get_gt(indice)
             else:
                 frame_range = self.context_range(indice=indice)
-                img_batch = []
-                for idx in frame_range:
-                    cur_img = np.transpose(get_inputs(self.all_frame_addr[idx]), [2, 0, 1])
-                    img_batch.append(cur_img)
-                img_batch = np.array(img_batch)
+                img_batch = self.get_frames(frame_range)
                 if self.all_bboxes is not None:
-                    img_batch = get_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
+                    img_batch = crop_foreground(img=img_batch, bboxes=self.all_bboxes[indice], patch_size=self.patch_size)
                 img_batch = torch.from_numpy(img_batch)
                 if self.return_gt:
-                    gt_batch = np.array([self.all_gt[indice]])
-                    gt_batch = torch.from_numpy(gt_batch)
+                    gt_batch = self.get_gt(indice)
             if self.return_gt:
                 return img_batch, gt_batch
             else: